@@ -0,0 +1,385 @@
+"""
+Offline beat and segment analysis of a song, standing in for the Echo Nest API.
+
+analyze() works straight from the audio samples and returns a document in the same form
+as the Echo Nest track analysis, holding just the fields this project uses, so that
+beats.parse_analysis() handles either one.
+
+  - Spectrum: short time Fourier transform of the mono mix, computed block by block so
+    memory use stays flat however long the song.  Power is summed into log-spaced
+    frequency bands.
+  - Onset envelope: spectral flux, the mean rise in band level in dB from one frame to
+    the next, with its slowly varying part removed.
+  - Tempo: peak of the onset envelope's autocorrelation, weighted towards 120 bpm.
+  - Beats: dynamic programming over the onset envelope for the best sequence of beats
+    near the tempo's period (D. Ellis, Beat Tracking by Dynamic Programming, 2007).
+  - Segments: peaks in the onset envelope.  Each segment runs to the next and reports
+    its loudest frame, as loudness_max and loudness_max_time.
+
+Loudness values are in dB relative to full scale.  Results depend only on the samples
+and the parameters below, so repeated runs give identical output.
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+import scipy as sp
+import scipy.fft
+import scipy.io.wavfile
+import scipy.ndimage
+
+#################################################
+
+# Bump this when changes here alter analysis results.
+VERSION = 1
+
+FRAME_TIME = 0.046     # Analysis window, seconds.  Rounded up to a power of two samples.
+BAND_MIN = 40.         # Hz.
+BAND_MAX = 16000.      # Hz.
+NUM_BANDS = 36
+FLOOR = -80.           # dB.
+BLOCK_SIZE = 1024      # Frames per block of spectra.
+
+BPM_MIN = 30.
+BPM_MAX = 300.
+BPM_PRIOR = 120.
+TIGHTNESS = 100.
+
+ONSET_WINDOW = 0.03    # Seconds either side of an onset peak.
+ONSET_DELTA = 0.3      # Envelope standard deviations above the local mean.
+ONSET_GAP = 0.08       # Seconds between segments, at least.
+
+# Flux peaks while an attack is still entering the window, slightly ahead of the
+# attack itself.  Frames, added to onset and beat times.
+ONSET_OFFSET = 0.75
+
+
+def to_mono(data):
+    """
+    Mix (num_frames, num_channels) samples of any WAV sample format down to float32
+    values between -1 and 1.
+    """
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+
+    x = data.mean(axis=1, dtype=np.float32)
+
+    if data.dtype == np.uint8:
+        x = (x - 128.) / 128.
+    elif data.dtype.kind in 'iu':
+        x /= float(np.iinfo(data.dtype).max) + 1.
+
+    # Done.
+    return x.astype(np.float32, copy=False)
+
+
+def frame_size(sample_rate):
+    """
+    Analysis window and hop sizes, samples.
+    """
+    n_fft = 1 << int(np.ceil(np.log2(FRAME_TIME * sample_rate)))
+    hop = n_fft // 4
+
+    # Done.
+    return n_fft, hop
+
+
+def band_starts(n_fft, sample_rate):
+    """
+    First FFT bin of each log-spaced frequency band, plus the end of the last band.
+    """
+    freq_max = min(BAND_MAX, sample_rate / 2.)
+    edges = np.geomspace(BAND_MIN, freq_max, NUM_BANDS + 1)
+    bins = np.unique(np.round(edges * n_fft / sample_rate).astype(int))
+
+    # Done.
+    return bins
+
+
+def spectral_features(data, sample_rate):
+    """
+    Frame by frame spectral flux and loudness of (num_frames, num_channels) samples.
+    Frames are centred on multiples of the hop size.  Returns flux, loudness in dB and
+    the frame rate.
+    """
+    n_fft, hop = frame_size(sample_rate)
+    bins = band_starts(n_fft, sample_rate)
+    window = np.hanning(n_fft).astype(np.float32)
+    scale = 4. / float(n_fft)**2
+
+    num_samples = len(data)
+    num_frames = 1 + num_samples // hop
+    pad = n_fft // 2
+
+    flux = np.zeros(num_frames, dtype=np.float32)
+    loudness = np.zeros(num_frames, dtype=np.float32)
+
+    level_prev = None
+    for f0 in range(0, num_frames, BLOCK_SIZE):
+        f1 = min(f0 + BLOCK_SIZE, num_frames)
+
+        # Samples for this block, zero padded beyond either end of the song.
+        k0 = f0 * hop - pad
+        k1 = (f1 - 1) * hop - pad + n_fft
+        x = np.zeros(k1 - k0, dtype=np.float32)
+        j0 = max(k0, 0)
+        j1 = min(k1, num_samples)
+        x[j0 - k0:j1 - k0] = to_mono(data[j0:j1])
+
+        frames = np.lib.stride_tricks.sliding_window_view(x, n_fft)[::hop]
+
+        power = np.einsum('ij,ij->i', frames, frames) / n_fft
+        loudness[f0:f1] = 10. * np.log10(power + 1.e-10)
+
+        spectrum = sp.fft.rfft(frames * window, axis=1)
+        power = spectrum.real**2 + spectrum.imag**2
+        bands = np.add.reduceat(power[:, bins[0]:bins[-1]], bins[:-1] - bins[0], axis=1)
+        level = np.maximum(10. * np.log10(bands * scale + 1.e-12), FLOOR)
+
+        if level_prev is None:
+            level_prev = level[:1]
+        rise = np.diff(np.vstack([level_prev, level]), axis=0)
+        flux[f0:f1] = np.maximum(rise, 0.).mean(axis=1)
+
+        level_prev = level[-1:]
+
+    loudness = np.maximum(loudness, FLOOR)
+    frame_rate = float(sample_rate) / hop
+
+    # Done.
+    return flux, loudness, frame_rate
+
+
+def onset_envelope(flux, frame_rate):
+    """
+    Remove the slowly varying part of the spectral flux and scale to unit deviation.
+    """
+    size = max(int(round(frame_rate)), 1)
+    env = flux - sp.ndimage.uniform_filter1d(flux, size, mode='nearest')
+    env = np.maximum(env, 0.)
+
+    std = env.std()
+    if std > 0:
+        env /= std
+
+    # Done.
+    return env
+
+
+def estimate_tempo(env, frame_rate):
+    """
+    Tempo from the autocorrelation of the onset envelope.  Returns beats per minute and
+    a confidence between 0 and 1.
+    """
+    n = len(env)
+    x = env - env.mean()
+    spectrum = np.fft.rfft(x, 2 * n)
+    ac = np.fft.irfft(spectrum.real**2 + spectrum.imag**2)[:n]
+    if ac[0] <= 0:
+        return BPM_PRIOR, 0.
+
+    lag_min = max(int(60. * frame_rate / BPM_MAX), 1)
+    lag_max = min(int(60. * frame_rate / BPM_MIN) + 1, n - 2)
+    if lag_max <= lag_min:
+        return BPM_PRIOR, 0.
+
+    lags = np.arange(lag_min, lag_max + 1)
+    bpm = 60. * frame_rate / lags
+    prior = np.exp(-0.5 * np.log2(bpm / BPM_PRIOR)**2)
+
+    k = lags[np.argmax(ac[lags] * prior)]
+
+    # Parabolic interpolation for a fractional lag.
+    a, b, c = ac[k - 1], ac[k], ac[k + 1]
+    denom = a - 2. * b + c
+    if denom < 0:
+        lag = k + 0.5 * (a - c) / denom
+    else:
+        lag = float(k)
+
+    confidence = float(np.clip(b / ac[0], 0., 1.))
+
+    # Done.
+    return float(60. * frame_rate / lag), confidence
+
+
+def track_beats(env, frame_rate, bpm):
+    """
+    Beat positions in fractional frames, chosen by dynamic programming to land on
+    strong onsets while keeping close to the given tempo.
+    """
+    n = len(env)
+    period = 60. * frame_rate / bpm
+
+    # Onset strength smoothed over a small fraction of the period.
+    k = np.arange(-int(period), int(period) + 1)
+    local = np.convolve(env, np.exp(-0.5 * (k * 32. / period)**2), 'same')
+
+    d_min = max(int(round(period / 2.)), 1)
+    d_max = max(int(round(2. * period)), d_min)
+
+    # Penalty for each candidate previous beat, ordered oldest first.
+    d = np.arange(d_max, d_min - 1, -1)
+    penalty = -TIGHTNESS * np.log(d / period)**2
+
+    score = local.copy()
+    backlink = np.full(n, -1, dtype=np.int64)
+    for i in range(d_min, n):
+        k0 = max(i - d_max, 0)
+        k1 = i - d_min + 1
+        candidates = score[k0:k1] + penalty[len(penalty) - (k1 - k0):]
+        j = np.argmax(candidates)
+        score[i] = local[i] + candidates[j]
+        backlink[i] = k0 + j
+
+    # Last beat is the last strong local maximum of the cumulative score.
+    peaks = np.flatnonzero((score[1:-1] > score[:-2]) & (score[1:-1] >= score[2:])) + 1
+    if not len(peaks):
+        return np.zeros(0)
+
+    peaks = peaks[score[peaks] > 0.5 * np.median(score[peaks])]
+    i = peaks[-1]
+
+    frames = []
+    while i >= 0:
+        frames.append(i)
+        i = backlink[i]
+    frames = np.array(frames[::-1])
+
+    # Drop weak beats running into silence at either end.
+    strength = local[frames]
+    keep = np.flatnonzero(strength >= 0.5 * np.sqrt(np.mean(strength**2)))
+    if len(keep):
+        frames = frames[keep[0]:keep[-1] + 1]
+
+    # Done.
+    return refine_peaks(local, frames)
+
+
+def refine_peaks(values, frames):
+    """
+    Fractional frame positions of peaks by parabolic interpolation.
+    """
+    frames = np.asarray(frames, dtype=np.int64)
+    inner = (frames > 0) & (frames < len(values) - 1)
+
+    offset = np.zeros(len(frames))
+    k = frames[inner]
+    a, b, c = values[k - 1], values[k], values[k + 1]
+    denom = a - 2. * b + c
+    ok = denom < 0
+    offset[np.flatnonzero(inner)[ok]] = 0.5 * (a - c)[ok] / denom[ok]
+
+    # Done.
+    return frames + np.clip(offset, -0.5, 0.5)
+
+
+def pick_onsets(env, frame_rate):
+    """
+    Frames starting new segments: onset envelope peaks standing clear of the local mean
+    and spaced at least ONSET_GAP apart.  Frame zero always starts a segment.
+    """
+    w = max(int(round(ONSET_WINDOW * frame_rate)), 1)
+    peak = env == sp.ndimage.maximum_filter1d(env, 2 * w + 1, mode='nearest')
+    mean = sp.ndimage.uniform_filter1d(env, 6 * w + 1, mode='nearest')
+
+    candidates = np.flatnonzero(peak & (env >= mean + ONSET_DELTA))
+
+    gap = ONSET_GAP * frame_rate
+    onsets = [0]
+    for k in candidates:
+        if k - onsets[-1] >= gap:
+            onsets.append(k)
+
+    # Done.
+    return np.array(onsets)
+
+
+def segment_loudness(loudness, starts):
+    """
+    Loudest frame in each segment.  Returns loudness at the start, the maximum and the
+    frame offset of the maximum from the start.
+    """
+    ids = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(loudness))))
+    order = np.lexsort((-loudness[starts[0]:], ids))
+    first = np.searchsorted(ids[order], np.arange(len(starts)))
+    k_max = order[first] + starts[0]
+
+    # Done.
+    return loudness[starts], loudness[k_max], k_max - starts
+
+
+def analyze(data, sample_rate):
+    """
+    Analyze (num_frames, num_channels) samples.  Returns a dictionary in the form of an
+    Echo Nest track analysis with 'track', 'beats' and 'segments' entries.
+    """
+    flux, loudness, frame_rate = spectral_features(data, sample_rate)
+    env = onset_envelope(flux, frame_rate)
+
+    duration = float(len(data)) / sample_rate
+    bpm, tempo_confidence = estimate_tempo(env, frame_rate)
+
+    # Beats.
+    frames = track_beats(env, frame_rate, bpm)
+    times = (frames + ONSET_OFFSET) / frame_rate
+    durations = np.diff(np.append(times, duration))
+    strength = env[np.round(frames).astype(int)]
+    if len(strength):
+        confidence = np.clip(strength / max(strength.max(), 1.e-9), 0., 1.)
+    else:
+        confidence = strength
+
+    beats = [{'start': t, 'duration': dt, 'confidence': c}
+             for t, dt, c in zip(times.tolist(), durations.tolist(), confidence.tolist())]
+
+    # Segments.
+    starts = pick_onsets(env, frame_rate)
+    times = (starts + ONSET_OFFSET) / frame_rate
+    times[0] = 0.
+    durations = np.diff(np.append(times, duration))
+    confidence = np.clip(env[starts] / max(env.max(), 1.e-9), 0., 1.)
+    level_start, level_max, k_max = segment_loudness(loudness, starts)
+
+    segments = [{'start': t, 'duration': dt, 'confidence': c, 'loudness_start': p0,
+                 'loudness_max': p1, 'loudness_max_time': dk / frame_rate}
+                for t, dt, c, p0, p1, dk in zip(times.tolist(), durations.tolist(),
+                                                confidence.tolist(), level_start.tolist(),
+                                                level_max.tolist(), k_max.tolist())]
+
+    track = {'duration': duration,
+             'sample_rate': sample_rate,
+             'tempo': bpm,
+             'tempo_confidence': tempo_confidence,
+             'loudness': float(loudness.max()),
+             'analysis_version': VERSION}
+
+    # Done.
+    return {'track': track, 'beats': beats, 'segments': segments}
+
+#################################################
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Analyze beats and segments of a WAV file.')
+    parser.add_argument('fname', type=str, help='WAV file name.')
+
+    args = parser.parse_args()
+
+    time_A = time.time()
+    sample_rate, data = sp.io.wavfile.read(args.fname, mmap=True)
+    result = analyze(data, sample_rate)
+    time_B = time.time()
+
+    track = result['track']
+    print('Duration: %.1f s' % track['duration'])
+    print('Tempo: %.2f bpm (confidence %.2f)' % (track['tempo'], track['tempo_confidence']))
+    print('Beats: %d' % len(result['beats']))
+    print('Segments: %d' % len(result['segments']))
+    print('Analysis time: %.2f s' % (time_B - time_A))
+
+    # Done.
@@ -1,20 +1,35 @@
 
 import argparse
+import contextlib
+import functools
+import io
+import multiprocessing
 import os
 import threading
 import time
-import ossaudiodev
 
 import numpy as np
 import scipy as sp
 import scipy.io.wavfile
 
-import data_io
-import requests
-
-import pyechonest
-import pyechonest.config
-import pyechonest.track
+try:
+    import data_io
+except ImportError:
+    data_io = None
+
+import analysis
+import cache
+import clock
+import convert
+import decode
+import document
+import echonest
+import metrics
+import playback
+import sinks
+
+# Song file types found by find_songs().
+SONG_EXTENSIONS = ['.wav', '.mp3', '.m4a', '.flac', '.ogg']
 
 """
 The functions and classes in this file handle everything to do with audio signals.
@@ -33,8 +48,12 @@ The Player class has two jobs:
      The audio data is broken up into small chunks sized to allow for a specified time interval between
      chunks.  In between feeding data chunks to the audio device buffer, a timestamp is updated
      and a check is made for user requests to halt.
-     An estimate is also made for the timelag between sending data to the audio device to when
-     sound actually comes out the speaker.
+     The timestamp follows the device's own report of the timelag between sending data to it
+     and sound actually coming out the speaker, see playback.py.  The audio can go to any
+     sink from sinks.py, e.g. a WAV file on a machine without sound.
+     The song is decoded a chunk at a time in another background thread, see decode.py, so
+     compressed songs play directly and a long song takes no more memory than a short one.
+     Each chunk is converted to the sample rate and channels the device plays, see convert.py.
 
   2. The second job performed by this class is to deliver near-realtime information about the time
      and magnitude of individual beats.  This is done by creating a generator that yields this beat
@@ -50,11 +69,18 @@ I love using generators.  Its almost like magic!!
 
 ################################
 # File IO.
-def read_wav(fname):
+def read_wav(fname, mmap=False):
     """
     http://www.scipy.org/doc/api_docs/SciPy.io.wavfile.html
+
+    With mmap the sample data is memory-mapped from the file rather than read in, so
+    opening takes the same short time however long the song.  Data is always shaped
+    (num_frames, num_channels).
     """
-    sample_rate, data = sp.io.wavfile.read(fname)
+    sample_rate, data = sp.io.wavfile.read(fname, mmap=mmap)
+
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
 
     return data, sample_rate
 
@@ -70,71 +96,53 @@ def write_wav(fname, data, sample_rate):
 
 #################################################
 # Echo Nest API stuff.
-def echo_nest_analysis(fname_song, fname_config=None):
+def echo_nest_analysis(fname_song, fname_config=None, store=None):
     """
     Get track details via Echo Nest API.
+
+    The full analysis is streamed straight into a document.Document, kept in the
+    analysis cache, the default one unless store is given, by the song's content.  An
+    analysis saved as YAML by earlier versions is converted the first time it is used.
+    See echonest.fetch_batch() to fetch many songs at once.
     """
     if not fname_config:
         fname_config = 'audio_config.yml'
+    if not store:
+        store = cache.AnalysisCache()
 
     fname_config = os.path.abspath(fname_config)
     path_work = os.path.dirname(fname_config)
 
-    path_analysis = os.path.join(path_work, 'Audio Analysis')
-    if not os.path.isdir(path_analysis):
-        os.mkdir(path_analysis)
+    f = store.document_name(store.digest(fname_song))
 
-    fname_song = os.path.basename(fname_song)
-    b, e = os.path.splitext(fname_song)
-    #if not (e == '.mp3' or e == '.m4a'):
-    #    fname_song = b + '.mp3'
+    name = os.path.basename(fname_song)
+    b, e = os.path.splitext(name)
 
-    fname_analysis = b + '.full.yml'
+    fname_legacy = os.path.join(path_work, 'Audio Analysis', b + '.full.yml')
 
-    f = os.path.join(path_analysis, fname_analysis)
     if os.path.isfile(f):
         print('Load existing analysis')
-        analysis, meta = data_io.read(f)
+        store.touch(f)
+    elif os.path.isfile(fname_legacy):
+        print('Convert existing analysis')
+        doc, meta = data_io.read(fname_legacy)
+        columns, other = document.from_dict(doc)
+        document.write(f, columns, other)
+        store.evict()
     else:
-        # Read config.
-        info, meta = data_io.read(fname_config)
-        if not info['songs']:
-            info['songs'] = {}
-
-        if not 'songs' in info:
-            info['songs'] = {}
-
-        # Configure Echo Nest API key.
-        pyechonest.config.ECHO_NEST_API_KEY = info['api_key']
-
-        # Load track details.
-        if fname_song not in info['songs']:
-            print('Upload new song to Echo Nest: %s' % fname_song)
-
-            info['songs'][fname_song] = {}
-
-            track = pyechonest.track.track_from_filename(fname_song)
+        info = echonest.read_config(fname_config)
+        client = echonest.Client(info['api_key'], info.get('endpoint'), jobs=1)
 
-            info['songs'][fname_song]['id'] = track.id
-            info['songs'][fname_song]['analysis_url'] = track.analysis_url
+        print('Fetch song analysis from %s: %s' % (client.endpoint, name))
+        entry = echonest.fetch_song(client, info['songs'], fname_song, store)
 
-            # Save updated config.
-            data_io.write(fname_config, info)
-
-        else:
-            print('Download song analysis from Echo Nest: %s' % fname_song)
-            track = pyechonest.track.track_from_id(info['songs'][fname_song]['id'])
-
-        print('Retrieve full analysis from url')
-        r = requests.get(track.analysis_url)
-        analysis = r.json()
-
-        print('Save analysis to cache folder')
-        f = os.path.join(path_analysis, fname_analysis)
-        data_io.write(f, analysis)
+        # Save updated config.
+        info['songs'][name] = entry
+        echonest.write_config(fname_config, info)
+        store.evict()
 
     # Done.
-    return analysis
+    return document.Document(f)
 
 
 #################################################
@@ -142,7 +150,12 @@ def echo_nest_analysis(fname_song, fname_config=None):
 def parse_analysis(analysis):
     """
     Pick out the information I want to make my robot dance!
+
+    Takes either a document.Document or an analysis dictionary.
     """
+    if isinstance(analysis, document.Document):
+        return analysis.beat_times(), analysis.segment_table()
+
     beats = []
     for b in analysis['beats']:
         t0 = b['start']
@@ -165,41 +178,86 @@ def parse_analysis(analysis):
 
 
 
-def analyze_song(fname_song):
+def analysis_source(fname_song):
     """
-    Helper function.
+    File a song is analyzed from: the WAV file alongside it if there is one, as that
+    needs no decoding, else the song itself.
     """
+    fname_wav = os.path.splitext(fname_song)[0] + '.wav'
+    if os.path.isfile(fname_wav):
+        return fname_wav
+
+    # Done.
+    return fname_song
 
-    path_work = os.path.dirname(fname_song)
-    path_analysis = os.path.join(path_work, 'Audio Analysis')
-    if not os.path.isdir(path_analysis):
-        os.mkdir(path_analysis)
 
-    b, e = os.path.splitext(os.path.basename(fname_song))
-    fname_beats = b + '.beats.npz'
-    fname_segments = b + '.segments.npz'
 
-    fa = os.path.join(path_analysis, fname_beats)
-    fb = os.path.join(path_analysis, fname_segments)
-    if os.path.isfile(fa) and os.path.isfile(fb):
+def is_stale(fname_song, store=None):
+    """
+    True if a song's audio has changed, or is new to the analysis cache, since it was
+    last analyzed.  Never reads the audio itself.
+    """
+    if not store:
+        store = cache.AnalysisCache()
+
+    key = store.key_cached(analysis_source(fname_song))
+
+    # Done.
+    return not key or not store.contains(key)
+
+
+
+def analyze_song(fname_song, force=False, store=None):
+    """
+    Helper function.  Songs are analyzed locally, see the analysis module, from the WAV
+    file alongside if there is one, else decoded from the song file.  Results are kept
+    in a cache.AnalysisCache, the default one unless another is given.  Set force to
+    analyze again even when cached results exist.
+    """
+    if not store:
+        store = cache.AnalysisCache()
+
+    fname_source = analysis_source(fname_song)
+    key = store.key(fname_source)
+
+    entry = None
+    if not force:
+        entry = store.get(key)
+
+    if entry:
         print('Loading analysis')
-        beats, meta = data_io.read(fa)
-        segments, meta = data_io.read(fb)
+        beats, segments, levels = entry
     else:
         print('Analyze song')
-        analysis = echo_nest_analysis(fname_song)
+        if os.path.splitext(fname_source)[1].lower() == '.wav':
+            data, sample_rate = read_wav(fname_source, mmap=True)
+        else:
+            data, sample_rate = decode.read_all(fname_source)
+        results = analysis.analyze(data, sample_rate)
 
         print('Caching analysis results')
-        beats, segments = parse_analysis(analysis)
+        beats, segments = parse_analysis(results)
 
         beats = np.asarray(beats)
         segments = np.asarray(segments)
+        levels = normalize_levels(segments[:, 2])
 
-        io.write(fa, beats)
-        io.write(fb, segments)
+        store.put(key, beats, segments, levels)
 
-    # Normalize levels.
-    v = segments[:, 2]
+    segments = np.array(segments)
+    segments[:, 2] = levels
+
+    # Done,
+    return beats, segments
+
+
+
+def normalize_levels(v):
+    """
+    Scale segment levels so the median is one and the 10th to 90th percentile range
+    spans 0.1 to 1.4.
+    """
+    v = np.array(v, dtype=float)
 
     v0, v1 = np.percentile(v, [10.0, 90.0])
 
@@ -217,10 +275,98 @@ def analyze_song(fname_song):
     #v = (v - lo) / (hi - lo)
     #v = np.clip(v, 0, 1)
 
-    segments[:, 2] = v
+    # Done.
+    return v
 
-    # Done,
-    return beats, segments
+
+
+def find_songs(path):
+    """
+    Song files in a folder, one per song name.  Analysis reads the WAV file if there is
+    one, so that is preferred over other formats of the same song.
+    """
+    songs = {}
+    for f in sorted(os.listdir(path)):
+        b, e = os.path.splitext(f)
+        e = e.lower()
+        if e not in SONG_EXTENSIONS:
+            continue
+
+        if b not in songs or e == '.wav':
+            songs[b] = os.path.join(path, f)
+
+    # Done.
+    return [songs[b] for b in sorted(songs)]
+
+
+
+def analyze_job(fname_song, force=False, path_cache=None):
+    """
+    Batch worker.  Analyze one song with its output hidden.  Returns the file name,
+    seconds taken and an error message, or None on success.
+    """
+    time_A = time.time()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            analyze_song(fname_song, force, cache.AnalysisCache(path_cache))
+        error = None
+    except Exception as e:
+        error = '%s: %s' % (e.__class__.__name__, e)
+
+    # Done.
+    return fname_song, time.time() - time_A, error
+
+
+
+def analyze_batch(path, jobs=None, force=False, path_cache=None):
+    """
+    Analyze every song in a folder whose cached analysis is missing or stale, or every
+    song with force, across a pool of worker processes.  Failed songs are reported and
+    skipped.  Returns dictionary of (seconds, error) tuples by song file name.
+    """
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+
+    store = cache.AnalysisCache(path_cache)
+
+    songs = find_songs(path)
+    todo = [f for f in songs if force or is_stale(f, store)]
+
+    # Longest first, to finish with short jobs spread across the pool.
+    todo.sort(key=os.path.getsize, reverse=True)
+
+    print('Songs: %d, to analyze: %d, processes: %d' % (len(songs), len(todo), jobs))
+
+    results = {}
+    time_A = time.time()
+
+    pool = multiprocessing.Pool(min(jobs, max(len(todo), 1)))
+    try:
+        job = functools.partial(analyze_job, force=force, path_cache=path_cache)
+        for k, (f, dt, error) in enumerate(pool.imap_unordered(job, todo)):
+            name = os.path.basename(f)
+            if error:
+                print('[%3d/%d] %6.2f s  %s  FAILED  %s' % (k+1, len(todo), dt, name, error))
+            else:
+                print('[%3d/%d] %6.2f s  %s' % (k+1, len(todo), dt, name))
+
+            results[f] = (dt, error)
+
+        pool.close()
+    except KeyboardInterrupt:
+        print('\nUser stop!')
+        pool.terminate()
+
+    pool.join()
+
+    time_B = time.time()
+    failed = sum(1 for dt, error in results.values() if error)
+    work = sum(dt for dt, error in results.values())
+    print('Processed %d songs in %.1f s, %.1f s of work, %d failed' %
+          (len(results), time_B - time_A, work, failed))
+
+    # Done.
+    return results
 
 #############################################################
 
@@ -230,67 +376,114 @@ class Player(threading.Thread):
     This class handles audio play back with ability to report back about beats.
     """
 
-    def __init__(self, fname, time_interval=None, lag=0.):
+    def __init__(self, fname, time_interval=None, lag=0., audio_device=None, analysis=None,
+                 latency=None, sample_rate=None, num_channels=None):
         """
         Initialize class.
+
+        Optionally supply an audio device, a sink from the sinks module or a description
+        for sinks.make_sink(), default the OSS device, and a (beats, segments) tuple to
+        use instead of analyzing the song.
+
+        Latency is the output delay past the device buffer, default as measured by
+        playback.calibrate(), and lag any further delay to allow for.
+
+        The device is asked for the given sample rate and channels, default the song's
+        own, and the song is converted to whatever it accepts, see convert.py.
         """
         threading.Thread.__init__(self)
 
         if not time_interval:
             time_interval = 0.05
+        if latency is None:
+            latency = playback.load_latency()
 
         self.time_interval = time_interval
 
-        self.lock = threading.Lock()
         self.is_running = False
+        self.is_finished = False
 
-        self._timestamp = None
+        self.tick = clock.Event()
+        self.halt = clock.Event()
 
-        b, e = os.path.splitext(fname)
-        #if not (e == '.mp3' or e == '.m4a'):
-        #    fname = b + '.mp3'
+        # Chunks written late enough for the device buffer to run dry count as
+        # deadline misses, allowing for scheduling noise.
+        self.metrics = metrics.LoopMetrics('player', counters=['chunks'])
 
         fname = os.path.normpath(fname)
 
         if not os.path.isfile(fname):
             raise IOError('Input file does not exist: %s' % fname)
 
-        print('Load audio data: %s' % os.path.basename(fname))
-        b, e = os.path.splitext(fname)
-        fname_wav = b + '.wav'
-        data_audio, sample_rate = read_wav(fname_wav)
-
-        num_frames, num_channels = data_audio.shape
+        print('Open audio data: %s' % os.path.basename(fname))
+        self.decoder = decode.open_song(fname)
 
         self.fname = fname
-        self.data_audio = data_audio
-
-        self.num_frames = num_frames
-        self.num_channels = num_channels
-        self.sample_rate = sample_rate
 
         print('Load audio analysis')
-        self.audio_beats, self.audio_segments = analyze_song(fname)
+        if analysis:
+            self.audio_beats, self.audio_segments = analysis
+        else:
+            self.audio_beats, self.audio_segments = analyze_song(fname)
 
         print('Configure audio device')
-        self.chunk_size = int(self.time_interval * self.sample_rate)
-        print('  time interval: %.1f ms' % (self.time_interval*1000))
-        print('  audio chunk size: %d' % self.chunk_size)
+        if not sample_rate:
+            sample_rate = self.decoder.sample_rate
+        if not num_channels:
+            num_channels = self.decoder.num_channels
+
+        if not audio_device or isinstance(audio_device, str):
+            audio_device = sinks.make_sink(audio_device)
 
-        self.audio_device = ossaudiodev.open('w')
-        self.audio_device.setparameters(ossaudiodev.AFMT_S16_LE, self.num_channels, self.sample_rate)
+        self.audio_device = audio_device
+        self.audio_device.setparameters(sinks.AFMT_S16_LE, num_channels, sample_rate)
 
+        # Frames, as for ossaudiodev.
         bufsize =  self.audio_device.bufsize()
         self.bufsize = bufsize
-        print('  audio buffer size: %d' % bufsize)
+        print('  audio buffer size: %d frames' % bufsize)
+
+        clock.sleep(0.01)
+        fmt, num_channels, sample_rate = self.audio_device.setparameters(sinks.AFMT_S16_LE,
+                                                                         num_channels,
+                                                                         sample_rate)
+
+        # Rate and channels the device plays, maybe not those asked for.
+        self.num_channels = num_channels
+        self.sample_rate = sample_rate
 
-        time.sleep(0.01)
-        self.audio_device.setparameters(ossaudiodev.AFMT_S16_LE, self.num_channels, self.sample_rate)
+        self.chunk_size = int(self.time_interval * self.sample_rate)
+        print('  time interval: %.1f ms' % (self.time_interval*1000))
+        print('  audio chunk size: %d' % self.chunk_size)
 
-        # Estimate time lag.
-        self.lag = float(bufsize)/self.chunk_size * self.time_interval + lag
+        # Convert decoded chunks to the device's format as they are decoded.
+        chunk_size = int(self.time_interval * self.decoder.sample_rate)
+        self.converter = convert.Converter(self.decoder.sample_rate, self.decoder.num_channels,
+                                           self.sample_rate, self.num_channels, chunk_size)
+        self.prefetch = decode.Prefetcher(self.decoder, chunk_size, converter=self.converter)
+        print('  audio format: %d Hz, %d channels, from %d Hz, %d channels' %
+              (self.sample_rate, self.num_channels, self.decoder.sample_rate,
+               self.decoder.num_channels))
+
+        # Frame count at the device rate, None if the decoder can not tell in advance.
+        self.num_frames = None
+        if self.decoder.num_frames is not None:
+            self.num_frames = -(-self.decoder.num_frames * self.converter.L // self.converter.M)
+
+        # Delay not reported by the device.
+        self.lag = latency + lag
         print('  time lag: %.3f' % self.lag)
 
+        self.frame_bytes = 2 * self.num_channels
+        self.playback = playback.PlaybackClock(self.sample_rate, self.lag)
+
+        # Bytes of the current decoded chunk not yet written.
+        self.pending = memoryview(b'')
+        self.bytes_written = 0
+
+        # Start decoding now, so audio is ready by the time it is wanted.
+        self.prefetch.start()
+
         # Done.
 
 
@@ -299,18 +492,22 @@ class Player(threading.Thread):
         """
         Timestamp for use music current being played.
         """
-        self.lock.acquire()
-        value = self._timestamp
-        self.lock.release()
+        return self.playback.position()
 
-        return value
+
+    @property
+    def at_end(self):
+        """
+        True once all the song's audio has been written.
+        """
+        return self.prefetch.finished and not len(self.pending)
 
 
-    @timestamp.setter
-    def timestamp(self, value):
-        self.lock.acquire()
-        self._timestamp = value
-        self.lock.release()
+    def ready(self):
+        """
+        True if write_chunk() has audio to write, or the song is over.
+        """
+        return bool(len(self.pending)) or self.prefetch.ready()
 
 
     def run(self):
@@ -318,48 +515,135 @@ class Player(threading.Thread):
         This is where the action happens.
         """
         k0 = 0
-        k1 = 0
-
-        t0 = time.time()
-        t1 = t0
+        t0 = clock.time()
 
         self.is_running = True
         try:
-            while self.is_running:
-
-                k0 = k1
-                k1 = k0 + self.chunk_size
-                data_chunk_str = self.data_audio[k0:k1].tostring()
-
-                self.timestamp = float(k1) / self.sample_rate - self.lag
-                self.audio_device.write(data_chunk_str)
-
-            # Loop is over, Still some data in the pipeline.
-            dt = float(self.bufsize) / float(self.sample_rate)
-            print('Empty buffer: %.2f' % dt)
-            time.sleep(dt)
+            while self.is_running and not self.at_end:
+                # Wait for room in the device buffer, or for stop(), then for the
+                # decoder if it has fallen behind.
+                self.audio_device.wait(self.time_interval)
+                if not self.ready():
+                    self.prefetch.wait(self.time_interval)
+                if self.is_running:
+                    k0 = self.write_chunk(k0, t0)
+
+            if self.is_running:
+                # Loop is over, Still some data in the pipeline.
+                dt = self.time_drain()
+                print('Empty buffer: %.2f' % dt)
+                self.halt.wait(dt)
+            else:
+                self.audio_device.reset()
 
         except KeyboardInterrupt:
             print('\nUser stop!')
             self.stop()
 
-        # Finish.
+        self.finish()
+        clock.detach()
+
+        # Done.
+
+
+    def write_chunk(self, k0, t0):
+        """
+        Write audio from frame k0 on to the device, as much as it has room for up to
+        one chunk, for playback started at time t0.  Never blocks.  Returns the frame
+        following the audio written, k0 if no decoded audio was ready.
+        """
+        if not len(self.pending):
+            chunk = self.prefetch.get()
+            if chunk is None:
+                return k0
+            self.pending = memoryview(chunk).cast('B')
+
+        self.metrics.tick(clock.time(), t0 + float(k0) / self.sample_rate)
+        self.metrics.count('chunks')
+
+        # The rest of one decoded chunk is topped up from the next, so the device's room
+        # is filled in one call rather than one more wake up per chunk.
+        size = self.chunk_size * self.frame_bytes
+        num = 0
+
+        time_A = clock.time()
+        while True:
+            # A write may end part way through a frame.
+            n = self.audio_device.write(self.pending[:size - num])
+            self.pending = self.pending[n:]
+            num += n
+            if len(self.pending) or num >= size or not self.prefetch.ready():
+                break
+
+            chunk = self.prefetch.get()
+            if chunk is None:
+                break
+            self.pending = memoryview(chunk).cast('B')
+
+        self.metrics.observe('write_time', clock.time() - time_A)
+
+        self.bytes_written += num
+        k1 = self.bytes_written // self.frame_bytes
+
+        if num:
+            self.playback.update(k1, self.audio_device.odelay())
+
+            # Once the position is known beats() times its own waits from it.
+            if self.bytes_written == num:
+                self.tick.set()
+
+        # Done.
+        return k1
+
+
+    def time_drain(self):
+        """
+        Time to wait after the last write for the device buffer to play out.
+        """
+        frames = self.audio_device.odelay()
+
+        # Done.
+        return float(frames) / float(self.sample_rate) + self.lag
+
+
+    def finish(self):
+        """
+        Stop decoding, close the audio device and let beats() know playback is over.
+        """
+        self.prefetch.stop()
+        info = self.prefetch.report()
+        if info['speed']:
+            print('Decode: %.1f s of audio at %.0fx real time, %d underruns' %
+                  (float(info['frames']) / self.decoder.sample_rate, info['speed'],
+                   info['underruns']))
+
         print('Close audio device')
         self.audio_device.close()
 
-        # Done.
+        self.is_finished = True
+        self.tick.set()
+
+
+    def start(self):
+        clock.attach()
+        threading.Thread.start(self)
 
 
     def stop(self):
-        if self.isAlive():
+        if self.is_alive():
             print('Player stopping: %s' % os.path.basename(self.fname))
 
         self.is_running = False
+        self.audio_device.interrupt()
+        self.halt.set()
 
 
-    def beats(self):
+    def beats(self, idle=False):
         """
         Setup a generator to yield beat information in a timely manner.
+
+        With idle set, also yield None each time the generator wakes up with no event
+        due, at least every time_interval seconds, e.g. for tempo.anticipate().
         """
 
         # Make a list of audio events.
@@ -367,7 +651,7 @@ class Player(threading.Thread):
         data_segs = [ (t, 'segment', (p,v) ) for t,p,v in self.audio_segments]
 
         data = data_beats + data_segs
-        data = np.asarray(data, dtype=np.object)
+        data = np.asarray(data, dtype=object)
         times = [d[0] for d in data]
 
         ix = np.argsort(times)
@@ -376,8 +660,26 @@ class Player(threading.Thread):
         v_old = 0.
         for d in data:
             t = d[0]
-            while self.timestamp <= t:
-                time.sleep(self.time_interval*0.1)
+            while True:
+                timestamp = self.timestamp
+                if timestamp is not None and timestamp >= t:
+                    break
+                if self.is_finished:
+                    return
+
+                # Wake when the event is due, or once playback starts.  Idle wake ups
+                # come at least every time_interval.
+                wait = self.time_interval
+                if timestamp is not None:
+                    wait = self.playback.wait_time(t)
+                    if idle:
+                        wait = min(wait, self.time_interval)
+
+                self.tick.wait(wait)
+                self.tick.clear()
+
+                if idle:
+                    yield None
 
             yield d
 
@@ -390,14 +692,24 @@ if __name__ == '__main__':
     # Setup.
 
 
-    parser = argparse.ArgumentParser(description='Process a song.')
+    parser = argparse.ArgumentParser(description='Process a song, or a folder of songs.')
 
-    parser.add_argument('fname', type=str, help='Song file name.')
+    parser.add_argument('fname', type=str, help='Song file or folder name.')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Worker processes for a folder, default one per core.')
+    parser.add_argument('--force', action='store_true',
+                        help='Analyze again even when cached results are up to date.')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Analysis cache folder, default %s.' % cache.PATH_DEFAULT)
 
     args = parser.parse_args()
 
-    print('Processing data for: %s' % args.fname)
-    results = analyze_song(args.fname)
+    if os.path.isdir(args.fname):
+        print('Processing songs in: %s' % args.fname)
+        results = analyze_batch(args.fname, args.jobs, args.force, args.cache)
+    else:
+        print('Processing data for: %s' % args.fname)
+        results = analyze_song(args.fname, args.force, cache.AnalysisCache(args.cache))
 
 
 
@@ -0,0 +1,709 @@
+"""
+Benchmarks for the servo control stack.
+
+Everything here runs headless against the in-memory fake I2C bus and the simulated
+hardware from sim.py, so no Raspberry Pi or servo hardware is needed.  Results are
+printed or written as JSON, tagged with the git commit, for comparison between commits.
+
+  - ticks: servo loop tick rate against servo count, for ServoBank and for one
+    DampedServo thread per servo.
+  - jitter: tick interval percentiles of a ServoBank running on the wall clock.
+  - conversion: cost of Response.output() and width to counts conversion.
+  - i2c: transactions and bytes per frame, and frames per second, for burst and
+    per-register channel writes.
+  - latency: beat-to-pulse and beat-to-write latency through
+    lego.Controller.main_dance(), in wall time on the real clock.
+  - mailbox: pulse() latency for lock-based and mailbox command paths.
+  - driver: a pulse sent through driver.RemoteBank moves the servo in the driver
+    process, smoothly, and how long it takes to start.
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import timeit
+
+import numpy as np
+
+import clock
+import damped_servo
+import driver
+import engine
+import pca9685
+import sim
+
+#################################################
+# Helpers.
+
+
+def percentiles(values, q=(50., 90., 99.)):
+    """
+    Summary statistics for a list of timing samples, in microseconds.
+    """
+    values = np.asarray(values) * 1.e6
+    if not len(values):
+        return {}
+
+    info = {'count': len(values),
+            'mean': float(values.mean()),
+            'max': float(values.max())}
+    for p, v in zip(q, np.percentile(values, q)):
+        info['p%g' % p] = float(v)
+
+    # Done.
+    return info
+
+
+def fake_writer():
+    """
+    BurstWriter on a fresh fake I2C bus.
+    """
+    return pca9685.BurstWriter(pca9685.FakeI2C())
+
+
+def make_bank(num_servos, freq=None, writer=None):
+    """
+    ServoBank with one SG-92r servo on each of the first num_servos channels.
+    """
+    if writer is None:
+        writer = fake_writer()
+
+    bank = damped_servo.ServoBank(freq, writer=writer)
+    for k in range(num_servos):
+        bank.add(k, damped_servo.info_sg92r, 0.1)
+
+    # Done.
+    return bank
+
+
+def machine_info():
+    """
+    Describe the code version and machine the benchmarks ran on.
+    """
+    path = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=path,
+                                         stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    info = {'commit': commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'platform': platform.platform()}
+
+    # Done.
+    return info
+
+#################################################
+# Tick rate and jitter.
+
+
+def bench_bank_ticks(num_servos, duration=1.0):
+    """
+    Step a ServoBank as fast as possible with every channel kept moving.  Report step()
+    cost and the achievable tick rate.
+    """
+    bank = make_bank(num_servos)
+    bank.hold([0.5] * num_servos, t=0.)
+
+    rng = np.random.RandomState(0)
+    costs = []
+    t = 0.
+    time_end = time.time() + duration
+    while time.time() < time_end:
+        # New targets every few ticks, as for a busy song.
+        if len(costs) % 5 == 0:
+            bank.force(rng.randint(num_servos), rng.uniform(0., 1.), t=t)
+
+        t += 1. / bank.freq
+
+        time_A = time.time()
+        bank.step(t)
+        costs.append(time.time() - time_A)
+
+    results = {'design': 'ServoBank',
+               'servos': num_servos,
+               'step_us': percentiles(costs),
+               'ticks_per_sec': len(costs) / max(sum(costs), 1.e-9)}
+
+    # Done.
+    return results
+
+
+def bench_thread_ticks(num_servos, duration=1.0, freq=None):
+    """
+    Run one DampedServo thread per servo on a shared writer, each with its deadband
+    disabled and asking for the given tick frequency.  Report total and per-servo tick
+    rates achieved.
+    """
+    if not freq:
+        freq = 1000.  # Hz
+
+    writer = fake_writer()
+    servos = [damped_servo.DampedServo(k, damped_servo.info_sg92r, 0.1, writer=writer)
+              for k in range(num_servos)]
+    for D in servos:
+        D.freq = freq
+        D.eps = 0.
+        D.start()
+
+    rng = np.random.RandomState(0)
+    time_end = time.time() + duration
+    while time.time() < time_end:
+        servos[rng.randint(num_servos)].pulse(rng.uniform(0., 1.))
+        time.sleep(0.01)
+
+    for D in servos:
+        D.stop()
+    for D in servos:
+        D.join()
+
+    rates = [D.tick_rate for D in servos]
+    results = {'design': 'DampedServo',
+               'servos': num_servos,
+               'freq': freq,
+               'ticks_per_sec': sum(rates),
+               'ticks_per_sec_per_servo': sum(rates) / num_servos}
+
+    # Done.
+    return results
+
+
+def bench_ticks(servo_counts=(1, 2, 5, 8, 16), duration=1.0):
+    """
+    Tick rate against servo count.  A PCA9685 board has 16 channels.
+    """
+    results = []
+    for n in servo_counts:
+        results.append(bench_bank_ticks(n, duration))
+        results.append(bench_thread_ticks(n, duration))
+
+    # Done.
+    return results
+
+
+class TimedBank(damped_servo.ServoBank):
+    """
+    ServoBank recording the clock time at the start of each tick.
+    """
+
+    def __init__(self, *args, **kwargs):
+        damped_servo.ServoBank.__init__(self, *args, **kwargs)
+        self.tick_times = []
+
+
+    def step(self, t=None):
+        self.tick_times.append(clock.time())
+        return damped_servo.ServoBank.step(self, t)
+
+
+def bench_jitter(num_servos=5, duration=1.0, freq=None):
+    """
+    Run a ServoBank thread on the wall clock with its deadband disabled, so it ticks on
+    every period, while pulsing random servos.  Report tick interval and its deviation
+    from the nominal period.
+    """
+    bank = TimedBank(freq, eps=0., writer=fake_writer())
+    for k in range(num_servos):
+        bank.add(k, damped_servo.info_sg92r, 0.1)
+
+    bank.start()
+
+    rng = np.random.RandomState(0)
+    time_end = time.time() + duration
+    while time.time() < time_end:
+        bank.force(rng.randint(num_servos), rng.uniform(0., 1.))
+        time.sleep(0.05)
+
+    bank.stop()
+    bank.join()
+
+    period = 1. / bank.freq
+    intervals = np.diff(bank.tick_times)
+    deviation = np.abs(intervals - period)
+
+    results = {'servos': num_servos,
+               'freq': bank.freq,
+               'ticks': len(bank.tick_times),
+               'interval_us': percentiles(intervals),
+               'jitter_us': percentiles(deviation),
+               'late_ticks': int(np.sum(intervals > 1.5*period))}
+
+    # Done.
+    return results
+
+#################################################
+# Conversion cost.
+
+
+def time_call(func, number=None):
+    """
+    Average cost of a call to func, in microseconds.
+    """
+    if not number:
+        number = 10000
+
+    seconds = min(timeit.repeat(func, number=number, repeat=3))
+
+    # Done.
+    return seconds / number * 1.e6
+
+
+def bench_conversion(number=None):
+    """
+    Cost per call of the response models' output(), and of converting pulse widths to
+    PWM counts for single servos and for a full bank.
+    """
+    results = {}
+    for model in [damped_servo.Response, damped_servo.CriticalResponse,
+                  damped_servo.TrapezoidResponse]:
+        response = model(0.1)
+        response.force(0.75)
+        results['%s.output_us' % model.__name__] = time_call(response.output, number)
+
+    servo = damped_servo.Servo(0, damped_servo.info_sg92r, writer=fake_writer())
+    widths = np.linspace(0., 1., 1000)
+    results['Servo.width_to_counts_us'] = time_call(lambda: servo.width_to_counts(0.3),
+                                                    number)
+    results['Servo.widths_to_counts_1000_us'] = time_call(
+        lambda: servo.widths_to_counts(widths), number)
+
+    bank = make_bank(16)
+    widths = np.linspace(0., 1., 16)
+    results['ServoBank.width_to_counts_16_us'] = time_call(
+        lambda: bank.width_to_counts(widths), number)
+    results['ServoBank.output_16_us'] = time_call(bank.output, number)
+
+    # Done.
+    return results
+
+#################################################
+# I2C traffic.
+
+
+def write_registers(i2c, updates):
+    """
+    Original channel writes: four single-register writes per channel, as done by the
+    Adafruit setPWM() method.
+    """
+    for c, (on, off) in updates.items():
+        reg = pca9685.LED0_ON_L + pca9685.BYTES_PER_CHANNEL*c
+        for k, value in enumerate(pca9685.channel_bytes(on, off)):
+            i2c.write8(reg + k, value)
+
+
+def bench_i2c_case(method, channels, duration=0.25):
+    """
+    Write frames updating the given channels to a fake bus.  Report traffic per frame
+    and throughput.
+    """
+    i2c = pca9685.FakeI2C()
+    writer = pca9685.BurstWriter(i2c)
+    i2c.reset_counts()
+
+    frames = 0
+    time_A = time.time()
+    time_end = time_A + duration
+    while time.time() < time_end:
+        frames += 1
+        updates = dict((c, (0, 200 + (frames + c) % 200)) for c in channels)
+
+        if method == 'burst':
+            for c, (on, off) in updates.items():
+                writer.set(c, on, off)
+            writer.flush()
+        else:
+            write_registers(i2c, updates)
+
+    dt = time.time() - time_A
+
+    results = {'method': method,
+               'channels': len(channels),
+               'contiguous': list(channels) == list(range(channels[0], channels[-1] + 1)),
+               'transactions_per_frame': float(i2c.transactions) / frames,
+               'bytes_per_frame': float(i2c.bytes) / frames,
+               'frames_per_sec': frames / dt,
+               'transactions_per_sec': i2c.transactions / dt}
+
+    # Done.
+    return results
+
+
+def bench_i2c(duration=0.25):
+    """
+    Compare burst writes against per-register writes for a few channel layouts.
+    """
+    layouts = [[0],
+               [0, 1, 2, 3, 4],
+               [0, 2, 3, 14, 15],
+               list(range(16))]
+
+    results = []
+    for channels in layouts:
+        for method in ['burst', 'registers']:
+            results.append(bench_i2c_case(method, channels, duration))
+
+    # Done.
+    return results
+
+#################################################
+# Beat-to-pulse latency.
+
+
+def bench_latency(duration=None, model=None, use_engine=False, lead=None):
+    """
+    Play a simulated song in real time through lego.Controller.main_dance(), or
+    main_dance_async() on an engine.Engine, with the audio going to a sinks.NullSink
+    that drains at the sample rate and servo writes going to the fake I2C bus.  For
+    each audio event, measure the wall time from the moment the event is heard, going
+    by the player's playback position, to the matching pulse being issued and to the
+    servo's channel being written.  With lead set, beats are predicted and issued
+    early, see tempo.anticipate(), and beat latency comes out negative.
+    """
+    if not duration:
+        duration = 30.
+
+    path_work = tempfile.mkdtemp()
+
+    pca9685.close_boards()
+    board = pca9685.get_board(factory=pca9685.FakeI2C)
+
+    # Wall time of every channel write.
+    writes = []
+    writer_set = board.writer.set
+
+    def set_timed(channel, on, off):
+        writes.append((clock.time(), channel))
+        writer_set(channel, on, off)
+
+    board.writer.set = set_timed
+
+    try:
+        controller, gpio, audio_device = sim.make_controller(path_work, duration, model=model,
+                                                             lead=lead)
+        player = controller.player
+
+        if use_engine:
+            controller.engine = engine.Engine()
+
+        controller.turn_on()
+
+        pulses = []
+        perform = controller.perform
+
+        def perform_timed(servos, move):
+            time_pulse = clock.time()
+            position = player.playback.position(time_pulse)
+            channel = servos[move.servo].channel
+            pulses.append((time_pulse, position, channel, move.kind, move.t))
+            perform(servos, move)
+
+        controller.perform = perform_timed
+
+        time_A = time.time()
+        if use_engine:
+            controller.engine.run(controller.main_dance_async())
+        else:
+            controller.main_dance()
+        time_B = time.time()
+
+        controller.turn_off()
+        if use_engine:
+            controller.engine.close()
+        else:
+            while controller.bank.is_alive() or player.is_alive():
+                clock.sleep(0.01)
+
+        beat_times = np.asarray(player.audio_beats)
+        num_events = len(player.audio_beats) + len(player.audio_segments)
+
+    finally:
+        pca9685.close_boards()
+        shutil.rmtree(path_work)
+
+    results = {'song_duration': duration,
+               'engine': use_engine,
+               'lead': lead,
+               'events': num_events,
+               'pulses': len(pulses),
+               'time_wall': time_B - time_A}
+
+    write_times = np.asarray([t for t, channel in writes])
+    write_channels = np.asarray([channel for t, channel in writes])
+
+    latency = {'beat': [], 'segment': []}
+    latency_write = {'beat': [], 'segment': []}
+    for k, (time_pulse, position, channel, kind, t) in enumerate(pulses):
+        # Predicted beats are matched to the nearest beat of the song.
+        if kind == 'beat':
+            t = beat_times[np.argmin(np.abs(beat_times - t))]
+        time_heard = time_pulse - (position - t)
+        latency[kind].append(time_pulse - time_heard)
+
+        # First write to the servo's channel after the pulse and before the channel's
+        # next pulse, if the pulse moved it at all.
+        time_end = np.inf
+        for pulse in pulses[k + 1:]:
+            if pulse[2] == channel:
+                time_end = pulse[0]
+                break
+
+        ix = np.flatnonzero((write_times >= time_pulse) & (write_times < time_end) &
+                            (write_channels == channel))
+        if len(ix):
+            latency_write[kind].append(write_times[ix[0]] - time_heard)
+
+    for kind in ['beat', 'segment']:
+        results['%s_latency_us' % kind] = percentiles(latency[kind])
+        results['%s_write_latency_us' % kind] = percentiles(latency_write[kind])
+
+    # Done.
+    return results
+
+
+class LockedCommand(object):
+    """
+    Original DampedServo command path: pulse() and the servo loop share a lock around
+    the response model.
+    """
+
+    def __init__(self, scale):
+        self.response = damped_servo.Response(scale)
+        self.lock = threading.Lock()
+
+
+    def pulse(self, width):
+        self.lock.acquire()
+        self.response.force(width)
+        self.lock.release()
+
+
+    def tick(self):
+        self.lock.acquire()
+        y = self.response.output()
+        self.lock.release()
+
+        return y
+
+
+class MailboxCommand(object):
+    """
+    Current DampedServo command path: pulse() posts an immutable target to a mailbox and
+    the servo loop picks it up without locking.
+    """
+
+    def __init__(self, scale):
+        self.response = damped_servo.Response(scale)
+        self.mailbox = damped_servo.Mailbox(damped_servo.Target(0., scale, self.response.t_set, 0))
+        self.target_old = self.mailbox.read()
+
+
+    def pulse(self, width):
+        target = self.mailbox.read()
+        self.mailbox.post(damped_servo.Target(width, target.scale, clock.time(),
+                                              target.seq + 1))
+
+
+    def tick(self):
+        target = self.mailbox.read()
+        if target is not self.target_old:
+            self.response.force(target.value, target.time)
+            self.target_old = target
+
+        return self.response.output()
+
+
+def bench_command(kind, num_servos, duration=1.0):
+    """
+    Run one spinning loop thread per servo while the calling thread issues pulses to
+    random servos.  Report pulse() call latency and loop tick rate.
+    """
+    commands = [kind(0.1) for k in range(num_servos)]
+    ticks = [0] * num_servos
+    info = {'keep_running': True}
+
+    def loop(k):
+        c = commands[k]
+        while info['keep_running']:
+            c.tick()
+            ticks[k] += 1
+
+    threads = [threading.Thread(target=loop, args=(k,)) for k in range(num_servos)]
+    for t in threads:
+        t.start()
+
+    latency = []
+    rng = np.random.RandomState(0)
+    time_end = time.time() + duration
+    while time.time() < time_end:
+        c = commands[rng.randint(num_servos)]
+        width = rng.uniform(0., 1.)
+
+        time_A = time.time()
+        c.pulse(width)
+        latency.append(time.time() - time_A)
+
+        time.sleep(0.001)
+
+    info['keep_running'] = False
+    for t in threads:
+        t.join()
+
+    results = {'design': kind.__name__,
+               'servos': num_servos,
+               'pulse_latency_us': percentiles(latency),
+               'ticks_per_sec': sum(ticks) / duration}
+
+    # Done.
+    return results
+
+
+def bench_mailbox(servo_counts=(5, 32), duration=1.0):
+    """
+    Compare lock-based and mailbox command paths under contention.
+    """
+    results = []
+    for n in servo_counts:
+        for kind in [LockedCommand, MailboxCommand]:
+            results.append(bench_command(kind, n, duration))
+
+    # Done.
+    return results
+
+#################################################
+# Driver process.
+
+
+def bench_driver(duration=1.0, width=1.0, scale=0.1):
+    """
+    Start a driver.RemoteBank with one servo on the fake I2C bus, pulse it once the
+    driver is up, and follow the width the driver process reports.  Raise an error if
+    the servo never moves, or if it jumps rather than moving through its response.
+    Report time from the pulse to the first movement and to settling.
+
+    Then stop the heartbeat until the driver holds position, and raise an error if the
+    first pulse after that is not obeyed.
+    """
+    timeout = 0.25
+    bank = driver.RemoteBank(factory=pca9685.FakeI2C, timeout=timeout)
+    servo = bank.add(0, damped_servo.info_sg92r, scale)
+    bank.start()
+
+    try:
+        time_end = time.time() + 5.
+        while not bank.status()['ticks'] and time.time() < time_end:
+            time.sleep(0.01)
+
+        time_A = time.time()
+        servo.pulse(width)
+
+        samples = []
+        time_end = time_A + duration
+        while time.time() < time_end:
+            samples.append((time.time() - time_A, bank.width[0]))
+            time.sleep(0.001)
+
+        # Stall the heartbeat until the failsafe holds, then pulse back to zero.
+        bank.keep_running = False
+        bank.heartbeat.join()
+
+        time_end = time.time() + 10. * timeout
+        while not bank.status()['failsafe_active'] and time.time() < time_end:
+            time.sleep(0.01)
+        if not bank.status()['failsafe_active']:
+            raise RuntimeError('Driver did not hold when the heartbeat stopped')
+
+        width_held = bank.width[0]
+        servo.pulse(0.)
+
+        recovered = False
+        time_end = time.time() + duration
+        while not recovered and time.time() < time_end:
+            recovered = bank.width[0] < width_held - bank.eps
+            time.sleep(0.001)
+
+        bank.keep_running = True
+
+    finally:
+        bank.stop()
+        bank.join()
+
+    dt, y = np.asarray(samples).T
+    moved = np.flatnonzero(y > 0.)
+    if not len(moved):
+        raise RuntimeError('Driver servo did not move within %.1f s of a pulse' % duration)
+
+    # A first order response covers 1 - exp(-1/(freq*scale)) of the way in one tick.
+    step_first = y[moved[0]] / width
+    step_max = 2. * (1. - np.exp(-1. / (bank.freq * scale)))
+    if step_first > step_max:
+        raise RuntimeError('Driver servo jumped %.2f of the way in one tick' % step_first)
+    if not recovered:
+        raise RuntimeError('Driver servo ignored the first pulse after a failsafe hold')
+
+    settled = np.flatnonzero(np.abs(y - width) < bank.eps)
+
+    results = {'freq': bank.freq,
+               'scale': scale,
+               'first_step': float(step_first),
+               'move_latency_us': float(dt[moved[0]] * 1.e6),
+               'width_final': float(y[-1]),
+               'status': bank.status()}
+    if len(settled):
+        results['settle_time'] = float(dt[settled[0]])
+
+    # Done.
+    return results
+
+#################################################
+
+
+if __name__ == '__main__':
+
+    names = ['ticks', 'jitter', 'conversion', 'i2c', 'latency', 'mailbox', 'driver']
+
+    parser = argparse.ArgumentParser(description='Servo control benchmarks.')
+    parser.add_argument('--duration', type=float, default=1.0, help='Seconds per case.')
+    parser.add_argument('--song', type=float, default=30., help='Song seconds for latency.')
+    parser.add_argument('--only', type=str, nargs='+', choices=names, default=names,
+                        help='Benchmarks to run.')
+    parser.add_argument('--output', type=str, default=None, help='Write JSON results here.')
+
+    args = parser.parse_args()
+
+    results = {'machine': machine_info()}
+    if 'ticks' in args.only:
+        results['ticks'] = bench_ticks(duration=args.duration)
+    if 'jitter' in args.only:
+        results['jitter'] = bench_jitter(duration=args.duration)
+    if 'conversion' in args.only:
+        results['conversion'] = bench_conversion()
+    if 'i2c' in args.only:
+        results['i2c'] = bench_i2c(duration=args.duration/4.)
+    if 'latency' in args.only:
+        results['latency'] = [bench_latency(args.song),
+                              bench_latency(args.song, use_engine=True),
+                              bench_latency(args.song, lead=0.1)]
+    if 'mailbox' in args.only:
+        results['mailbox'] = bench_mailbox(duration=args.duration)
+    if 'driver' in args.only:
+        results['driver'] = bench_driver(duration=args.duration)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    # Done.
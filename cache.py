@@ -0,0 +1,262 @@
+"""
+Content-addressed cache of song analysis results.
+
+Results live in one folder, by default ~/.cache/DampedServo, keyed by a hash of the
+song's audio file contents and analysis.VERSION.  Two different songs with the same
+name never collide, edited audio is analyzed afresh, and a song that is moved or copied
+is still found.  Each entry is a single small .npz file holding beats, segments and
+normalized segment levels.  Full Echo Nest analysis documents, see document.py, are
+kept the same way, keyed by content alone.
+
+Hashing reads the whole audio file, so each file's hash is remembered in a small index
+file, valid for as long as the file's size and modification time stay the same.
+
+Entries are written to a temporary file and renamed into place, so readers never see a
+partial entry and processes writing the same entry at once do no harm.  When entries
+take up more than the size limit, the least recently used are removed.  Reading an
+entry counts as using it.
+
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import analysis
+
+#################################################
+
+PATH_DEFAULT = os.path.join(os.path.expanduser('~'), '.cache', 'DampedServo')
+MAX_BYTES = 64 * 2**20
+
+# Temporary files older than this, seconds, were left by writers that died.
+TMP_AGE = 3600.
+
+
+def hash_file(fname, block_size=None):
+    """
+    SHA-1 hash of a file's contents.
+    """
+    if not block_size:
+        block_size = 2**20
+
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+
+    # Done.
+    return h.hexdigest()
+
+
+def replace_atomic(fname, write):
+    """
+    Call write() with a temporary file object in the same folder as fname, then rename
+    the temporary file to fname.
+    """
+    path = os.path.dirname(fname)
+    fd, fname_tmp = tempfile.mkstemp(dir=path, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(fname_tmp, fname)
+    except BaseException:
+        os.remove(fname_tmp)
+        raise
+
+    # Done.
+
+
+class AnalysisCache(object):
+    """
+    Analysis results by song content.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        if not path:
+            path = PATH_DEFAULT
+        if not max_bytes:
+            max_bytes = MAX_BYTES
+
+        self.path = path
+        self.max_bytes = max_bytes
+
+        self.path_entries = os.path.join(path, 'entries')
+        self.path_documents = os.path.join(path, 'documents')
+        self.path_index = os.path.join(path, 'index')
+
+        os.makedirs(self.path_entries, exist_ok=True)
+        os.makedirs(self.path_documents, exist_ok=True)
+        os.makedirs(self.path_index, exist_ok=True)
+
+
+    def index_name(self, fname):
+        name = hashlib.sha1(os.path.realpath(fname).encode('utf-8')).hexdigest()
+
+        # Done.
+        return os.path.join(self.path_index, name + '.json')
+
+
+    def lookup(self, fname):
+        """
+        Remembered content hash of an audio file, or None if the file has not been
+        hashed since it last changed.
+        """
+        stat = os.stat(fname)
+        try:
+            with open(self.index_name(fname)) as f:
+                info = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if info.get('size') != stat.st_size or info.get('mtime_ns') != stat.st_mtime_ns:
+            return None
+
+        # Done.
+        return info.get('digest')
+
+
+    def digest(self, fname):
+        """
+        Content hash of an audio file, hashing it if needed.
+        """
+        digest = self.lookup(fname)
+        if digest:
+            return digest
+
+        stat = os.stat(fname)
+        digest = hash_file(fname)
+
+        info = {'path': os.path.realpath(fname),
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'digest': digest}
+        replace_atomic(self.index_name(fname),
+                       lambda f: f.write(json.dumps(info).encode('utf-8')))
+
+        # Done.
+        return digest
+
+
+    def key(self, fname):
+        """
+        Entry key for an audio file: its content hash and the analysis version.
+        """
+        return '%s.v%d' % (self.digest(fname), analysis.VERSION)
+
+
+    def key_cached(self, fname):
+        """
+        Entry key for an audio file if its hash is remembered, else None.
+        """
+        digest = self.lookup(fname)
+        if not digest:
+            return None
+
+        # Done.
+        return '%s.v%d' % (digest, analysis.VERSION)
+
+
+    def entry_name(self, key):
+        return os.path.join(self.path_entries, key + '.npz')
+
+
+    def contains(self, key):
+        return os.path.isfile(self.entry_name(key))
+
+
+    def document_name(self, digest):
+        """
+        File name for the full analysis document of an audio file with this content hash.
+        """
+        return os.path.join(self.path_documents, digest + '.npz')
+
+
+    def touch(self, fname):
+        """
+        Mark a cached file as recently used.
+        """
+        try:
+            os.utime(fname)
+        except OSError:
+            pass
+
+
+    def get(self, key):
+        """
+        Cached (beats, segments, levels) for a key, or None.
+        """
+        fname = self.entry_name(key)
+        try:
+            with np.load(fname) as data:
+                entry = data['beats'], data['segments'], data['levels']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+        self.touch(fname)
+
+        # Done.
+        return entry
+
+
+    def put(self, key, beats, segments, levels):
+        """
+        Store analysis results under a key, then evict old entries if the cache is over
+        its size limit.
+        """
+        arrays = {'beats': np.asarray(beats, dtype=float),
+                  'segments': np.asarray(segments, dtype=float).reshape(-1, 3),
+                  'levels': np.asarray(levels, dtype=float)}
+
+        replace_atomic(self.entry_name(key), lambda f: np.savez(f, **arrays))
+        self.evict()
+
+
+    def evict(self):
+        """
+        Remove least recently used entries and documents until the cache fits its size
+        limit, and temporary files abandoned by writers.
+        """
+        t_now = time.time()
+
+        entries = []
+        for path in [self.path_entries, self.path_documents]:
+            for name in os.listdir(path):
+                fname = os.path.join(path, name)
+                try:
+                    stat = os.stat(fname)
+                except OSError:
+                    continue
+
+                if name.endswith('.tmp'):
+                    if t_now - stat.st_mtime > TMP_AGE:
+                        remove(fname)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, fname))
+
+        total = sum(size for t, size, fname in entries)
+        for t, size, fname in sorted(entries)[:-1]:
+            if total <= self.max_bytes:
+                break
+
+            remove(fname)
+            total -= size
+
+        # Done.
+
+
+def remove(fname):
+    """
+    Remove a file another process may have removed already.
+    """
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
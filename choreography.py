@@ -0,0 +1,249 @@
+"""
+Dance moves for Lego Batman's robot arm.
+
+The function dance() holds the decisions that turn a song's beat and segment events into
+servo targets.  lego.Controller.main_dance() calls it live, event by event.
+
+compile_timeline() instead runs the same decisions over a whole song ahead of time.  It
+drives a ServoBank against the fake I2C bus at the bank's own tick rate and records
+every channel's target, width and PWM counts at each tick.  The result is cached as
+NumPy arrays and memory-mapped by the Timeline class.  Playback is then just an index
+lookup by audio timestamp.
+
+"""
+
+import collections
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import damped_servo
+import pca9685
+
+#################################################
+
+# Bump this when changes to the dance or the servo model invalidate cached timelines.
+VERSION = 1
+
+Move = collections.namedtuple('Move', ['t', 'kind', 'servo', 'value', 'level', 'width'])
+
+
+def merge_events(beats, segments):
+    """
+    Make a time-ordered list of audio events in the same form as yielded by
+    beats.Player.beats().
+    """
+    data_beats = [(t, 'beat') for t in beats]
+    data_segs = [(t, 'segment', (p, v)) for t, p, v in segments]
+
+    data = data_beats + data_segs
+    times = [d[0] for d in data]
+
+    ix = np.argsort(times, kind='mergesort')
+
+    # Done.
+    return [data[k] for k in ix]
+
+
+def dance(events, lohi, beat_servos=None, segment_servos=None, alpha=None):
+    """
+    Generator yielding one Move for each audio event.  Beats alternate between the
+    beat servos and segments rotate through the segment servos.  Each servo flips
+    between its low and high positions from lohi, scaled by a smoothed loudness level.
+    """
+    if beat_servos is None:
+        beat_servos = [0, 3]
+    if segment_servos is None:
+        segment_servos = [2, 1, 4]
+    if alpha is None:
+        alpha = 0.05
+
+    parity = [False] * len(lohi)
+
+    ix_beat = 0
+    ix_segment = 0
+    v_old = 0.
+    for d in events:
+        t, k = d[:2]
+
+        if k == 'beat':
+            ix_beat += 1
+            servo = beat_servos[ix_beat % len(beat_servos)]
+
+        elif k == 'segment':
+            ix_segment += 1
+            ix_segment = ix_segment % len(segment_servos)
+            servo = segment_servos[ix_segment]
+
+            p, v = d[2]
+            v_old = alpha * v_old + (1. - alpha) * v
+
+        else:
+            raise ValueError('Invalid kind: %s' % k)
+
+        parity[servo] = not parity[servo]
+        value = lohi[servo][parity[servo]]
+
+        width = value * v_old
+        if width > 1:
+            width = 1
+        if width < 0:
+            width = 0
+
+        yield Move(t, k, servo, value, v_old, width)
+
+#################################################
+
+
+class Timeline(object):
+    """
+    Precompiled per-channel servo timeline, memory-mapped from the cache.
+    """
+
+    def __init__(self, fname_base):
+        """
+        Open timeline files sharing the given base name.
+        """
+        with open(fname_base + '.json') as f:
+            meta = json.load(f)
+
+        self.fname_base = fname_base
+        self.rate = meta['rate']
+        self.channels = meta['channels']
+        self.beats = meta['beats']
+
+        self.targets = np.load(fname_base + '.targets.npy', mmap_mode='r')
+        self.widths = np.load(fname_base + '.widths.npy', mmap_mode='r')
+        self.counts = np.load(fname_base + '.counts.npy', mmap_mode='r')
+
+        self.num_frames = len(self.counts)
+        self.duration = float(self.num_frames - 1) / self.rate
+
+
+    def index(self, t):
+        """
+        Frame index for a time in seconds since the start of the song.
+        """
+        k = int(t * self.rate)
+        if k < 0:
+            k = 0
+        if k >= self.num_frames:
+            k = self.num_frames - 1
+
+        # Done.
+        return k
+
+
+    def lookup(self, t):
+        """
+        PWM counts for all channels at a time in seconds since the start of the song.
+        """
+        return self.counts[self.index(t)]
+
+
+def render(beats, segments, config, tail=None):
+    """
+    Render complete timeline for a song.  Returns arrays of targets, widths and counts,
+    each shaped (num_frames, num_servos), sampled at the configured bank frequency.
+    """
+    if tail is None:
+        tail = 2.0
+
+    writer = pca9685.BurstWriter(pca9685.FakeI2C())
+    bank = damped_servo.ServoBank(config['freq'], config['eps'], writer=writer,
+                                  model=config['model'])
+    for s in config['servos']:
+        bank.add(s['channel'], s['info'], s['scale'], sign=s.get('sign'), alpha=s.get('alpha'),
+                 vmin=s.get('vmin'), vmax=s.get('vmax'))
+
+    bank.hold([s['initial'] for s in config['servos']], t=0.)
+
+    events = merge_events(beats, segments)
+    moves = list(dance(events, config['lohi'], config['beat_servos'], config['segment_servos']))
+
+    rate = float(bank.freq)
+    duration = tail
+    if moves:
+        duration += moves[-1].t
+    num_frames = int(duration * rate) + 1
+
+    shape = (num_frames, len(bank))
+    targets = np.zeros(shape, dtype=np.float32)
+    widths = np.zeros(shape, dtype=np.float32)
+    counts = np.zeros(shape, dtype=np.uint16)
+
+    k = 0
+    for i in range(num_frames):
+        t = i / rate
+        while k < len(moves) and moves[k].t <= t:
+            bank.force(moves[k].servo, moves[k].width, t=moves[k].t)
+            k += 1
+
+        bank.step(t)
+
+        targets[i] = bank.y_set
+        widths[i] = bank.width
+        counts[i] = bank.counts
+
+    # Done.
+    return targets, widths, counts
+
+
+def timeline_key(beats, segments, config):
+    """
+    Cache key for a song's analysis plus controller configuration.
+    """
+    h = hashlib.sha1()
+    h.update(('version %d' % VERSION).encode('utf-8'))
+    h.update(np.ascontiguousarray(beats, dtype=float).tobytes())
+    h.update(np.ascontiguousarray(segments, dtype=float).tobytes())
+    h.update(json.dumps(config, sort_keys=True, default=repr).encode('utf-8'))
+
+    # Done.
+    return h.hexdigest()
+
+
+def compile_timeline(beats, segments, config, path_cache=None):
+    """
+    Return Timeline for a song, rendering and caching it first if needed.
+
+    config holds the controller setup: per-servo settings under 'servos' (channel, info,
+    scale and optional sign, alpha, vmin, vmax, plus 'initial' width), the 'lohi' table,
+    'beat_servos', 'segment_servos', and the bank's 'freq', 'eps' and 'model'.
+    """
+    if not path_cache:
+        path_cache = os.path.join('Audio Analysis', 'Timelines')
+
+    if not os.path.isdir(path_cache):
+        os.makedirs(path_cache)
+
+    key = timeline_key(beats, segments, config)
+    fname_base = os.path.join(path_cache, key)
+
+    if os.path.isfile(fname_base + '.json'):
+        print('Load existing timeline')
+    else:
+        print('Compile timeline')
+        targets, widths, counts = render(beats, segments, config)
+
+        # Write arrays first and meta data last, so a partial write is never mistaken
+        # for a complete timeline.
+        for name, data in [('targets', targets), ('widths', widths), ('counts', counts)]:
+            f = '%s.%s.npy' % (fname_base, name)
+            np.save(f + '.tmp.npy', data)
+            os.rename(f + '.tmp.npy', f)
+
+        meta = {'rate': float(config['freq']),
+                'channels': [s['channel'] for s in config['servos']],
+                'beats': [float(t) for t in beats],
+                'version': VERSION}
+
+        f = fname_base + '.json'
+        with open(f + '.tmp', 'w') as fp:
+            json.dump(meta, fp)
+        os.rename(f + '.tmp', f)
+
+    # Done.
+    return Timeline(fname_base)
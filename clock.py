@@ -0,0 +1,237 @@
+"""
+Pluggable clock used by the servo, audio and show controller code.
+
+By default everything runs in real time, on the monotonic clock.  Installing a
+VirtualClock instead lets a whole show run in simulated time, as fast as the CPU allows.
+Virtual time only advances once every participating thread is blocked in sleep() or
+waiting on an Event made by the clock; it then jumps straight to the earliest wake-up
+time.
+
+The thread that creates a VirtualClock participates automatically.  Threads started
+later must call attach() from the starting thread before they start, and detach() when
+they finish.  The servo and player classes do this in their start() and run() methods.
+
+"""
+
+import threading
+import time as _time
+
+#################################################
+
+
+class RealClock(object):
+    """
+    Real time, from the monotonic clock so it never jumps when the system time is set.
+    """
+
+    def time(self):
+        return _time.monotonic()
+
+
+    def sleep(self, dt):
+        if dt > 0:
+            _time.sleep(dt)
+
+
+    def sleep_until(self, t):
+        self.sleep(t - _time.monotonic())
+
+
+    def Event(self):
+        return threading.Event()
+
+
+    def attach(self):
+        pass
+
+
+    def detach(self):
+        pass
+
+
+class VirtualEvent(object):
+    """
+    Event whose wait() timeout runs on a VirtualClock.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.flag = False
+
+
+    def is_set(self):
+        return self.flag
+
+
+    def set(self):
+        with self.clock.lock:
+            self.flag = True
+            for entry in self.clock.waiting:
+                if entry.event is self:
+                    entry.cond.notify()
+
+
+    def clear(self):
+        self.flag = False
+
+
+    def wait(self, timeout=None):
+        if timeout is None:
+            t = float('inf')
+        else:
+            t = self.clock.now + timeout
+
+        self.clock.block(t, self)
+
+        # Done.
+        return self.flag
+
+
+class Waiter(object):
+    """
+    A thread blocked on a VirtualClock, waiting for a time or an event.
+    """
+
+    def __init__(self, t, event, lock):
+        self.t = t
+        self.event = event
+        self.cond = threading.Condition(lock)
+
+
+class VirtualClock(object):
+    """
+    Simulated time shared by a fixed set of participating threads.
+    """
+
+    def __init__(self, start=0.):
+        self.now = float(start)
+        self.lock = threading.Lock()
+
+        # Each thread's Waiter, reused every time it blocks.
+        self.local = threading.local()
+
+        # Number of participating threads, and those currently blocked.
+        self.threads = 1
+        self.waiting = []
+
+
+    def time(self):
+        return self.now
+
+
+    def sleep(self, dt):
+        self.block(self.now + max(dt, 0.))
+
+
+    def sleep_until(self, t):
+        self.block(t)
+
+
+    def Event(self):
+        return VirtualEvent(self)
+
+
+    def attach(self):
+        """
+        Register one more participating thread.  Call before starting the thread.
+        """
+        with self.lock:
+            self.threads += 1
+
+
+    def detach(self):
+        """
+        Unregister the calling thread.  Call as the thread finishes.
+        """
+        with self.lock:
+            self.threads -= 1
+            self.advance()
+
+
+    def ready(self, waiter):
+        return waiter.t <= self.now or (waiter.event is not None and waiter.event.flag)
+
+
+    def advance(self):
+        """
+        Jump to the earliest wake-up time once every participating thread is blocked and
+        none of them is ready to run, then wake the threads that are due.  Call with the
+        lock held.
+        """
+        if len(self.waiting) < self.threads:
+            return
+
+        due = [w for w in self.waiting if self.ready(w)]
+        if not due:
+            t = min(w.t for w in self.waiting)
+            if t == float('inf'):
+                return
+
+            self.now = t
+            due = [w for w in self.waiting if w.t <= t]
+
+        for w in due:
+            w.cond.notify()
+
+
+    def block(self, t, event=None):
+        """
+        Block calling thread until virtual time reaches t, or the event is set.
+        """
+        waiter = getattr(self.local, 'waiter', None)
+        if waiter is None:
+            waiter = Waiter(t, event, self.lock)
+            self.local.waiter = waiter
+
+        with self.lock:
+            waiter.t = t
+            waiter.event = event
+            self.waiting.append(waiter)
+
+            while not self.ready(waiter):
+                self.advance()
+                if self.ready(waiter):
+                    break
+                waiter.cond.wait()
+
+            self.waiting.remove(waiter)
+
+#################################################
+
+current = RealClock()
+
+
+def install(clock):
+    """
+    Make the supplied clock current.  Returns the previous clock.
+    """
+    global current
+    previous = current
+    current = clock
+
+    # Done.
+    return previous
+
+
+def time():
+    return current.time()
+
+
+def sleep(dt):
+    current.sleep(dt)
+
+
+def sleep_until(t):
+    current.sleep_until(t)
+
+
+def Event():
+    return current.Event()
+
+
+def attach():
+    current.attach()
+
+
+def detach():
+    current.detach()
@@ -0,0 +1,343 @@
+"""
+Chunk by chunk conversion of decoded audio to the format an output device plays.
+
+A Converter takes chunks of samples in any format the decoders produce, unsigned 8-bit,
+16, 24 or 32-bit integers or floating point, and any number of channels, and turns
+them into 16-bit samples with the device's channels and sample rate:
+
+  - Format: samples are scaled to floating point values between -1 and 1.
+  - Channels: mixed by a fixed matrix, see mix_matrix().  Mono goes to every output
+    channel, and extra input channels are averaged into the outputs.
+  - Rate: polyphase resampling by the ratio of the rates, up by L and down by M, with
+    a Kaiser windowed low pass filter of TAPS input samples per output sample.  Only
+    the filter phases needed for each output sample are evaluated.
+
+Every buffer is allocated up front for the largest chunk, so converting a chunk
+allocates nothing, and the work per chunk is a fixed number of array operations.  The
+filter is centred on each output sample, so converted audio keeps its timing exactly,
+but each output sample needs the input up to latency seconds after it.  flush() gives
+the last of the output at the end of the song.
+
+"""
+
+import math
+
+import numpy as np
+
+#################################################
+
+TAPS = 16              # Filter length, in input samples at the lower of the two rates.
+BETA = 8.6             # Kaiser window shape, about 80 dB stop band.
+CUTOFF = 0.9           # Pass band edge, as a fraction of the lower Nyquist frequency.
+CHUNK_SIZE = 4096      # Largest chunk, frames, unless told otherwise.
+
+
+def mix_matrix(channels_in, channels_out):
+    """
+    Channel mix, shaped (channels_in, channels_out).  Input channel i goes to output
+    channel i modulo channels_out, and each output is the mean of its inputs.  With
+    fewer inputs, output channel j takes input j modulo channels_in.
+    """
+    mix = np.zeros((channels_in, channels_out), dtype=np.float32)
+    if channels_in >= channels_out:
+        for i in range(channels_in):
+            mix[i, i % channels_out] = 1.
+        mix /= mix.sum(axis=0)
+    else:
+        for j in range(channels_out):
+            mix[j % channels_in, j] = 1.
+
+    # Done.
+    return mix
+
+
+def low_pass(num_taps, cutoff):
+    """
+    Kaiser windowed sinc low pass filter with unit gain, cutoff as a fraction of the
+    Nyquist frequency.  The same as scipy.signal.firwin(), without importing it.
+    """
+    m = np.arange(num_taps) - (num_taps - 1) / 2.
+    h = cutoff * np.sinc(cutoff * m) * np.kaiser(num_taps, BETA)
+
+    # Done.
+    return h / h.sum()
+
+
+def scale_for(dtype):
+    """
+    Offset and scale taking samples of a given type to values between -1 and 1.
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.uint8:
+        return 128., 1. / 128.
+    if dtype.kind == 'i':
+        return 0., 1. / (float(np.iinfo(dtype).max) + 1.)
+    if dtype.kind == 'f':
+        return 0., 1.
+
+    # Done.
+    raise ValueError('Unsupported sample type: %s' % dtype)
+
+#################################################
+
+
+class Converter(object):
+    """
+    Converts chunks of at most chunk_size frames at sample_rate_in with channels_in
+    channels, to samples of type dtype at sample_rate_out with channels_out channels.
+    Output rate and channels default to those of the input, so by default only the
+    format changes.  Integer output is full scale, floating point output between -1
+    and 1.
+    """
+
+    def __init__(self, sample_rate_in, channels_in, sample_rate_out=None, channels_out=None,
+                 chunk_size=None, dtype=None):
+        if not sample_rate_out:
+            sample_rate_out = sample_rate_in
+        if not channels_out:
+            channels_out = channels_in
+        if not chunk_size:
+            chunk_size = CHUNK_SIZE
+        if dtype is None:
+            dtype = np.int16
+
+        self.sample_rate_in = sample_rate_in
+        self.sample_rate_out = sample_rate_out
+        self.channels_in = channels_in
+        self.channels_out = channels_out
+        self.dtype = np.dtype(dtype)
+
+        if channels_in == channels_out:
+            self.mix = None
+        else:
+            self.mix = mix_matrix(channels_in, channels_out)
+
+        # Rate ratio, up by L and down by M.
+        g = math.gcd(int(sample_rate_in), int(sample_rate_out))
+        self.L = int(sample_rate_out) // g
+        self.M = int(sample_rate_in) // g
+        self.resample = self.L != self.M
+
+        if self.resample:
+            # Taps per phase, more when going down so the filter spans TAPS samples at
+            # the output rate.
+            self.K = TAPS * max(int(math.ceil(float(self.M) / self.L)), 1)
+
+            # An odd length puts the filter's centre on a sample, padded with a zero to
+            # fill the table.
+            N = self.K * self.L
+            N -= 1 - N % 2
+            cutoff = CUTOFF * min(1. / self.L, 1. / self.M)
+            h = low_pass(N, cutoff) * self.L
+            h = np.append(h, np.zeros(self.K * self.L - N))
+
+            # Column p of row k holds the tap applied to input sample base - k for an
+            # output sample falling on phase p.
+            self.H = h.reshape(self.K, self.L).astype(np.float32)
+            self.delay = (N - 1) // 2
+        else:
+            self.K = 1
+            self.H = None
+            self.delay = 0
+
+        # Input frames needed past an output sample, and the zeros flush() feeds in.
+        self.latency_frames = self.delay // self.L + 1
+        self.latency = float(self.latency_frames) / sample_rate_in
+
+        self.chunk_size = max(chunk_size, self.latency_frames + 1)
+        self.max_output = (self.chunk_size * self.L) // self.M + 2
+
+        # Work buffers.  The filter's input is held channel by channel, after the last
+        # K - 1 frames of the previous chunk.  Its terms and results are flat, to be
+        # viewed as (channels_out, count) arrays for each chunk's count of outputs.
+        H = self.K - 1
+        self.scaled = np.zeros((self.chunk_size, channels_in), dtype=np.float32)
+        self.mixed = np.zeros((self.chunk_size, channels_out), dtype=np.float32)
+        self.work = np.zeros((channels_out, H + self.chunk_size), dtype=np.float32)
+        self.history = np.zeros((channels_out, H), dtype=np.float32)
+        self.result = np.zeros(channels_out * self.max_output, dtype=np.float32)
+        self.term = np.zeros(channels_out * self.max_output, dtype=np.float32)
+        self.coefs = np.zeros(self.max_output, dtype=np.float32)
+        self.ramp = np.arange(self.max_output, dtype=np.int64) * self.M
+        self.index = np.zeros(self.max_output, dtype=np.int64)
+        self.phase = np.zeros(self.max_output, dtype=np.int64)
+        self.zeros = np.zeros((self.latency_frames, channels_in), dtype=np.float32)
+        self.output = np.zeros((self.max_output, channels_out), dtype=self.dtype)
+
+        self.frames_in = 0
+        self.frames_out = 0
+        self.flushed = False
+
+
+    def convert(self, data, out=None):
+        """
+        Convert a chunk shaped (num_frames, channels_in).  Writes to out if given, an
+        array of at least max_output frames, else to a buffer reused on the next call.
+        Returns the converted frames, possibly fewer than would be expected from the
+        rate ratio while the filter fills.
+        """
+        n = len(data)
+        if n > self.chunk_size:
+            raise ValueError('Chunk of %d frames, at most %d' % (n, self.chunk_size))
+        if out is None:
+            out = self.output
+
+        # Fast path, nothing to do but copy.
+        if (data.dtype == self.dtype and self.mix is None and not self.resample and
+                self.dtype.kind == 'i'):
+            out[:n] = data
+            self.frames_in += n
+            self.frames_out += n
+            return out[:n]
+
+        x = self.mixed[:n]
+
+        # Format.
+        offset, scale = scale_for(data.dtype)
+        if self.mix is None:
+            scaled = x
+        else:
+            scaled = self.scaled[:n]
+
+        np.copyto(scaled, data, casting='unsafe')
+        if offset:
+            scaled -= np.float32(offset)
+        scaled *= np.float32(scale)
+
+        # Channels.
+        if self.mix is not None:
+            np.dot(scaled, self.mix, out=x)
+
+        # Rate.
+        if self.resample:
+            H = self.K - 1
+            self.work[:, :H] = self.history
+            np.copyto(self.work[:, H:H + n], x.T)
+
+            y = self.filter(n)
+            self.history[:] = self.work[:, n:n + H]
+        else:
+            y = x
+
+        self.frames_in += n
+
+        # Done.
+        return self.store(y, out)
+
+
+    def filter(self, n):
+        """
+        Output samples computable from the work buffer holding n new frames.
+        """
+        H = self.K - 1
+        L, M = self.L, self.M
+
+        # Each output sample's filter centre, in steps of 1 / L input frames from the
+        # start of the work buffer, where the H frames kept from before come first.
+        start = self.frames_out * M + self.delay - (self.frames_in - H) * L
+        last = H + n - 1
+        count = max((last * L + L - 1 - start) // M + 1, 0)
+        if self.flushed:
+            count = min(count, self.frames_expected() - self.frames_out)
+
+        index = self.index[:count]
+        phase = self.phase[:count]
+        np.add(self.ramp[:count], start, out=index)
+        np.remainder(index, L, out=phase)
+        np.floor_divide(index, L, out=index)
+
+        # Every operation runs over contiguous memory, so needs no temporary arrays.
+        shape = (self.channels_out, count)
+        coefs = self.coefs[:count]
+        term = self.term[:self.channels_out * count].reshape(shape)
+        result = self.result[:self.channels_out * count].reshape(shape)
+        result[:] = 0.
+        for k in range(self.K):
+            np.take(self.H[k], phase, out=coefs, mode='clip')
+            np.take(self.work, index, axis=1, out=term, mode='clip')
+            for row in term:
+                row *= coefs
+            result += term
+            index -= 1
+
+        # Done.
+        return result.T
+
+
+    def store(self, y, out):
+        """
+        Write converted values to out in the output format.
+        """
+        count = len(y)
+        if self.dtype.kind in 'iu':
+            offset, scale = scale_for(self.dtype)
+            info = np.iinfo(self.dtype)
+            y *= np.float32(1. / scale)
+            if offset:
+                y += np.float32(offset)
+            np.rint(y, out=y)
+            np.clip(y, info.min, info.max, out=y)
+
+        np.copyto(out[:count], y, casting='unsafe')
+        self.frames_out += count
+
+        # Done.
+        return out[:count]
+
+
+    def frames_expected(self):
+        """
+        Output frames for all the input so far.
+        """
+        return -(-self.frames_in * self.L // self.M)
+
+
+    def flush(self, out=None):
+        """
+        Last of the output, once all the input has been converted, or None if there is
+        none left.
+        """
+        if self.flushed or not self.resample:
+            return None
+
+        self.flushed = True
+        frames_in = self.frames_in
+
+        # Zeros past the end, not counted as input.
+        y = self.convert(self.zeros, out)
+        self.frames_in = frames_in
+        if not len(y):
+            return None
+
+        # Done.
+        return y
+
+
+def convert(data, sample_rate_in, sample_rate_out=None, channels_out=None, dtype=None,
+            chunk_size=None):
+    """
+    Convert a whole array of samples shaped (num_frames, num_channels), chunk by chunk.
+    Returns the samples shaped (num_frames_out, channels_out).
+    """
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+
+    converter = Converter(sample_rate_in, data.shape[1], sample_rate_out, channels_out,
+                          chunk_size, dtype)
+
+    num_out = -(-len(data) * converter.L // converter.M)
+    result = np.zeros((num_out + converter.max_output, converter.channels_out),
+                      dtype=converter.dtype)
+
+    k = 0
+    for k0 in range(0, len(data), converter.chunk_size):
+        y = converter.convert(data[k0:k0 + converter.chunk_size], result[k:])
+        k += len(y)
+
+    y = converter.flush(result[k:])
+    if y is not None:
+        k += len(y)
+
+    # Done.
+    return result[:k]
@@ -10,15 +10,16 @@ import os
 import time
 import sys
 import threading
+import collections
 
 import numpy as np
 import scipy as sp
 import scipy.stats
 
-path_adafruit = '../Adafruit-Raspberry-Pi-Python-Code/Adafruit_PWM_Servo_Driver'
-sys.path.append(os.path.abspath(path_adafruit))
-
-import Adafruit_PWM_Servo_Driver
+import clock
+import metrics
+import pca9685
+import profiles
 
 ###############################################
 
@@ -37,20 +38,24 @@ class Response(object):
         """
         self.scale = scale
 
-        self.t_set = time.time()
+        self.t_set = clock.time()
         self.y_set = y_set
         self.y_ref = y_set
         self.y_now = y_set
 
 
-    def force(self, y):
+    def force(self, y, t=None):
         """
-        Set new system input value y.
+        Set new system input value y.  Optionally supply the time at which the new
+        value was requested.
         """
-        self.y_ref = self.output()
+        if t is None:
+            t = clock.time()
+
+        self.y_ref = self.output(t)
         self.y_set = y
 
-        self.t_set = time.time()
+        self.t_set = t
 
 
     def output(self, t=None):
@@ -59,8 +64,8 @@ class Response(object):
         """
 
         # Use supplied time?
-        if not t:
-            t = time.time()
+        if t is None:
+            t = clock.time()
 
         dt = t - self.t_set
         frac = 1. - np.exp(-dt/self.scale)
@@ -71,17 +76,287 @@ class Response(object):
         # Done.
         return y
 
+
+    def time_move(self, y, eps):
+        """
+        Return the time at which the output will first differ from value y by more
+        than eps.  Return None if the output will settle within eps of y.
+        """
+        if abs(self.y_set - y) <= eps:
+            return None
+
+        if self.y_set == self.y_ref:
+            return self.t_set
+
+        # Solve y_set - (y_set - y_ref)*exp(-dt/scale) = y +/- eps for dt.
+        y_cross = y + eps*np.sign(self.y_set - y)
+        ratio = (self.y_set - y_cross) / (self.y_set - self.y_ref)
+
+        if not (0. < ratio < 1.):
+            return self.t_set
+
+        # Done.
+        return self.t_set - self.scale*np.log(ratio)
+
+
+
+class CriticalResponse(Response):
+    """
+    Critically damped second order response function.  Velocity stays continuous when
+    the input changes, so no extra smoothing is needed on top.
+    """
+    def __init__(self, scale, y_set=0.):
+        Response.__init__(self, scale, y_set)
+
+        self.v_ref = 0.
+        self.v_now = 0.
+
+
+    def force(self, y, t=None):
+        """
+        Set new system input value y.  Optionally supply the time at which the new
+        value was requested.
+        """
+        if t is None:
+            t = clock.time()
+
+        self.y_ref, self.v_ref = profiles.critical(t, self.t_set, self.y_ref, self.v_ref,
+                                                   self.y_set, self.scale)
+        self.y_set = y
+
+        self.t_set = t
+
+
+    def output(self, t=None):
+        """
+        Return output response.
+        """
+        if t is None:
+            t = clock.time()
+
+        y, v = profiles.critical(t, self.t_set, self.y_ref, self.v_ref, self.y_set, self.scale)
+        self.y_now = y
+        self.v_now = v
+
+        # Done.
+        return y
+
+
+    def time_move(self, y, eps):
+        """
+        Return None once the output has settled within eps of both y and the input value.
+        Otherwise the output is still moving, so return the time of the last input change.
+        """
+        settled = (abs(self.y_set - y) <= eps and abs(self.y_now - y) <= eps and
+                   abs(self.v_now)*self.scale <= eps)
+        if settled:
+            return None
+
+        # Done.
+        return self.t_set
+
+
+def trapezoid_limits(scale, vmax=None, amax=None):
+    """
+    Velocity and acceleration limits for a trapezoid move.  Limits not given follow from
+    scale, such that a move across the full range from rest takes scale seconds.
+    """
+    if not vmax:
+        vmax = 1.25/scale
+    if not amax:
+        amax = 6.25/scale**2
+
+    # Done.
+    return vmax, amax
+
+
+class TrapezoidResponse(Response):
+    """
+    Velocity and acceleration limited response function.  Moves follow a trapezoidal
+    velocity profile and stop exactly on the input value.
+
+    When limits are not given they follow from scale, such that a move across the full
+    range from rest takes scale seconds.
+    """
+    def __init__(self, scale, y_set=0., vmax=None, amax=None):
+        Response.__init__(self, scale, y_set)
+
+        self.vmax = vmax
+        self.amax = amax
+
+        self.v_now = 0.
+        self.plan = profiles.plan_trapezoid(self.t_set, y_set, 0., y_set, *self.limits())
+
+
+    def limits(self):
+        """
+        Velocity and acceleration limits.
+        """
+        return trapezoid_limits(self.scale, self.vmax, self.amax)
+
+
+    def force(self, y, t=None):
+        """
+        Set new system input value y and plan a move from the current state.
+        """
+        if t is None:
+            t = clock.time()
+
+        y_ref, v_ref = profiles.trapezoid(t, *self.plan)
+        self.plan = profiles.plan_trapezoid(t, float(y_ref), float(v_ref), y, *self.limits())
+
+        self.y_ref = float(y_ref)
+        self.y_set = y
+        self.t_set = t
+
+
+    def output(self, t=None):
+        """
+        Return output response.
+        """
+        if t is None:
+            t = clock.time()
+
+        y, v = profiles.trapezoid(t, *self.plan)
+        self.y_now = float(y)
+        self.v_now = float(v)
+
+        # Done.
+        return self.y_now
+
+
+    def time_move(self, y, eps):
+        """
+        Return None once the planned move is complete and y is within eps of the input
+        value.  Otherwise return the time of the last input change.
+        """
+        if self.v_now == 0. and abs(self.y_set - y) <= eps:
+            return None
+
+        # Done.
+        return self.t_set
+
+#################################################
+
+# Response models offered by ServoBank.
+MODELS = ['first_order', 'critical', 'trapezoid']
+
+
+def settle_time(model, scale, frac=None):
+    """
+    Time for a move across the full range from rest to come within frac of its
+    target, default 5%, under one of the MODELS with time scale scale.  Settle time is
+    proportional to scale, so settle_time(model, 1.) converts settle times to scales.
+    """
+    if frac is None:
+        frac = 0.05
+
+    if model == 'first_order':
+        return -scale*np.log(frac)
+
+    if model == 'critical':
+        # Solve (1 + x) exp(-x) = frac for x = t/scale, by Newton's method.
+        x = 1. - np.log(frac)
+        for k in range(20):
+            x += ((1. + x)*np.exp(-x) - frac) / (x*np.exp(-x))
+        return x*scale
+
+    if model == 'trapezoid':
+        # Stops exactly on target, scale seconds after setting off.
+        return scale
+
+    # Done.
+    raise ValueError('Invalid response model: %s' % model)
+
+# Servo command record: target width, response time scale, time of request and pulse
+# sequence number.  Each pulse posts the next sequence number, so pulses at the same
+# instant stay distinct, while a change of scale alone keeps the number it replaces.
+Target = collections.namedtuple('Target', ['value', 'scale', 'time', 'seq'])
+
+
+class Mailbox(object):
+    """
+    Single writer, single reader mailbox holding the most recent Target.  Targets are
+    immutable and posting one is a single reference assignment, so neither side needs a
+    lock.  The reader detects new posts by identity, and new pulses by sequence number.
+    """
+
+    def __init__(self, target):
+        self.target = target
+
+
+    def post(self, target):
+        self.target = target
+
+
+    def read(self):
+        return self.target
+
+
+def resync(time_next, period):
+    """
+    Time the tick due at time_next is treated as due, once woken for it.  Ticks stay on
+    fixed deadlines spaced period apart, so late wakeups do not add up to drift.  Start
+    over from now only when more than a whole period behind, e.g. after sleeping while
+    settled.  A tick woken early by a new command leaves the one at time_next due.
+    """
+    time_now = clock.time()
+    if time_now - time_next > period:
+        return time_now
+    if time_now < time_next:
+        return time_next - period
+
+    # Done.
+    return time_next
+
 #################################################
 
 
+def counts_table(vmin, vmax, sign=1, curve=None):
+    """
+    Build lookup table of digital counts indexed by quantized pulse width.  The table has
+    one entry per count between vmin and vmax so no resolution is lost.
+
+    The optional calibration curve maps width to fractional position between vmin and
+    vmax.  It is either a function accepting an array of widths, or a sequence of
+    (width, fraction) knots that are interpolated linearly.
+    """
+    num = int(abs(vmax - vmin)) + 1
+
+    width = np.linspace(0., 1., num)
+    if sign < 0:
+        width = 1. - width
+
+    if curve is None:
+        frac = width
+    elif callable(curve):
+        frac = curve(width)
+    else:
+        knots = np.asarray(curve, dtype=float)
+        frac = np.interp(width, knots[:, 0], knots[:, 1])
+
+    counts = np.round(vmin + frac * (vmax - vmin))
+
+    # Done.
+    return counts.astype(np.uint16)
+
+
 class Servo(object):
     """
     Servo controller based on Adafruit support library for PWM board PCA9685.
     """
 
-    def __init__(self, channel, info=None, sign=None, vmin=None, vmax=None):
+    def __init__(self, channel, info=None, sign=None, vmin=None, vmax=None, writer=None,
+                 curve=None, address=None):
         """
         Create an instance of a servo controller.
+
+        By default pulses are sent straight away to the shared board at the given I2C
+        address, see pca9685.get_board().  Alternatively supply a pca9685.BurstWriter;
+        pulses are then queued on the writer and sent when it is flushed.
+
+        Optional calibration curve is passed to counts_table().  It defaults to the
+        info dict's 'curve' entry, if any.
         """
 
         #if info:
@@ -106,22 +381,34 @@ class Servo(object):
                 sign = info['sign']
             else:
                 sign = 1
+        if curve is None:
+            if info:
+                curve = info.get('curve')
 
         self.channel = channel
         self.period = 20. # milliseconds
         self.vmin = vmin
         self.vmax = vmax
         self.sign = sign
+        self.curve = curve
+
+        self.table = counts_table(vmin, vmax, sign, curve)
+        self.table_max = len(self.table) - 1
 
         self.start_stop = (0, 0)
+        self.writer = writer
+        self.autoflush = False
 
-        self.pwm = Adafruit_PWM_Servo_Driver.PWM()
+        self.metrics = metrics.LoopMetrics('servo.%d' % channel,
+                                           counters=['writes', 'suppressed_dedupe',
+                                                     'suppressed_deadband', 'invalid'])
 
-        freq = 1000. / self.period  # Hz
-        self.pwm.setPWMFreq(freq)
+        if not writer:
+            freq = 1000. / self.period  # Hz
+            self.writer = pca9685.get_board(address, freq=freq).writer
+            self.autoflush = True
 
 
-    #@memoize
     def width_to_counts(self, width):
         """
         Convert pulse width from miliseconds to digital counts.
@@ -130,18 +417,25 @@ class Servo(object):
         if not (0. <= width <= 1.0):
             raise ValueError('Invalid width: %s' % width)
 
-        if self.sign < 0:
-            width = 1. - width
+        DN_start = 0
+        DN_stop = int(self.table[int(width * self.table_max + 0.5)])
+
+        # Done.
+        return DN_start, DN_stop
 
-        gain = (self.vmax - self.vmin)
 
-        DN_start = 0
-        DN_stop = self.vmin + width * gain
+    def widths_to_counts(self, width):
+        """
+        Vectorized conversion of an array of pulse widths to an array of stop counts.
+        """
+        width = np.asarray(width)
+        if np.any((width < 0.) | (width > 1.)):
+            raise ValueError('Invalid width: %s' % width[(width < 0.) | (width > 1.)])
 
-        DN_stop = int(np.round(DN_stop))
+        ix = np.rint(width * self.table_max).astype(np.intp)
 
         # Done.
-        return DN_start, DN_stop
+        return self.table[ix]
 
 
     def pulse(self, width):
@@ -150,11 +444,20 @@ class Servo(object):
         width is a fractional value between 0 and 1.  It indicates the relative pulse width
         between the system minimum value and the system maximum value.
         """
-        DN_start, DN_stop = self.width_to_counts(width)
+        try:
+            DN_start, DN_stop = self.width_to_counts(width)
+        except ValueError:
+            self.metrics.count('invalid')
+            raise
 
         if not self.start_stop == (DN_start, DN_stop):
             self.start_stop = (DN_start, DN_stop)
-            self.pwm.setPWM(self.channel, DN_start, DN_stop)
+            self.writer.set(self.channel, DN_start, DN_stop)
+            self.metrics.count('writes')
+            if self.autoflush:
+                self.writer.flush()
+        else:
+            self.metrics.count('suppressed_dedupe')
 
         # Done.
         return DN_start, DN_stop
@@ -164,32 +467,58 @@ class Servo(object):
 
 class DampedServo(Servo, threading.Thread):
     """
-    Servo controller with first order response function.
-    Controller lives in a background thread.
+    Servo controller with first order response function, or one of the other response
+    models.  Controller lives in a background thread.
     """
 
-    def __init__(self, channel, info, scale, sign=None, alpha=None, vmin=None, vmax=None):
+    def __init__(self, channel, info, scale, sign=None, alpha=None, vmin=None, vmax=None,
+                 spin=False, writer=None, curve=None, address=None, model=None):
         """
         Create a new instance of a damped servo controller.
+
+        The response model defaults to the first order Response class.  Alternatives are
+        CriticalResponse and TrapezoidResponse.  The extra exponential smoothing set by
+        alpha is only applied by default to the first order model.
+
+        By default the run loop ticks on absolute deadlines at the update frequency and
+        sleeps whenever the response is settled.  Set spin=True to instead update the
+        servo as fast as possible.
+
+        Servos on the same board share a writer and have their pending updates flushed
+        together at the end of whichever servo's tick comes first.
         """
-        Servo.__init__(self, channel, info, sign=sign, vmin=vmin, vmax=vmax)
+        Servo.__init__(self, channel, info, sign=sign, vmin=vmin, vmax=vmax, writer=writer,
+                       curve=curve, address=address)
+        self.autoflush = False
         threading.Thread.__init__(self)
 
+        if not model:
+            model = Response
         if alpha is None:
-            alpha = 0.05
+            if model is Response:
+                alpha = 0.05
+            else:
+                alpha = 1.
 
-        self.response = Response(scale)
+        self.response = model(scale)
         self.freq = 70.  # Hz.
         self.alpha = alpha
+        self.eps = 0.01
+        self.spin = spin
 
-        self.lock = threading.Lock()
+        # Measured when the run loop exits.
+        self.ticks = 0
+        self.tick_rate = None
+
+        self.mailbox = Mailbox(Target(0., scale, self.response.t_set, 0))
+        self.wake = clock.Event()
 
 
     def __del__(self):
         """
         Cleanup when this object is deleted.
         """
-        if self.isAlive():
+        if self.is_alive():
             print('DampedServo __del__')
             self.keep_running = False
             self.join()
@@ -205,30 +534,43 @@ class DampedServo(Servo, threading.Thread):
 
     @property
     def scale(self):
-        return self.response.scale
+        return self.mailbox.read().scale
 
 
     @scale.setter
     def scale(self, value):
-        self.response.scale = value
+        target = self.mailbox.read()
+        self.mailbox.post(target._replace(scale=value))
 
 
     def run(self):
         """
         This is where the work happens.
         """
-        self.keep_running = True
         time_wait = 1./self.freq
 
-        time_A = time.time()
+        time_A = clock.time()
+        time_next = time_A
         cnt = 0
         width = self.response.output()
 
-        eps = 0.01
+        eps = self.eps
+        target_old = None
+        deadline = None
         while self.keep_running:
 
             cnt += 1
-            self.lock.acquire()
+            self.metrics.tick(clock.time(), deadline)
+
+            # Pick up new commands.  A new sequence number means a new pulse, otherwise
+            # only the scale has changed.
+            target = self.mailbox.read()
+            if target is not target_old:
+                self.response.scale = target.scale
+                if not target_old or target.seq != target_old.seq:
+                    self.response.force(target.value, target.time)
+                target_old = target
+
             width_old = width
             width_new = self.response.output()
 
@@ -237,36 +579,607 @@ class DampedServo(Servo, threading.Thread):
                 if 0 <= width <= 1.:
                     super(DampedServo, self).pulse(width)
                 else:
+                    self.metrics.count('invalid')
                     print('warning, invalid width: %.1f' % (width))
+            else:
+                self.metrics.count('suppressed_deadband')
+
+            self.writer.flush()
+
+            if self.spin:
+                continue
+
+            # Next tick is due at the later of the regular deadline and the time the
+            # response next moves by more than eps.
+            time_move = self.response.time_move(width, eps)
+
+            time_next += time_wait
+            time_now = clock.time()
+            if time_move is None:
+                deadline = None
+                timeout = None
+            else:
+                deadline = max(time_next, time_move)
+                timeout = deadline - time_now
+
+            if timeout is None or timeout > 0:
+                self.wake.wait(timeout)
+                self.wake.clear()
 
-            self.lock.release()
-            #if self.scale > 1.0:
-            #    time.sleep(time_wait)
+            time_next = resync(time_next, time_wait)
 
 
         # Loop finished.
-        time_B = time.time()
+        time_B = clock.time()
         dt = time_B - time_A
-        freq = cnt / dt
+        freq = cnt / max(dt, 1.e-6)
+        self.ticks = cnt
+        self.tick_rate = freq
 
         print('Servo run loop exit: %d [%.1f Hz]' % (self.channel, freq))
 
+        clock.detach()
+
         # Done.
 
 
+    def start(self):
+        # Set here rather than in run(), so a stop() straight after start() is not lost.
+        self.keep_running = True
+        clock.attach()
+        threading.Thread.start(self)
+
+
     def stop(self):
-        if self.isAlive():
+        if self.is_alive():
             self.keep_running = False
+            self.wake.set()
             print('Servo stopping: %d' % self.channel)
 
 
+    def pulse(self, width):
+        """
+        Set new input value for servo.  Never blocks.  Call pulse() and set scale from
+        a single thread.
+        """
+        target = self.mailbox.read()
+        self.mailbox.post(Target(width, target.scale, clock.time(), target.seq + 1))
+
+        self.wake.set()
+
+#################################################
+
+
+class BankServo(object):
+    """
+    Lightweight view onto a single channel of a ServoBank.
+    Offers the same pulse() and scale interface as DampedServo.
+    """
+
+    def __init__(self, bank, index):
+        self.bank = bank
+        self.index = index
+
+
+    @property
+    def channel(self):
+        return int(self.bank.channel[self.index])
+
+
+    @property
+    def scale(self):
+        return self.bank.mailboxes[self.index].read().scale
+
+
+    @scale.setter
+    def scale(self, value):
+        mailbox = self.bank.mailboxes[self.index]
+        mailbox.post(mailbox.read()._replace(scale=value))
+
+
+    @property
+    def alpha(self):
+        return float(self.bank.alpha[self.index])
+
+
+    @alpha.setter
+    def alpha(self, value):
+        self.bank.alpha[self.index] = value
+
+
+    @property
+    def target(self):
+        return self.bank.mailboxes[self.index].read().value
+
+
     def pulse(self, width):
         """
         Set new input value for servo.
         """
-        self.lock.acquire()
-        self.response.force(width)
-        self.lock.release()
+        self.bank.force(self.index, width)
+
+
+class ServoBank(threading.Thread):
+    """
+    Drive many servos with damped response from a single background thread.
+    State for every channel is stored in NumPy arrays so that each tick evaluates all
+    responses, smoothing, deadbands and count conversions in one vectorized step.
+
+    Only the ticking thread touches the channel arrays, so a tick takes no lock.  Other
+    threads talk to it through the per-channel mailboxes alone.  Call add() and hold()
+    before start(), from the thread that ticks the bank, or between pause() and
+    resume().
+    """
+
+    def __init__(self, freq=None, eps=None, writer=None, address=None, model=None):
+        """
+        Create a new, empty servo bank.  Add servos with the add() method.
+        Channel updates are written through a pca9685.BurstWriter, one flush per tick.
+        If no writer is given the bank uses the shared board at the given I2C address
+        once it starts.
+
+        Response model is 'first_order' (default), 'critical' or 'trapezoid', see the
+        profiles module.
+        """
+        threading.Thread.__init__(self)
+
+        if not freq:
+            freq = 70.  # Hz.
+        if eps is None:
+            eps = 0.01
+        if not model:
+            model = 'first_order'
+        if model not in MODELS:
+            raise ValueError('Invalid response model: %s' % model)
+
+        self.freq = freq
+        self.eps = eps
+        self.model = model
+        self.period = 20. # milliseconds
+
+        self.wake = clock.Event()
+        self.keep_running = False
+
+        # Set by pause(), and acknowledged by the run loop once it stops ticking.
+        self.paused = False
+        self.parked = clock.Event()
+
+        # Measured when the run loop exits.
+        self.ticks = 0
+        self.tick_rate = None
+
+        self.address = address
+        self.writer = writer
+        self.servos = []
+
+        self.metrics = metrics.BankMetrics('bank')
+
+        # Commands from BankServo views, one mailbox per channel.
+        self.mailboxes = []
+        self.targets = []
+
+        self.channel = np.zeros(0, dtype=np.int32)
+        self.vmin = np.zeros(0)
+        self.vmax = np.zeros(0)
+        self.sign = np.zeros(0, dtype=np.int32)
+
+        # Per-channel count tables concatenated into one array.
+        self.table = np.zeros(0, dtype=np.uint16)
+        self.table_offset = np.zeros(0, dtype=np.intp)
+        self.table_max = np.zeros(0, dtype=np.intp)
+
+        self.scale = np.zeros(0)
+        self.alpha = np.zeros(0)
+        self.t_set = np.zeros(0)
+        self.y_set = np.zeros(0)
+        self.y_ref = np.zeros(0)
+        self.y_now = np.zeros(0)
+        self.v_ref = np.zeros(0)
+        self.v_now = np.zeros(0)
+        self.width = np.zeros(0)
+        self.counts = np.zeros(0, dtype=np.int32)
+
+        # Trapezoid move plans, one row of segments per channel.
+        shape = (0, profiles.NUM_SEGMENTS)
+        self.plan = (np.zeros(shape), np.zeros(shape), np.zeros(shape), np.zeros(shape))
+
+
+    def add(self, channel, info, scale, sign=None, alpha=None, vmin=None, vmax=None,
+            curve=None):
+        """
+        Add a new servo channel to the bank.  Arguments have the same meaning as for
+        DampedServo.  Returns a BankServo view for controlling the new channel.  Not
+        while another thread is ticking the bank, see pause().
+        """
+        if not vmin:
+            if info:
+                vmin = info['vmin']
+            else:
+                vmin = 200
+        if not vmax:
+            if info:
+                vmax = info['vmax']
+            else:
+                vmax = 450
+        if not sign:
+            if info:
+                sign = info['sign']
+            else:
+                sign = 1
+        if alpha is None:
+            if self.model == 'first_order':
+                alpha = 0.05
+            else:
+                alpha = 1.
+        if curve is None:
+            if info:
+                curve = info.get('curve')
+
+        table = counts_table(vmin, vmax, sign, curve)
+
+        if channel in self.channel:
+            raise ValueError('Channel already in use: %d' % channel)
+
+        self.channel = np.append(self.channel, channel).astype(np.int32)
+        self.vmin = np.append(self.vmin, vmin)
+        self.vmax = np.append(self.vmax, vmax)
+        self.sign = np.append(self.sign, sign).astype(np.int32)
+
+        self.table_offset = np.append(self.table_offset, len(self.table)).astype(np.intp)
+        self.table_max = np.append(self.table_max, len(table) - 1).astype(np.intp)
+        self.table = np.append(self.table, table)
+
+        self.scale = np.append(self.scale, scale)
+        self.alpha = np.append(self.alpha, alpha)
+        self.t_set = np.append(self.t_set, clock.time())
+        self.y_set = np.append(self.y_set, 0.)
+        self.y_ref = np.append(self.y_ref, 0.)
+        self.y_now = np.append(self.y_now, 0.)
+        self.v_ref = np.append(self.v_ref, 0.)
+        self.v_now = np.append(self.v_now, 0.)
+        self.width = np.append(self.width, 0.)
+        self.counts = np.append(self.counts, 0).astype(np.int32)
+
+        plan = profiles.plan_trapezoid(self.t_set[-1], 0., 0., 0., *trapezoid_limits(scale))
+        self.plan = tuple(np.append(a, [b], axis=0) for a, b in zip(self.plan, plan))
+
+        target = Target(0., scale, self.t_set[-1], 0)
+        self.mailboxes.append(Mailbox(target))
+        self.targets.append(target)
+
+        servo = BankServo(self, len(self.servos))
+        self.servos.append(servo)
+
+        self.metrics.add_channel(channel)
+
+        # Done.
+        return servo
+
+
+    def __len__(self):
+        return len(self.servos)
+
+
+    def __getitem__(self, index):
+        return self.servos[index]
+
+
+    def width_to_counts(self, width):
+        """
+        Convert array of pulse widths, one per channel, to digital counts.
+        Widths must already be within range 0 to 1.
+        """
+        ix = self.table_offset + np.rint(width * self.table_max).astype(np.intp)
+
+        # Done.
+        return self.table[ix]
+
+
+    def output(self, t=None):
+        """
+        Evaluate response function for all channels.
+        """
+        if t is None:
+            t = clock.time()
+
+        if self.model == 'critical':
+            y, v = profiles.critical(t, self.t_set, self.y_ref, self.v_ref, self.y_set, self.scale)
+            self.v_now[:] = v
+        elif self.model == 'trapezoid':
+            y, v = profiles.trapezoid(t, *self.plan)
+            self.v_now[:] = v
+        else:
+            y = profiles.first_order(t, self.t_set, self.y_ref, self.y_set, self.scale)
+
+        self.y_now[:] = y
+
+        # Done.
+        return y
+
+
+    def force(self, index, y, t=None):
+        """
+        Set new system input value y for the servo at the specified index.  Never blocks;
+        the new value is picked up at the start of the next tick.
+        """
+        if t is None:
+            t = clock.time()
+
+        target = self.mailboxes[index].read()
+        self.mailboxes[index].post(Target(y, target.scale, t, target.seq + 1))
+
+        self.wake.set()
+
+
+    def hold(self, widths, t=None):
+        """
+        Place every channel at rest at the given widths, without moving through the
+        positions in between.  Assumes the servos are already physically there.  Call
+        from the same thread that sends pulses, and not while another thread is ticking
+        the bank, see pause().
+        """
+        if t is None:
+            t = clock.time()
+
+        widths = np.asarray(widths, dtype=float)
+        self.y_set[:] = widths
+        self.y_ref[:] = widths
+        self.y_now[:] = widths
+        self.width[:] = widths
+        self.v_ref[:] = 0.
+        self.v_now[:] = 0.
+        self.t_set[:] = t
+        self.counts[:] = self.width_to_counts(widths)
+
+        # Plans of a single segment at rest.
+        starts, ys, vs, accs = self.plan
+        starts[:] = t
+        ys[:] = widths[:, np.newaxis]
+        vs[:] = 0.
+        accs[:] = 0.
+
+        # A hold is not a pulse, so keeps the sequence number, leaving the next one to
+        # whoever sends pulses.  Otherwise a driver's hold would take the number of the
+        # controller's next pulse, which would then be lost.
+        for index, mailbox in enumerate(self.mailboxes):
+            target = mailbox.read()._replace(value=widths[index], time=t)
+            mailbox.post(target)
+            self.targets[index] = target
+
+
+    def receive(self):
+        """
+        Apply commands posted to the mailboxes since the last tick.
+        """
+        for index, mailbox in enumerate(self.mailboxes):
+            target = mailbox.read()
+            target_old = self.targets[index]
+            if target is target_old:
+                continue
+
+            self.scale[index] = target.scale
+            if target.seq != target_old.seq:
+                t = target.time
+                args = (t, self.t_set[index], self.y_ref[index])
+                if self.model == 'critical':
+                    y, v = profiles.critical(*args + (self.v_ref[index], self.y_set[index],
+                                                      self.scale[index]))
+                    self.v_ref[index] = v
+                elif self.model == 'trapezoid':
+                    y, v = profiles.trapezoid(t, *[a[index] for a in self.plan])
+                    y, v = float(y), float(v)
+                    plan = profiles.plan_trapezoid(t, y, v, target.value,
+                                                   *trapezoid_limits(self.scale[index]))
+                    for a, b in zip(self.plan, plan):
+                        a[index] = b
+                    self.v_ref[index] = v
+                else:
+                    y = profiles.first_order(*args + (self.y_set[index], self.scale[index]))
+
+                self.y_ref[index] = y
+                self.y_set[index] = target.value
+                self.t_set[index] = t
+
+            self.targets[index] = target
+
+
+    def time_move(self):
+        """
+        Return the earliest time at which any channel's response will differ from its
+        current width by more than eps.  Return None if every channel is settled.
+        """
+        # Any channel whose output is already more than eps from its width, as when
+        # moving, is due straight away.
+        if (np.abs(self.y_now - self.width) > self.eps).any():
+            return self.t_set.min()
+
+        dy = self.y_set - self.width
+        active = np.abs(dy) > self.eps
+
+        if self.model in ['critical', 'trapezoid']:
+            active |= np.abs(self.y_now - self.width) > self.eps
+            active |= np.abs(self.v_now)*self.scale > self.eps
+            if not active.any():
+                return None
+
+            return self.t_set[active].min()
+
+        if not active.any():
+            return None
+
+        y_cross = self.width + self.eps*np.sign(dy)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = (self.y_set - y_cross) / (self.y_set - self.y_ref)
+            t = self.t_set - self.scale*np.log(ratio)
+
+        t = np.where((0. < ratio) & (ratio < 1.), t, self.t_set)
+
+        # Done.
+        return t[active].min()
+
+
+    def step(self, t=None):
+        """
+        Advance all channels by one tick.  Returns indices of channels that were
+        sent new pulse widths.
+        """
+        self.receive()
+
+        width_new = self.output(t)
+        width_old = self.width
+
+        dy = width_new - width_old
+        move = np.abs(dy) > self.eps
+        width = width_old + self.alpha * dy
+
+        invalid = None
+        if width.min() < 0. or width.max() > 1.:
+            invalid = move & ((width < 0.) | (width > 1.))
+            for ix in np.flatnonzero(invalid):
+                print('warning, invalid width: %.1f' % (width[ix]))
+            move &= ~invalid
+
+        self.width = np.where(move, width, width_old)
+
+        counts = self.width_to_counts(self.width)
+        writes = move & (counts != self.counts)
+        ix_write = writes.nonzero()[0]
+        np.copyto(self.counts, counts, where=writes)
+
+        self.metrics.count_channels(writes, move, invalid)
+
+        for channel, count in zip(self.channel[ix_write].tolist(), counts[ix_write].tolist()):
+            self.writer.set(channel, 0, count)
+
+        if len(ix_write):
+            self.writer.flush()
+
+        # Done.
+        return ix_write
+
+
+    def run(self):
+        """
+        This is where the work happens.  Tick all channels on absolute deadlines spaced
+        at the bank's update frequency, sleeping while every channel is settled.
+        """
+        self.open()
+
+        time_A = clock.time()
+        time_next = time_A
+        cnt = 0
+        deadline = None
+        while self.keep_running:
+            if self.paused:
+                self.parked.set()
+                self.wake.wait()
+                self.wake.clear()
+
+                time_next = clock.time()
+                deadline = None
+                continue
+
+            cnt += 1
+            self.metrics.tick(clock.time(), deadline)
+            self.step()
+
+            time_next, deadline = self.schedule(time_next)
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = deadline - clock.time()
+
+            if timeout is None or timeout > 0:
+                self.wake.wait(timeout)
+                self.wake.clear()
+
+            time_next = resync(time_next, 1./self.freq)
+
+        self.loop_exit(time_A, cnt)
+
+        clock.detach()
+
+        # Done.
+
+
+    def open(self):
+        """
+        Make sure there is a writer, using the shared board if none was given.
+        """
+        if not self.writer:
+            freq = 1000. / self.period  # Hz
+            self.writer = pca9685.get_board(self.address, freq=freq).writer
+
+
+    def schedule(self, time_next):
+        """
+        Work out when the tick after the one due at time_next should happen.  Returns the
+        next regular deadline, and the time the next tick is due, which is None when
+        every channel is settled.
+        """
+        time_move = self.time_move()
+
+        time_next += 1./self.freq
+        if time_move is None:
+            deadline = None
+        else:
+            deadline = max(time_next, time_move)
+
+        # Done.
+        return time_next, deadline
+
+
+    def loop_exit(self, time_A, cnt):
+        """
+        Record tick rate for a run loop started at time_A that has finished cnt ticks.
+        """
+        dt = clock.time() - time_A
+        freq = cnt / max(dt, 1.e-6)
+        self.ticks = cnt
+        self.tick_rate = freq
+
+        print('Servo bank run loop exit: %d channels [%.1f Hz]' % (len(self), freq))
+
+
+    def start(self):
+        # Set here rather than in run(), so a stop() straight after start() is not lost.
+        self.keep_running = True
+        clock.attach()
+        threading.Thread.start(self)
+
+
+    def pause(self):
+        """
+        Stop ticking until resume(), e.g. while something else writes to the board.
+        Returns once the run loop is idle, so the caller may then use the writer and
+        call hold().
+        """
+        if not self.keep_running:
+            return
+
+        self.paused = True
+        self.wake.set()
+        self.parked.wait()
+
+
+    def resume(self):
+        """
+        Start ticking again after pause().
+        """
+        self.paused = False
+        self.parked.clear()
+        self.wake.set()
+
+
+    def stop(self):
+        """
+        Stop the run loop, whether it runs in this bank's own thread or on an
+        engine.Engine.
+        """
+        if self.keep_running:
+            self.keep_running = False
+            self.wake.set()
+            print('Servo bank stopping: %d channels' % len(self))
 
 #################################################
 
@@ -301,7 +1214,7 @@ if __name__ == '__main__':
     while flag:
         try:
             dt = np.random.uniform(0.05, 0.5)
-            time.sleep(dt)
+            clock.sleep(dt)
 
             val = np.random.uniform(0., 1.)
 
@@ -0,0 +1,544 @@
+"""
+Streaming audio decoders for beats.Player.
+
+A decoder reads a song a chunk at a time as (num_frames, num_channels) sample arrays,
+so a song of any length plays in the same small amount of memory and starts at once.
+WAV files are read by WavDecoder.  Compressed songs, FLAC, OGG, MP3 and so on, are
+decoded by whatever is installed:
+
+  - SoundFileDecoder: the soundfile package, libsndfile.  FLAC and OGG, and MP3 with
+    libsndfile 1.1 or later.
+  - CommandDecoder: a command line decoder writing WAV to a pipe.  ffmpeg for any
+    format, or flac, oggdec or mpg123 for their own.
+
+open_song() picks one.  A Prefetcher runs a decoder in a background thread, keeping a
+bounded queue of decoded chunks ahead of playback, and reports decode throughput and
+queue underruns, the times playback wanted audio and none was ready.  Given a
+convert.Converter it also converts each chunk to the output device's format, into a
+fixed set of buffers reused as playback takes the chunks.  WAV data is likewise read
+straight into a fixed set of buffers, and used in place.
+
+"""
+
+import collections
+import os
+import shutil
+import struct
+import subprocess
+import threading
+import time
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+import numpy as np
+
+import clock
+import metrics
+
+#################################################
+
+PREFETCH = 1.0         # Seconds of audio decoded ahead of playback.
+CHUNK_SIZE = 4096      # Frames per chunk, unless told otherwise.
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Command line decoders writing 16-bit WAV to stdout, by the file types they take.
+COMMANDS = [('ffmpeg', None, ['-v', 'error', '-nostdin', '-i', '{fname}',
+                              '-f', 'wav', '-acodec', 'pcm_s16le', '-']),
+            ('flac', ['.flac'], ['-d', '-c', '-s', '{fname}']),
+            ('oggdec', ['.ogg'], ['-Q', '-b', '16', '-o', '-', '{fname}']),
+            ('mpg123', ['.mp3'], ['-q', '-w', '-', '{fname}'])]
+
+
+def open_song(fname):
+    """
+    Decoder for a song file, the first installed one able to read it.
+    """
+    b, e = os.path.splitext(fname)
+    e = e.lower()
+
+    if e == '.wav':
+        return WavDecoder(fname)
+
+    if soundfile is not None:
+        try:
+            return SoundFileDecoder(fname)
+        except RuntimeError:
+            pass
+
+    for name, extensions, args in COMMANDS:
+        if extensions and e not in extensions:
+            continue
+        if shutil.which(name):
+            return CommandDecoder(fname, [name] + args)
+
+    # Songs used to be played from a converted WAV file alongside.
+    fname_wav = b + '.wav'
+    if os.path.isfile(fname_wav):
+        print('No decoder for %s, playing %s' % (os.path.basename(fname),
+                                                 os.path.basename(fname_wav)))
+        return WavDecoder(fname_wav)
+
+    # Done.
+    raise IOError('No decoder for %s, install soundfile or ffmpeg' % fname)
+
+
+def read_all(fname):
+    """
+    Whole song as one (num_frames, num_channels) array, and its sample rate.
+    """
+    decoder = open_song(fname)
+    try:
+        chunks = []
+        while True:
+            chunk = decoder.read(decoder.sample_rate)
+            if chunk is None:
+                break
+            chunks.append(chunk)
+    finally:
+        decoder.close()
+
+    if not chunks:
+        raise IOError('No audio in %s' % fname)
+
+    # Done.
+    return np.concatenate(chunks), decoder.sample_rate
+
+#################################################
+
+
+class WavDecoder(object):
+    """
+    WAV file, or WAV stream given as stream.  Read with ordinary reads rather than
+    memory-mapped, so audio already played does not stay in memory.
+    """
+
+    def __init__(self, fname, stream=None):
+        if stream is None:
+            stream = open(fname, 'rb')
+
+        self.fname = fname
+        self.stream = stream
+
+        info = read_wav_header(stream)
+        self.sample_rate, self.num_channels, self.sample_width, self.floating, size = info
+        self.frame_bytes = self.num_channels * self.sample_width
+
+        # Bytes of sample data left, None if not known.
+        self.remaining = size
+        self.num_frames = None
+        if size is not None:
+            self.num_frames = size // self.frame_bytes
+
+        # Ring of buffers read into, see allocate().
+        self.buffers = []
+        self.buffer_index = 0
+
+
+    def allocate(self, num_buffers, num_frames):
+        """
+        From now on read chunks of up to num_frames frames into a ring of num_buffers
+        preallocated buffers, instead of into new bytes for every chunk.  A chunk is then
+        only valid until num_buffers - 1 more have been read.
+        """
+        size = num_frames * self.frame_bytes
+        self.buffers = [bytearray(size) for k in range(num_buffers)]
+        self.buffer_index = 0
+
+
+    def read(self, num_frames):
+        """
+        Next num_frames or fewer frames, or None at the end of the song.
+        """
+        n = num_frames * self.frame_bytes
+        if self.remaining is not None:
+            n = min(n, self.remaining)
+
+        if self.buffers and n <= len(self.buffers[0]):
+            buffer = memoryview(self.buffers[self.buffer_index])[:n]
+            self.buffer_index = (self.buffer_index + 1) % len(self.buffers)
+
+            n = self.stream.readinto(buffer) or 0
+            data = buffer[:n - n % self.frame_bytes]
+        else:
+            data = self.stream.read(n)
+            data = data[:len(data) - len(data) % self.frame_bytes]
+        if not len(data):
+            return None
+
+        if self.remaining is not None:
+            self.remaining -= len(data)
+
+        # Done.
+        return samples(data, self.sample_width, self.floating).reshape(-1, self.num_channels)
+
+
+    def close(self):
+        self.stream.close()
+
+
+class SoundFileDecoder(object):
+    """
+    Any file libsndfile reads, decoded to 16-bit samples.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.file = soundfile.SoundFile(fname)
+
+        self.sample_rate = self.file.samplerate
+        self.num_channels = self.file.channels
+        self.num_frames = self.file.frames
+
+
+    def read(self, num_frames):
+        chunk = self.file.read(num_frames, dtype='int16', always_2d=True)
+        if not len(chunk):
+            return None
+
+        # Done.
+        return chunk
+
+
+    def close(self):
+        self.file.close()
+
+
+class CommandDecoder(WavDecoder):
+    """
+    Command line decoder writing a WAV stream to its stdout.  The stream's data size is
+    ignored, decoders writing to a pipe can not go back to fill it in, and samples are
+    read until the decoder exits.
+    """
+
+    def __init__(self, fname, command):
+        self.command = [arg.format(fname=fname) for arg in command]
+        self.process = subprocess.Popen(self.command, stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE)
+
+        try:
+            WavDecoder.__init__(self, fname, self.process.stdout)
+        except IOError:
+            self.close()
+            raise IOError('%s could not decode %s' % (command[0], fname))
+
+        self.remaining = None
+        self.num_frames = None
+
+
+    def read(self, num_frames):
+        chunk = WavDecoder.read(self, num_frames)
+        if chunk is None and self.process.wait():
+            raise IOError('%s failed on %s' % (self.command[0], self.fname))
+
+        # Done.
+        return chunk
+
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+
+
+def read_wav_header(stream):
+    """
+    Read a WAV header up to the start of the sample data.  Returns sample rate, channels,
+    bytes per sample, True for floating point samples, and the size of the sample data
+    in bytes if the header gives it, else None.
+    """
+    def read(n):
+        data = stream.read(n)
+        if len(data) < n:
+            raise IOError('Truncated WAV header')
+        return data
+
+    riff, size, wave = struct.unpack('<4sI4s', read(12))
+    if riff != b'RIFF' or wave != b'WAVE':
+        raise IOError('Not a WAV stream')
+
+    fmt = None
+    while True:
+        tag, size = struct.unpack('<4sI', read(8))
+        if tag == b'data':
+            break
+
+        body = read(size + size % 2)
+        if tag == b'fmt ':
+            fmt = body
+
+    if fmt is None or len(fmt) < 16:
+        raise IOError('WAV stream has no format')
+
+    code, num_channels, sample_rate, rate_bytes, block, bits = struct.unpack('<HHIIHH', fmt[:16])
+    if code == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        code = struct.unpack('<H', fmt[24:26])[0]
+
+    if code not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+        raise IOError('Unsupported WAV format: 0x%04x' % code)
+
+    if size in (0, 0xFFFFFFFF):
+        size = None
+
+    # Done.
+    return sample_rate, num_channels, bits // 8, code == WAVE_FORMAT_IEEE_FLOAT, size
+
+
+def samples(data, sample_width, floating=False):
+    """
+    Samples from little endian PCM bytes.  8-bit samples are unsigned, 24-bit samples
+    come back as int32 scaled to full range.
+    """
+    if floating:
+        dtypes = {4: '<f4', 8: '<f8'}
+    elif sample_width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        wide = np.zeros((len(raw), 4), dtype=np.uint8)
+        wide[:, 1:] = raw
+        return wide.view('<i4').ravel()
+    else:
+        dtypes = {1: np.uint8, 2: '<i2', 4: '<i4'}
+
+    if sample_width not in dtypes:
+        raise IOError('Unsupported sample width: %d bytes' % sample_width)
+
+    # Done.
+    return np.frombuffer(data, dtype=dtypes[sample_width])
+
+#################################################
+
+
+class Prefetcher(object):
+    """
+    Decodes a song in a background thread into a queue of at most depth chunks of
+    chunk_size frames, default PREFETCH seconds' worth, converted by converter if given.
+    get() never blocks, so it can be called from the audio loop; wait() blocks until a
+    chunk is ready.  A chunk is only valid until the chunk after next is taken, its
+    buffer is then used again.  Once the queue is full, decoding resumes when it is
+    down to half, so the decode thread wakes once per several chunks.
+
+    Both sides wait on events made by the clock module, and the decode thread takes part
+    in a clock.VirtualClock, so wait() timeouts run in simulated time and simulated time
+    stands still while a chunk is being decoded.
+
+    Counters, in the 'decode' metrics: chunks and frames decoded, and underruns, calls
+    to get() finding the queue empty after playback has started.  The decode_time
+    histogram holds the wall clock time taken to decode each chunk.
+    """
+
+    def __init__(self, decoder, chunk_size=None, depth=None, converter=None):
+        if not chunk_size:
+            chunk_size = CHUNK_SIZE
+        if not depth:
+            depth = max(int(np.ceil(PREFETCH * decoder.sample_rate / chunk_size)), 2)
+
+        self.decoder = decoder
+        self.chunk_size = chunk_size
+        self.depth = depth
+        self.converter = converter
+
+        # Converted chunks' buffers, enough for a full queue, the chunk being played and
+        # the one being converted.
+        self.buffers = []
+        self.buffer_index = 0
+        if converter is not None:
+            shape = (converter.max_output, converter.channels_out)
+            self.buffers = [np.zeros(shape, dtype=converter.dtype) for k in range(depth + 2)]
+
+        # Decoders able to read into buffers of their own get as many, or with a
+        # converter just two, since it copies each chunk out as soon as it is read.
+        if hasattr(decoder, 'allocate'):
+            num_buffers = depth + 2
+            if converter is not None:
+                num_buffers = 2
+            decoder.allocate(num_buffers, chunk_size)
+
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.room = clock.Event()
+        self.filled = clock.Event()
+        self.thread = None
+
+        self.decoded = False
+        self.stopped = False
+        self.error = None
+
+        self.started = False
+        self.time_start = None
+        self.time_first = None
+        self.decode_time = 0.
+        self.depth_max = 0
+
+        self.metrics = metrics.Metrics('decode', counters=['chunks', 'frames', 'underruns'])
+
+
+    def start(self):
+        self.time_start = time.time()
+        self.thread = threading.Thread(target=self.run, name='decode')
+        self.thread.daemon = True
+        clock.attach()
+        self.thread.start()
+
+
+    def run(self):
+        """
+        Producer.  Decode chunks while there is room in the queue.
+        """
+        try:
+            while True:
+                with self.lock:
+                    full = len(self.queue) >= self.depth
+                    if full:
+                        self.room.clear()
+                if full and not self.stopped:
+                    self.room.wait()
+                    continue
+                if self.stopped:
+                    break
+
+                time_A = time.time()
+                chunk = self.decoder.read(self.chunk_size)
+                frames = 0
+                if chunk is not None:
+                    frames = len(chunk)
+                if self.converter is not None:
+                    chunk = self.convert(chunk)
+                dt = time.time() - time_A
+                if chunk is None:
+                    break
+
+                self.decode_time += dt
+                self.metrics.observe('decode_time', dt)
+                self.metrics.count('chunks')
+                self.metrics.count('frames', frames)
+                if not len(chunk):
+                    continue
+
+                with self.lock:
+                    self.queue.append(chunk)
+                    self.depth_max = max(self.depth_max, len(self.queue))
+                    if self.time_first is None:
+                        self.time_first = time.time()
+                    self.filled.set()
+
+        except Exception as e:
+            self.error = e
+            print('Decode failed: %s: %s' % (os.path.basename(self.decoder.fname), e))
+
+        self.decoder.close()
+
+        with self.lock:
+            self.decoded = True
+            self.filled.set()
+
+        clock.detach()
+
+        # Done.
+
+
+    def convert(self, chunk):
+        """
+        Convert a decoded chunk into the next buffer, or at the end of the song, with
+        chunk None, return the converter's last output if any.
+        """
+        out = self.buffers[self.buffer_index]
+        self.buffer_index = (self.buffer_index + 1) % len(self.buffers)
+
+        if chunk is None:
+            return self.converter.flush(out)
+
+        # Done.
+        return self.converter.convert(chunk, out)
+
+
+    def get(self):
+        """
+        Next chunk, or None if none is ready or the song is over.
+        """
+        with self.lock:
+            if self.queue:
+                chunk = self.queue.popleft()
+                self.started = True
+                if len(self.queue) <= self.depth // 2:
+                    self.room.set()
+                return chunk
+
+        if self.started and not self.decoded:
+            self.metrics.count('underruns')
+
+        # Done.
+        return None
+
+
+    def ready(self):
+        """
+        True if get() would return a chunk or the song is over.
+        """
+        return bool(self.queue) or self.decoded
+
+
+    @property
+    def finished(self):
+        """
+        True once every chunk has been decoded and taken.
+        """
+        return self.decoded and not self.queue
+
+
+    def wait(self, timeout=None):
+        """
+        Wait for a chunk, or the end of the song.  Returns ready().
+        """
+        with self.lock:
+            if self.ready():
+                return True
+            self.filled.clear()
+
+        self.filled.wait(timeout)
+
+        # Done.
+        return self.ready()
+
+
+    def stop(self):
+        """
+        Stop decoding and discard chunks not yet taken.
+        """
+        with self.lock:
+            self.stopped = True
+            self.queue.clear()
+            self.room.set()
+
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+    def report(self):
+        """
+        Decode statistics: frames decoded, decode and conversion speed as a multiple of
+        real time, seconds from start() to the first chunk, largest queue depth and
+        underruns.
+        """
+        frames = self.metrics.counters['frames']
+        speed = None
+        if self.decode_time > 0:
+            speed = frames / float(self.decoder.sample_rate) / self.decode_time
+
+        startup = None
+        if self.time_first is not None:
+            startup = self.time_first - self.time_start
+
+        info = {'frames': frames,
+                'speed': speed,
+                'startup': startup,
+                'depth_max': self.depth_max,
+                'underruns': self.metrics.counters['underruns']}
+
+        # Done.
+        return info
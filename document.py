@@ -0,0 +1,341 @@
+"""
+Compact columnar storage for full track analysis documents.
+
+An Echo Nest track analysis is a large JSON document, mostly long lists of beats,
+segments and so on, each item a small dictionary of numbers.  Held as Python objects,
+or stored as YAML, it is slow to load and takes a lot of memory.  Here each field of
+each list is instead a typed NumPy array, a column, and a whole document is one .npz
+file.  The few values outside the lists, such as 'meta' and 'track', are kept as
+JSON alongside.
+
+parse() reads JSON text incrementally, from a file or a network stream, and adds list
+items to their columns one at a time, so the full document is never in memory.
+Document loads a stored document, reading each column only when it is first used.
+Its segment_table() extracts the (t1, p1, v1) table used by beats.parse_analysis()
+with array arithmetic.
+
+"""
+
+import array
+import json
+
+import numpy as np
+
+import cache
+
+#################################################
+
+# Bump this when the stored layout changes.
+VERSION = 1
+
+# Top level lists stored as columns.
+LISTS = ['bars', 'beats', 'tatums', 'sections', 'segments']
+
+CHUNK_SIZE = 65536
+
+NUMBER_CHARS = '0123456789.eE+-'
+
+
+class Columns(object):
+    """
+    Accumulates list items field by field.  Numbers become float64 columns and lists
+    of numbers, e.g. segment pitches, become float32 columns shaped (num_items, width)
+    with the width taken from the first item.  Missing values are NaN.  Other values,
+    such as strings, are dropped.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.fields = {}
+        self.widths = {}
+
+
+    def add(self, item):
+        for key, value in item.items():
+            if key not in self.fields:
+                width = field_width(value)
+                if width is None:
+                    continue
+
+                self.widths[key] = width
+                self.fields[key] = array.array('d', [np.nan]) * (self.count * max(width, 1))
+
+            column = self.fields[key]
+            width = self.widths[key]
+            if width:
+                values = [number(v) for v in value[:width]] if isinstance(value, list) else []
+                column.extend(values + [np.nan] * (width - len(values)))
+            else:
+                column.append(number(value))
+
+        self.count += 1
+
+        # Fill in fields missing from this item.
+        for key, column in self.fields.items():
+            size = self.count * max(self.widths[key], 1)
+            if len(column) < size:
+                column.extend([np.nan] * (size - len(column)))
+
+
+    def arrays(self, name):
+        """
+        Dictionary of columns keyed by name and field, e.g. 'segments.start'.
+        """
+        result = {'%s.count' % name: np.array(self.count)}
+        for key, column in self.fields.items():
+            data = np.frombuffer(column, dtype=np.float64)
+            width = self.widths[key]
+            if width:
+                data = data.reshape(self.count, width).astype(np.float32)
+
+            result['%s.%s' % (name, key)] = data
+
+        # Done.
+        return result
+
+
+def field_width(value):
+    """
+    Column width for a field's first value: 0 for a number, the length of a list, or
+    None for a value not stored.
+    """
+    if isinstance(value, bool) or value is None or isinstance(value, (int, float)):
+        return 0
+    if isinstance(value, list) and all(isinstance(v, (int, float)) for v in value):
+        return len(value)
+
+    # Done.
+    return None
+
+
+def number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+#################################################
+
+
+class Reader(object):
+    """
+    Incremental JSON reader over a text stream.  Holds at most one chunk of text plus
+    the value being decoded.
+    """
+
+    def __init__(self, stream, chunk_size=None):
+        if not chunk_size:
+            chunk_size = CHUNK_SIZE
+
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+
+    def fill(self):
+        """
+        Read another chunk, dropping text already consumed.  Returns False at the end
+        of the stream.
+        """
+        if self.eof:
+            return False
+
+        chunk = self.stream.read(self.chunk_size)
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode('utf-8')
+
+        self.text = self.text[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+
+        # Done.
+        return bool(chunk)
+
+
+    def peek(self):
+        """
+        Next character after any whitespace, without consuming it, or '' at the end.
+        """
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return ''
+
+
+    def take(self, expected=None):
+        """
+        Consume the next character after any whitespace.
+        """
+        c = self.peek()
+        if expected and c != expected:
+            raise ValueError('Expected %r at %r' % (expected, self.text[self.pos:self.pos + 40]))
+
+        self.pos += 1
+
+        # Done.
+        return c
+
+
+    def value(self):
+        """
+        Decode the next complete JSON value, reading more text as needed.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.text, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+
+            # A number at the end of the text may continue in the next chunk, even past
+            # a partial fraction or exponent such as '1.' or '1e'.
+            if not self.text[end:].strip(NUMBER_CHARS) and self.fill():
+                continue
+
+            self.pos = end
+            return value
+
+
+def parse(stream, chunk_size=None):
+    """
+    Read a JSON analysis document from a text or binary stream.  Returns a dictionary of
+    column arrays for the lists in LISTS, and a dictionary of all other top level values.
+    """
+    reader = Reader(stream, chunk_size)
+
+    columns = {}
+    other = {}
+
+    reader.take('{')
+    if reader.peek() == '}':
+        return columns, other
+
+    while True:
+        key = reader.value()
+        reader.take(':')
+
+        if key in LISTS and reader.peek() == '[':
+            reader.take('[')
+            items = Columns()
+            if reader.peek() == ']':
+                reader.take()
+            else:
+                while True:
+                    item = reader.value()
+                    if isinstance(item, dict):
+                        items.add(item)
+                    if reader.take() == ']':
+                        break
+
+            columns.update(items.arrays(key))
+        else:
+            other[key] = reader.value()
+
+        c = reader.take()
+        if c == '}':
+            break
+        if c != ',':
+            raise ValueError('Expected , or } in analysis document')
+
+    # Done.
+    return columns, other
+
+
+def from_dict(document):
+    """
+    Columns and other values for a document already loaded as a dictionary.
+    """
+    columns = {}
+    other = {}
+    for key, value in document.items():
+        if key in LISTS and isinstance(value, list):
+            items = Columns()
+            for item in value:
+                if isinstance(item, dict):
+                    items.add(item)
+            columns.update(items.arrays(key))
+        else:
+            other[key] = value
+
+    # Done.
+    return columns, other
+
+
+def write(fname, columns, other):
+    """
+    Store a document's columns and other values in one .npz file, atomically.
+    """
+    arrays = dict(columns)
+    arrays['document'] = np.array(json.dumps({'version': VERSION, 'other': other}))
+
+    cache.replace_atomic(fname, lambda f: np.savez(f, **arrays))
+
+    # Done.
+
+#################################################
+
+
+class Document(object):
+    """
+    Stored analysis document.  Columns are read from the file when first used.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.data = np.load(fname)
+
+        info = json.loads(str(self.data['document']))
+        if info.get('version') != VERSION:
+            raise ValueError('Unsupported analysis document version: %s' % fname)
+
+        self.other = info['other']
+
+
+    def __getitem__(self, key):
+        """
+        Top level values outside the lists, e.g. 'track'.
+        """
+        return self.other[key]
+
+
+    def column(self, name, field):
+        """
+        Array of one field for every item of a list, e.g. column('beats', 'start').
+        """
+        key = '%s.%s' % (name, field)
+        if key not in self.data.files:
+            return np.zeros(int(self.data.get('%s.count' % name, 0)))
+
+        # Done.
+        return self.data[key]
+
+
+    def beat_times(self):
+        return self.column('beats', 'start')
+
+
+    def segment_table(self):
+        """
+        Time, loudness in dB and linear level at each segment's loudest point, shaped
+        (num_segments, 3).
+        """
+        t1 = self.column('segments', 'start') + self.column('segments', 'loudness_max_time')
+        p1 = self.column('segments', 'loudness_max')
+        v1 = 10.**(p1 / 20.)
+
+        # Done.
+        return np.column_stack([t1, p1, v1])
+
+
+    def close(self):
+        self.data.close()
@@ -0,0 +1,404 @@
+"""
+Run the servo bank and its I2C writes in a separate process.
+
+Servo threads share the GIL with everything else in the controller process, so NumPy
+work or song analysis on the music side stalls them and the arm visibly hiccups.
+RemoteBank offers the same interface as damped_servo.ServoBank, but the bank itself
+runs in a child process started by RemoteBank.start().  Targets travel from the
+controller process to the child through a CommandRing in shared memory.
+
+The controller process also writes a heartbeat to shared memory, from a background
+thread and with every command.  If the heartbeat is older than the timeout, the child
+assumes the controller has stalled or died and holds every servo where it is until the
+heartbeat returns.  The child exits when asked to stop, or when its parent process
+goes away.
+
+Targets and the driver's tick deadlines are stamped with clock.time(), the monotonic
+clock, which every process on the machine shares.  RemoteBank therefore needs the real
+clock and is not for use with a clock.VirtualClock.  The heartbeat is on the same
+monotonic clock, read directly, so a step in the wall clock neither trips the failsafe
+nor hides a stall.
+
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+
+import numpy as np
+
+import clock
+import damped_servo
+import pca9685
+
+#################################################
+
+# Record layout: sequence number, servo index, value, scale, time, and the target's own
+# pulse sequence number.
+SEQ, INDEX, VALUE, SCALE, TIME, PULSE = range(6)
+NUM_FIELDS = 6
+
+# Header layout.
+HEAD, HEARTBEAT, RUNNING = range(3)
+NUM_HEADER = 3
+
+# Status written back by the driver process.
+STATUS_FIELDS = ['ticks', 'commands', 'overruns', 'failsafes', 'failsafe_active',
+                 'deadline_misses', 'late_max']
+
+
+class CommandRing(object):
+    """
+    Single producer, single consumer ring buffer of servo commands in shared memory.
+
+    Each slot records the sequence number of the command it holds, cleared first and
+    written last, so the consumer can tell a complete record from one still being
+    written, and can detect when the producer has lapped it.  The consumer reads the
+    number again after copying a record, as in a seqlock, so a record overwritten while
+    being copied is not taken for a complete one.
+    """
+
+    def __init__(self, capacity=None):
+        if not capacity:
+            capacity = 256
+
+        self.capacity = capacity
+        self.records = multiprocessing.RawArray('d', capacity * NUM_FIELDS)
+        self.header = multiprocessing.RawArray('d', NUM_HEADER)
+        self.status = multiprocessing.RawArray('d', len(STATUS_FIELDS))
+        self.wake = multiprocessing.Event()
+
+        self.header[HEARTBEAT] = time.monotonic()
+        self.header[RUNNING] = 1.
+
+
+    def beat(self):
+        self.header[HEARTBEAT] = time.monotonic()
+
+
+    def age(self):
+        """
+        Seconds since the last heartbeat.
+        """
+        return time.monotonic() - self.header[HEARTBEAT]
+
+
+    def write(self, index, target):
+        """
+        Append a command for the servo at index.  Producer only.
+        """
+        k = int(self.header[HEAD])
+        base = (k % self.capacity) * NUM_FIELDS
+
+        self.records[base + SEQ] = -1.
+        self.records[base + INDEX] = index
+        self.records[base + VALUE] = target.value
+        self.records[base + SCALE] = target.scale
+        self.records[base + TIME] = target.time
+        self.records[base + PULSE] = target.seq
+        self.records[base + SEQ] = k
+
+        self.header[HEAD] = k + 1
+        self.beat()
+        self.wake.set()
+
+
+    def read(self, tail):
+        """
+        Read commands from sequence number tail onwards.  Consumer only.  Returns an
+        array of records, the new tail, and the number of commands lost because the
+        producer lapped the consumer.
+        """
+        head = int(self.header[HEAD])
+
+        lost = 0
+        if head - tail > self.capacity:
+            lost = head - self.capacity - tail
+            tail = head - self.capacity
+
+        if head == tail:
+            return np.zeros((0, NUM_FIELDS)), tail, lost
+
+        records = np.frombuffer(self.records, dtype=np.float64).reshape(self.capacity, NUM_FIELDS)
+        seq = np.arange(tail, head)
+        ix = seq % self.capacity
+        batch = records[ix]
+
+        # Keep only records that were complete before copying, and still the same after.
+        valid = (batch[:, SEQ] == seq) & (records[ix, SEQ] == seq)
+        if not valid.all():
+            k = np.argmin(valid)
+            batch = batch[:k]
+            head = tail + k
+
+        # Done.
+        return batch, head, lost
+
+
+    def get_status(self):
+        return dict(zip(STATUS_FIELDS, self.status[:]))
+
+#################################################
+
+
+def serve(ring, servos, freq=None, eps=None, model=None, address=None, timeout=None,
+          factory=None, widths=None):
+    """
+    Driver process main loop.  Build a ServoBank from the list of servo configuration
+    dicts, as passed to ServoBank.add(), then apply commands from the ring and tick the
+    bank until told to stop.  Hold position while the heartbeat is older than timeout.
+    Each channel's pulse width is copied to the optional shared array widths every tick.
+    """
+    if not timeout:
+        timeout = 1.0
+
+    ppid = os.getppid()
+
+    bank = damped_servo.ServoBank(freq, eps, address=address, model=model)
+    for config in servos:
+        bank.add(**config)
+
+    if factory:
+        board = pca9685.get_board(address, freq=1000. / bank.period, factory=factory)
+        bank.writer = board.writer
+    bank.open()
+
+    status = ring.status
+    tail = 0
+    failsafe = False
+
+    time_next = clock.time()
+    deadline = None
+    while ring.header[RUNNING] and os.getppid() == ppid:
+        bank.metrics.tick(clock.time(), deadline)
+
+        batch, tail, lost = ring.read(tail)
+        for k, value, scale, t, seq in batch[:, INDEX:]:
+            bank.mailboxes[int(k)].post(damped_servo.Target(value, scale, t, int(seq)))
+
+        stale = ring.age() > timeout
+        if stale and not failsafe:
+            bank.hold(bank.width)
+            status[STATUS_FIELDS.index('failsafes')] += 1
+        failsafe = stale
+
+        bank.step()
+        if widths is not None:
+            widths[:] = bank.width
+
+        status[STATUS_FIELDS.index('ticks')] += 1
+        status[STATUS_FIELDS.index('commands')] += len(batch)
+        status[STATUS_FIELDS.index('overruns')] += lost
+        status[STATUS_FIELDS.index('failsafe_active')] = failsafe
+        status[STATUS_FIELDS.index('deadline_misses')] = bank.metrics.deadline_misses
+        status[STATUS_FIELDS.index('late_max')] = bank.metrics.late_max
+
+        time_next, deadline = bank.schedule(time_next)
+
+        # Wake often enough to notice the heartbeat stopping.
+        time_check = clock.time() + timeout / 4.
+        if deadline is None or deadline > time_check:
+            deadline_wait = time_check
+        else:
+            deadline_wait = deadline
+
+        dt = deadline_wait - clock.time()
+        if dt > 0:
+            ring.wake.wait(dt)
+            ring.wake.clear()
+
+        time_next = damped_servo.resync(time_next, 1./bank.freq)
+
+    # Done.
+
+
+class RingMailbox(damped_servo.Mailbox):
+    """
+    Mailbox that also forwards every posted target to the driver process.
+    """
+
+    def __init__(self, target, ring, index):
+        damped_servo.Mailbox.__init__(self, target)
+        self.ring = ring
+        self.index = index
+
+
+    def post(self, target):
+        damped_servo.Mailbox.post(self, target)
+        self.ring.write(self.index, target)
+
+
+class RemoteBank(object):
+    """
+    Stand-in for damped_servo.ServoBank whose servos are driven from a separate process.
+    Add servos, then start().  Servos are controlled through the same BankServo views.
+    Channel alpha values are fixed once started, and the bank has no writer of its own.
+    """
+
+    def __init__(self, freq=None, eps=None, address=None, model=None, timeout=None,
+                 capacity=None, factory=None):
+        """
+        Heartbeat timeout defaults to one second.  Optional factory is passed on to
+        pca9685.get_board() in the driver process, e.g. pca9685.FakeI2C for testing.
+        """
+        if not freq:
+            freq = 70.  # Hz.
+        if eps is None:
+            eps = 0.01
+        if not model:
+            model = 'first_order'
+        if not timeout:
+            timeout = 1.0
+
+        self.freq = freq
+        self.eps = eps
+        self.model = model
+        self.address = address
+        self.timeout = timeout
+        self.factory = factory
+        self.writer = None
+
+        self.ring = CommandRing(capacity)
+        self.widths = None
+        self.process = None
+        self.heartbeat = None
+        self.keep_running = False
+
+        self.configs = []
+        self.servos = []
+        self.mailboxes = []
+        self.channel = np.zeros(0, dtype=np.int32)
+        self.alpha = np.zeros(0)
+
+
+    def add(self, channel, info, scale, sign=None, alpha=None, vmin=None, vmax=None,
+            curve=None):
+        """
+        Add a new servo channel, as for ServoBank.add().  Returns a BankServo view.
+        """
+        if self.process:
+            raise ValueError('Cannot add servos once the driver is running')
+        if channel in self.channel:
+            raise ValueError('Channel already in use: %d' % channel)
+
+        if alpha is None:
+            if self.model == 'first_order':
+                alpha = 0.05
+            else:
+                alpha = 1.
+
+        config = {'channel': channel, 'info': info, 'scale': scale, 'sign': sign,
+                  'alpha': alpha, 'vmin': vmin, 'vmax': vmax, 'curve': curve}
+        self.configs.append(config)
+
+        index = len(self.servos)
+        target = damped_servo.Target(0., scale, clock.time(), 0)
+        self.mailboxes.append(RingMailbox(target, self.ring, index))
+
+        self.channel = np.append(self.channel, channel).astype(np.int32)
+        self.alpha = np.append(self.alpha, alpha)
+
+        servo = damped_servo.BankServo(self, index)
+        self.servos.append(servo)
+
+        # Done.
+        return servo
+
+
+    def __len__(self):
+        return len(self.servos)
+
+
+    def __getitem__(self, index):
+        return self.servos[index]
+
+
+    def force(self, index, y, t=None):
+        """
+        Send new system input value y for the servo at the specified index.
+        """
+        if t is None:
+            t = clock.time()
+
+        target = self.mailboxes[index].read()
+        self.mailboxes[index].post(damped_servo.Target(y, target.scale, t, target.seq + 1))
+
+
+    def hold(self, widths, t=None):
+        """
+        Move every channel to the given widths.  Unlike ServoBank.hold() the driver
+        still moves the servos there through their response.
+        """
+        if t is None:
+            t = clock.time()
+
+        for index, width in enumerate(widths):
+            self.force(index, width, t)
+
+
+    @property
+    def width(self):
+        """
+        Pulse widths last sent by the driver process, all zero until it starts.
+        """
+        if self.widths is None:
+            return np.zeros(len(self))
+
+        return np.array(self.widths[:])
+
+
+    def status(self):
+        """
+        Counters reported by the driver process.
+        """
+        return self.ring.get_status()
+
+
+    def start(self):
+        """
+        Start the driver process and the heartbeat thread.
+        """
+        self.widths = multiprocessing.RawArray('d', len(self))
+
+        args = (self.ring, self.configs, self.freq, self.eps, self.model, self.address,
+                self.timeout, self.factory, self.widths)
+        self.process = multiprocessing.Process(target=serve, args=args)
+        self.process.daemon = True
+        self.process.start()
+
+        self.keep_running = True
+        self.heartbeat = threading.Thread(target=self.beat)
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+
+
+    def beat(self):
+        """
+        Heartbeat thread.  Stalls along with the rest of this process.
+        """
+        while self.keep_running:
+            self.ring.beat()
+            time.sleep(self.timeout / 4.)
+
+
+    def is_alive(self):
+        return bool(self.process) and self.process.is_alive()
+
+
+    def stop(self):
+        """
+        Ask the driver process to finish, leaving the servos where they are.
+        """
+        if self.keep_running:
+            self.keep_running = False
+            self.ring.header[RUNNING] = 0.
+            self.ring.wake.set()
+            print('Servo driver stopping: %d channels' % len(self))
+
+
+    def join(self, timeout=None):
+        if self.process:
+            self.process.join(timeout)
+        if self.heartbeat:
+            self.heartbeat.join(timeout)
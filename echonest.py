@@ -0,0 +1,653 @@
+"""
+Remote song analysis from an Echo Nest style web API, plus a local stand-in server.
+
+Client talks to an Echo Nest API v4 endpoint through a single requests.Session, so
+requests from all threads share one pool of open connections.  Connection errors,
+timeouts and busy or failing servers (429 and 5xx responses) are retried with
+exponential backoff, honouring Retry-After.  A full analysis is streamed through
+document.parse() into the analysis cache without ever holding the whole response.
+
+fetch_batch() gets analyses for many songs at once with a bounded number of threads,
+so a large library is limited by bandwidth rather than round trips.  Track ids of new
+uploads are saved to the config file every CONFIG_BATCH songs and at the end, rather
+than after every upload.
+
+The endpoint comes from the 'endpoint' entry of the config file, default
+ENDPOINT_DEFAULT.  Server answers the same requests from analysis.analyze() results
+for WAV uploads, with optional added latency and random failures, to test against
+without the real service:
+
+    python echonest.py --serve 8000
+    python echonest.py Music --endpoint http://localhost:8000/api/v4 --jobs 8
+
+"""
+
+import argparse
+import hashlib
+import http.server
+import io
+import json
+import multiprocessing.pool
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+import scipy as sp
+import scipy.io.wavfile
+
+try:
+    import data_io
+except ImportError:
+    data_io = None
+
+try:
+    import requests
+    import requests.adapters
+except ImportError:
+    requests = None
+
+import analysis
+import cache
+import document
+
+#################################################
+
+ENDPOINT_DEFAULT = 'http://developer.echonest.com/api/v4'
+
+JOBS = 8              # Concurrent requests.
+RETRIES = 5           # Attempts after the first.
+BACKOFF = 0.5         # First retry delay, seconds, doubled on each retry.
+BACKOFF_MAX = 30.
+TIMEOUT = 30.         # Seconds to connect, and between bytes received.
+POLL_TIMEOUT = 300.   # Seconds to wait for a pending analysis.
+CONFIG_BATCH = 50     # New songs between config file saves.
+
+# Song file types to upload, smallest first: a compressed file is preferred over the
+# WAV of the same song.
+UPLOAD_EXTENSIONS = ['.mp3', '.m4a', '.ogg', '.flac', '.wav']
+
+
+class TransientError(IOError):
+    """
+    Server busy or failing, worth trying again after a delay.
+    """
+
+    def __init__(self, message, retry_after=None):
+        IOError.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class ApiError(IOError):
+    """
+    Request refused by the API, e.g. for an unknown track id.
+    """
+    pass
+
+
+def read_config(fname_config=None):
+    """
+    Config file contents, with an empty 'songs' dictionary if it has none.
+    """
+    if not fname_config:
+        fname_config = 'audio_config.yml'
+
+    info, meta = data_io.read(fname_config)
+    if not info.get('songs'):
+        info['songs'] = {}
+
+    # Done.
+    return info
+
+
+def write_config(fname_config, info):
+    if not fname_config:
+        fname_config = 'audio_config.yml'
+
+    data_io.write(fname_config, info)
+
+    # Done.
+
+#################################################
+
+
+class Client(object):
+    """
+    Pooled, retrying connection to an Echo Nest style API.  Safe to use from several
+    threads at once.
+    """
+
+    def __init__(self, api_key, endpoint=None, jobs=None, retries=None, backoff=None,
+                 timeout=None):
+        if requests is None:
+            raise ImportError('Remote analysis needs the requests package')
+
+        if not endpoint:
+            endpoint = ENDPOINT_DEFAULT
+        if not jobs:
+            jobs = JOBS
+        if retries is None:
+            retries = RETRIES
+        if not backoff:
+            backoff = BACKOFF
+        if not timeout:
+            timeout = TIMEOUT
+
+        self.api_key = api_key
+        self.endpoint = endpoint.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        # One connection per job to each host, waiting for a free one beyond that.
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=jobs,
+                                                pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.errors = (requests.ConnectionError, requests.Timeout,
+                       requests.exceptions.ChunkedEncodingError, TransientError)
+
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_retries = 0
+
+        # Done.
+
+
+    def retry(self, action):
+        """
+        Call action(), retrying with backoff on transient errors.
+        """
+        attempt = 0
+        while True:
+            try:
+                return action()
+            except self.errors as e:
+                if attempt >= self.retries:
+                    raise
+
+                delay = min(self.backoff * 2**attempt, BACKOFF_MAX)
+                delay *= random.uniform(0.5, 1.)
+                if getattr(e, 'retry_after', None) is not None:
+                    delay = max(delay, e.retry_after)
+
+                attempt += 1
+                with self.lock:
+                    self.num_retries += 1
+
+                time.sleep(delay)
+
+
+    def send(self, method, url, **kwargs):
+        """
+        One request.  Raises TransientError for responses worth retrying.
+        """
+        with self.lock:
+            self.num_requests += 1
+
+        r = self.session.request(method, url, timeout=self.timeout, **kwargs)
+
+        if r.status_code == 429 or r.status_code >= 500:
+            retry_after = r.headers.get('Retry-After')
+
+            # Read the short error body, so the connection goes back to the pool.
+            r.content
+            r.close()
+            try:
+                retry_after = float(retry_after)
+            except (TypeError, ValueError):
+                retry_after = None
+
+            raise TransientError('HTTP %d from %s' % (r.status_code, url), retry_after)
+
+        # Done.
+        return r
+
+
+    def call(self, method, name, params, **kwargs):
+        """
+        API method call.  Returns the 'response' part of the reply.
+        """
+        url = '%s/%s' % (self.endpoint, name)
+        params = dict(params, api_key=self.api_key)
+        data = kwargs.get('data')
+
+        def action():
+            if hasattr(data, 'seek'):
+                data.seek(0)
+
+            r = self.send(method, url, params=params, **kwargs)
+            try:
+                reply = r.json()['response']
+            except ValueError:
+                r.raise_for_status()
+                raise
+
+            status = reply['status']
+            if status['code'] == 3:
+                # Rate limit.
+                raise TransientError(status['message'])
+            if status['code'] != 0:
+                raise ApiError('Echo Nest error %d: %s' % (status['code'], status['message']))
+
+            return reply
+
+        # Done.
+        return self.retry(action)
+
+
+    def upload(self, fname):
+        """
+        Upload a song file.  Returns the track id.
+        """
+        filetype = os.path.splitext(fname)[1][1:].lower()
+        with open(fname, 'rb') as f:
+            reply = self.call('POST', 'track/upload', {'filetype': filetype}, data=f,
+                              headers={'Content-Type': 'application/octet-stream'})
+
+        # Done.
+        return reply['track']['id']
+
+
+    def analysis_url(self, track_id):
+        """
+        URL of a track's full analysis, waiting while the analysis is pending.
+        """
+        params = {'id': track_id, 'bucket': 'audio_summary'}
+
+        time_A = time.time()
+        delay = self.backoff
+        while True:
+            track = self.call('GET', 'track/profile', params)['track']
+            if track['status'] == 'complete':
+                return track['audio_summary']['analysis_url']
+            if track['status'] != 'pending':
+                raise IOError('Echo Nest analysis %s: %s' % (track['status'], track_id))
+            if time.time() - time_A > POLL_TIMEOUT:
+                raise IOError('Echo Nest analysis timed out: %s' % track_id)
+
+            time.sleep(delay)
+            delay = min(delay * 2., BACKOFF_MAX)
+
+
+    def download(self, url, fname):
+        """
+        Stream a full analysis into a document file.
+        """
+        def action():
+            r = self.send('GET', url, stream=True)
+            try:
+                r.raise_for_status()
+                r.raw.decode_content = True
+                columns, other = document.parse(r.raw)
+            finally:
+                r.close()
+
+            document.write(fname, columns, other)
+
+        self.retry(action)
+
+        # Done.
+
+
+def fetch_song(client, songs, fname_song, store, force=False):
+    """
+    Make sure the analysis cache holds the full analysis of a song, uploading it if it
+    is not in songs, the config file's dictionary of known tracks.  Returns the song's
+    new config entry, or None if nothing changed.
+    """
+    f = store.document_name(store.digest(fname_song))
+    if os.path.isfile(f) and not force:
+        store.touch(f)
+        return None
+
+    name = os.path.basename(fname_song)
+    entry = songs.get(name)
+    if entry:
+        entry = dict(entry)
+    else:
+        entry = {'id': client.upload(fname_song)}
+
+    try:
+        url = client.analysis_url(entry['id'])
+    except ApiError:
+        if name not in songs:
+            raise
+
+        # Track unknown to the server, e.g. expired: upload again.
+        entry['id'] = client.upload(fname_song)
+        url = client.analysis_url(entry['id'])
+
+    client.download(url, f)
+
+    # Done.
+    entry['analysis_url'] = url
+    return entry
+
+
+def fetch_job(fname_song, client, songs, store, force=False):
+    """
+    Batch worker.  Returns the file name, new config entry, seconds taken and an error
+    message, or None on success.
+    """
+    time_A = time.time()
+    try:
+        entry = fetch_song(client, songs, fname_song, store, force)
+        error = None
+    except Exception as e:
+        entry = None
+        error = '%s: %s' % (e.__class__.__name__, e)
+
+    # Done.
+    return fname_song, entry, time.time() - time_A, error
+
+
+def find_uploads(path):
+    """
+    Song files in a folder, one per song name, preferring the smallest file type.
+    """
+    songs = {}
+    for f in sorted(os.listdir(path)):
+        b, e = os.path.splitext(f)
+        e = e.lower()
+        if e not in UPLOAD_EXTENSIONS:
+            continue
+
+        if b not in songs or UPLOAD_EXTENSIONS.index(e) < UPLOAD_EXTENSIONS.index(songs[b][1]):
+            songs[b] = (os.path.join(path, f), e)
+
+    # Done.
+    return [songs[b][0] for b in sorted(songs)]
+
+
+def fetch_batch(fnames, fname_config=None, endpoint=None, jobs=None, force=False,
+                path_cache=None):
+    """
+    Fetch full analyses for a list of song files across a pool of threads, skipping
+    songs already cached unless force is set.  Failed songs are reported and skipped.
+    Returns dictionary of (seconds, error) tuples by song file name.
+    """
+    if not jobs:
+        jobs = JOBS
+
+    info = read_config(fname_config)
+    songs = info['songs']
+    if not endpoint:
+        endpoint = info.get('endpoint')
+
+    client = Client(info['api_key'], endpoint, jobs)
+    store = cache.AnalysisCache(path_cache)
+
+    print('Songs: %d, threads: %d, endpoint: %s' % (len(fnames), jobs, client.endpoint))
+
+    results = {}
+    changed = 0
+    time_A = time.time()
+
+    pool = multiprocessing.pool.ThreadPool(min(jobs, max(len(fnames), 1)))
+    try:
+        job = lambda f: fetch_job(f, client, songs, store, force)
+        for k, (f, entry, dt, error) in enumerate(pool.imap_unordered(job, fnames)):
+            name = os.path.basename(f)
+            if error:
+                print('[%3d/%d] %6.2f s  %s  FAILED  %s' % (k+1, len(fnames), dt, name, error))
+            elif entry:
+                print('[%3d/%d] %6.2f s  %s' % (k+1, len(fnames), dt, name))
+            else:
+                print('[%3d/%d] %6.2f s  %s  cached' % (k+1, len(fnames), dt, name))
+
+            results[f] = (dt, error)
+
+            if entry and songs.get(name) != entry:
+                songs[name] = entry
+                changed += 1
+                if changed % CONFIG_BATCH == 0:
+                    write_config(fname_config, info)
+
+        pool.close()
+    except KeyboardInterrupt:
+        print('\nUser stop!')
+        pool.terminate()
+    finally:
+        if changed % CONFIG_BATCH:
+            write_config(fname_config, info)
+
+    pool.join()
+    store.evict()
+
+    time_B = time.time()
+    failed = sum(1 for dt, error in results.values() if error)
+    print('Fetched %d songs in %.1f s, %d requests, %d retries, %d failed' %
+          (len(results), time_B - time_A, client.num_requests, client.num_retries, failed))
+
+    # Done.
+    return results
+
+#################################################
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Request handler for Server.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def reply(self, code, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if code == 503:
+            self.send_header('Retry-After', '0')
+        self.end_headers()
+
+        # Write in pieces, as a large response would arrive.
+        view = memoryview(body)
+        for k in range(0, len(body), 65536):
+            self.wfile.write(view[k:k + 65536])
+
+
+    def api_reply(self, code, message, **kwargs):
+        response = {'status': {'code': code, 'message': message, 'version': '4.2'}}
+        response.update(kwargs)
+
+        # Done.
+        self.reply(400 if code else 200, {'response': response})
+
+
+    def respond(self, method):
+        stand_in = self.server.stand_in
+        stand_in.count(self.client_address)
+
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+
+        body = b''
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            body = self.rfile.read(length)
+
+        if stand_in.latency:
+            time.sleep(stand_in.latency)
+
+        if random.random() < stand_in.fail_rate:
+            self.reply(503, b'Busy', 'text/plain')
+            return
+
+        if url.path.startswith('/analysis/'):
+            text = stand_in.analyses.get(url.path[len('/analysis/'):-len('.json')])
+            if text is None:
+                self.reply(404, b'Not found', 'text/plain')
+            else:
+                self.reply(200, text)
+            return
+
+        if not params.get('api_key'):
+            self.api_reply(1, 'Invalid API key')
+        elif method == 'POST' and url.path == '/api/v4/track/upload':
+            try:
+                track = stand_in.upload(body, params.get('filetype'))
+            except ValueError as e:
+                self.api_reply(5, str(e))
+            else:
+                self.api_reply(0, 'Success', track=track)
+        elif method == 'GET' and url.path == '/api/v4/track/profile':
+            track = stand_in.profile(params.get('id'), self.headers.get('Host'))
+            if track:
+                self.api_reply(0, 'Success', track=track)
+            else:
+                self.api_reply(5, 'The Identifier specified does not exist')
+        else:
+            self.reply(404, b'Not found', 'text/plain')
+
+
+    def do_GET(self):
+        self.respond('GET')
+
+
+    def do_POST(self):
+        self.respond('POST')
+
+
+class Server(object):
+    """
+    Local stand-in for the Echo Nest API, running in a background thread.  Uploaded WAV
+    files are analyzed with analysis.analyze().  Each request is delayed by latency
+    seconds, and a fail_rate fraction of them answered with HTTP 503.
+    """
+
+    def __init__(self, port=None, latency=None, fail_rate=None):
+        if port is None:
+            port = 0
+        if latency is None:
+            latency = 0.
+        if fail_rate is None:
+            fail_rate = 0.
+
+        self.latency = latency
+        self.fail_rate = fail_rate
+
+        self.lock = threading.Lock()
+        self.tracks = {}
+        self.analyses = {}
+        self.num_requests = 0
+        self.connections = set()
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.stand_in = self
+
+        self.thread = None
+
+        # Done.
+
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:%d/api/v4' % self.httpd.server_address[1]
+
+
+    def count(self, address):
+        with self.lock:
+            self.num_requests += 1
+            self.connections.add(address)
+
+
+    def upload(self, body, filetype):
+        if filetype != 'wav':
+            raise ValueError('Stand-in server only analyzes WAV files')
+
+        track_id = 'TR' + hashlib.sha1(body).hexdigest()[:16].upper()
+        if track_id not in self.tracks:
+            sample_rate, data = sp.io.wavfile.read(io.BytesIO(body))
+            if data.ndim == 1:
+                data = data[:, None]
+
+            result = analysis.analyze(data, sample_rate)
+            with self.lock:
+                self.tracks[track_id] = result['track']
+                self.analyses[track_id] = json.dumps(result).encode('utf-8')
+
+        # Done.
+        return {'id': track_id, 'status': 'complete', 'filetype': filetype}
+
+
+    def profile(self, track_id, host):
+        track = self.tracks.get(track_id)
+        if not track:
+            return None
+
+        summary = {'analysis_url': 'http://%s/analysis/%s.json' % (host, track_id),
+                   'duration': track['duration'],
+                   'tempo': track['tempo']}
+
+        # Done.
+        return {'id': track_id, 'status': 'complete', 'audio_summary': summary}
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+#################################################
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Fetch Echo Nest analyses for songs, '
+                                                 'or run a local stand-in server.')
+    parser.add_argument('fnames', type=str, nargs='*', help='Song files or folders.')
+    parser.add_argument('--config', type=str, default=None,
+                        help='Config file, default audio_config.yml.')
+    parser.add_argument('--endpoint', type=str, default=None,
+                        help='API endpoint, default from the config file or %s.' % ENDPOINT_DEFAULT)
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Concurrent requests, default %d.' % JOBS)
+    parser.add_argument('--force', action='store_true',
+                        help='Fetch again even when cached.')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Analysis cache folder, default %s.' % cache.PATH_DEFAULT)
+    parser.add_argument('--serve', type=int, default=None, metavar='PORT',
+                        help='Run the stand-in server on this port instead.')
+    parser.add_argument('--latency', type=float, default=None,
+                        help='Stand-in server delay per request, seconds.')
+    parser.add_argument('--fail-rate', type=float, default=None,
+                        help='Fraction of stand-in server requests to fail.')
+
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        server = Server(args.serve, args.latency, args.fail_rate)
+        print('Stand-in server at %s' % server.endpoint)
+        try:
+            server.httpd.serve_forever()
+        except KeyboardInterrupt:
+            print('\nUser stop!')
+    else:
+        fnames = []
+        for f in args.fnames:
+            if os.path.isdir(f):
+                fnames.extend(find_uploads(f))
+            else:
+                fnames.append(f)
+
+        fetch_batch(fnames, args.config, args.endpoint, args.jobs, args.force, args.cache)
+
+    # Done.
@@ -0,0 +1,369 @@
+"""
+Run a whole show on a single asyncio event loop.
+
+The threaded design gives every ServoBank and beats.Player its own thread, plus RPIO's
+interrupt thread, and stitches them together with sleeps and events.  An Engine instead
+runs the servo ticks, audio chunk feeding and beat dispatch as coroutines on one event
+loop.  Everything is scheduled on timers: the servo loop keeps its absolute deadlines,
+audio chunks are written just in time to keep the device buffer full, and beat events
+wait for the chunk that carries them.  Button callbacks arriving from RPIO are handed
+over to the loop, so controller code only ever runs in one thread.
+
+lego.Controller runs on an engine when given one, see Controller.show_async().
+
+The loop normally runs on the wall clock.  Given a clock.VirtualClock it instead runs in
+virtual time: whenever nothing is ready to run the clock jumps straight to the next
+timer.  The caller installs the virtual clock, see sim.run_show().
+
+"""
+
+import asyncio
+import selectors
+
+import choreography
+import clock
+import damped_servo
+import tempo
+
+#################################################
+
+
+class VirtualSelector(selectors.BaseSelector):
+    """
+    Selector that advances a VirtualClock by the timeout instead of waiting, whenever no
+    file is ready.
+    """
+
+    def __init__(self, clock_virtual):
+        self.clock = clock_virtual
+        self.selector = selectors.DefaultSelector()
+
+
+    def register(self, fileobj, events, data=None):
+        return self.selector.register(fileobj, events, data)
+
+
+    def unregister(self, fileobj):
+        return self.selector.unregister(fileobj)
+
+
+    def modify(self, fileobj, events, data=None):
+        return self.selector.modify(fileobj, events, data)
+
+
+    def select(self, timeout=None):
+        ready = self.selector.select(0)
+        if ready or (timeout is not None and timeout <= 0):
+            return ready
+
+        if timeout is None:
+            # Nothing scheduled.  Only another thread can wake the loop now.
+            return self.selector.select(None)
+
+        with self.clock.lock:
+            self.clock.now += timeout
+
+        # Done.
+        return []
+
+
+    def close(self):
+        self.selector.close()
+
+
+    def get_map(self):
+        return self.selector.get_map()
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop whose time is a VirtualClock's time.
+    """
+
+    def __init__(self, clock_virtual):
+        self.clock = clock_virtual
+        asyncio.SelectorEventLoop.__init__(self, VirtualSelector(clock_virtual))
+
+
+    def time(self):
+        return self.clock.now
+
+
+class LoopEvent(object):
+    """
+    Event for waking a coroutine on an engine's loop.  May be set from any thread.
+    Used in place of the clock module's events by servo banks and players running on
+    an engine.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+
+    def is_set(self):
+        return self.event.is_set()
+
+
+    def set(self):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is self.loop:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+
+    def clear(self):
+        self.event.clear()
+
+
+    async def wait(self, timeout=None):
+        """
+        Wait for the event to be set, or the timeout to pass.  Returns the event's state.
+        """
+        if timeout is None:
+            await self.event.wait()
+        else:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        # Done.
+        return self.event.is_set()
+
+#################################################
+
+
+class Engine(object):
+    """
+    Single event loop running servo banks, audio playback and controller code.
+    """
+
+    def __init__(self, clock_virtual=None):
+        """
+        Create the engine's event loop, on the wall clock or the given VirtualClock.
+        """
+        if clock_virtual:
+            self.loop = VirtualEventLoop(clock_virtual)
+        else:
+            self.loop = asyncio.new_event_loop()
+
+        self.clock_virtual = clock_virtual
+
+
+    def run(self, coro):
+        """
+        Run coroutine to completion.  Returns its result.  Tasks it spawned carry on
+        whenever the loop runs again.
+        """
+        return self.loop.run_until_complete(coro)
+
+
+    def close(self):
+        """
+        Wait for all remaining tasks to finish, then close the loop.  Stop servo banks
+        and players first.
+        """
+        pending = asyncio.all_tasks(self.loop)
+        if pending:
+            self.loop.run_until_complete(asyncio.gather(*pending))
+
+        self.loop.close()
+
+
+    def spawn(self, coro):
+        """
+        Start coroutine as a new task on the loop.
+        """
+        return self.loop.create_task(coro)
+
+
+    def event(self):
+        return LoopEvent(self.loop)
+
+
+    async def sleep(self, dt):
+        await asyncio.sleep(max(dt, 0.))
+
+
+    async def sleep_until(self, t):
+        await asyncio.sleep(max(t - clock.time(), 0.))
+
+
+    async def run_steps(self, steps):
+        """
+        Run a generator that yields the time to sleep between its steps.
+        """
+        for dt in steps:
+            await self.sleep(dt)
+
+
+    def callback(self, func):
+        """
+        Wrap a GPIO interrupt callback so that it runs on the loop, whichever thread it
+        is called from.
+        """
+        def handler(pin, value):
+            self.loop.call_soon_threadsafe(func, pin, value)
+
+        # Done.
+        return handler
+
+
+    def start_bank(self, bank):
+        """
+        Run a damped_servo.ServoBank on the loop instead of in its own thread.
+        """
+        bank.wake = self.event()
+        bank.keep_running = True
+
+        # Done.
+        return self.spawn(self.drive(bank))
+
+
+    def start_player(self, player):
+        """
+        Play a beats.Player's audio from the loop instead of in its own thread.
+        """
+        player.tick = self.event()
+        player.is_running = True
+
+        # Done.
+        return self.spawn(self.play(player))
+
+
+    async def drive(self, bank):
+        """
+        Servo bank run loop.  Same schedule as damped_servo.ServoBank.run().
+        """
+        bank.open()
+
+        time_A = clock.time()
+        time_next = time_A
+        cnt = 0
+        deadline = None
+        while bank.keep_running:
+            if bank.paused:
+                bank.parked.set()
+                await bank.wake.wait()
+                bank.wake.clear()
+
+                time_next = clock.time()
+                deadline = None
+                continue
+
+            cnt += 1
+            bank.metrics.tick(clock.time(), deadline)
+            bank.step()
+
+            time_next, deadline = bank.schedule(time_next)
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = deadline - clock.time()
+
+            if timeout is None or timeout > 0:
+                await bank.wake.wait(timeout)
+                bank.wake.clear()
+
+            time_next = damped_servo.resync(time_next, 1./bank.freq)
+
+        bank.loop_exit(time_A, cnt)
+
+        # Done.
+
+
+    async def play(self, player):
+        """
+        Audio playback.  Each chunk is written once the device has room for it, judged
+        from its free space, so writes never block the loop.
+        """
+        need = min(player.chunk_size, player.bufsize // 2)
+
+        k0 = 0
+        t0 = clock.time()
+        while player.is_running and not player.at_end:
+            free = player.audio_device.obuffree()
+            if free < need:
+                await self.sleep(float(need - free) / player.sample_rate)
+                continue
+
+            if not player.ready():
+                # Decoder behind.  write_chunk() counts the underrun, or writes a chunk
+                # that has arrived since.
+                k0 = player.write_chunk(k0, t0)
+                await self.sleep(player.time_interval / 10.)
+                continue
+
+            k0 = player.write_chunk(k0, t0)
+
+        if player.is_running:
+            dt = player.time_drain()
+            print('Empty buffer: %.2f' % dt)
+            await self.sleep(dt)
+        else:
+            player.audio_device.reset()
+
+        player.finish()
+
+        # Done.
+
+
+    async def events(self, player, idle=False):
+        """
+        Asynchronous generator yielding the player's audio events as they are played,
+        in the same form as beats.Player.beats().  Call start_player() first.
+
+        With idle set, also yield None each time the generator wakes up with no event
+        due, at least every time_interval seconds once playback starts, for anticipate().
+        """
+        for d in choreography.merge_events(player.audio_beats, player.audio_segments):
+            t = d[0]
+            while True:
+                timestamp = player.timestamp
+                if timestamp is not None and timestamp >= t:
+                    break
+                if player.is_finished:
+                    return
+
+                # Wake when the event is due, or once playback starts.
+                wait = None
+                if timestamp is not None:
+                    wait = player.playback.wait_time(t)
+                    if idle:
+                        wait = min(wait, player.time_interval)
+
+                await player.tick.wait(wait)
+                player.tick.clear()
+
+                if idle:
+                    yield None
+
+            yield d
+
+
+    async def anticipate(self, events, predictor, player, lead=None):
+        """
+        Same as tempo.anticipate(), for events from events(player, idle=True), waiting
+        on the loop for predicted beats to come due.
+        """
+        state = tempo.Anticipation(predictor, player, lead)
+
+        async for d in events:
+            if d is None:
+                due = state.idle()
+                if due:
+                    wait, d = due
+                    await self.sleep(wait)
+                    yield d
+            else:
+                d = state.observe(d)
+                if d:
+                    yield d
+
+        # Done.
@@ -5,14 +5,24 @@ This file is where everything is orchestrated.  This file is specific to Lego Ba
 
 """
 
+import collections
 import os
+import threading
 import time
 
 import numpy as np
-import RPIO
 
+try:
+    import RPIO
+except ImportError:
+    RPIO = None
+
+import clock
 import damped_servo
+import driver
 import beats
+import choreography
+import tempo
 
 ########################################
 
@@ -26,15 +36,51 @@ class Controller(object):
                  channel_4, scale_4,
                  lag=0.,
                  channel_lohi=None,
-                 fname_song=None):
+                 fname_song=None,
+                 model=None,
+                 gpio=None,
+                 player=None,
+                 engine=None,
+                 isolate=False,
+                 predictor=None,
+                 lead=None):
+        """
+        Optionally supply a ready made beats.Player instead of a song file name, and a
+        stand-in for the RPIO module, e.g. from the sim module.
+
+        Supply a tempo.BeatPredictor to have main_dance() move on predicted beats, lead
+        seconds ahead of them, see tempo.anticipate().  Servo scales are taken to suit
+        the predictor's starting tempo and follow its tempo estimate from then on.
+
+        Supply an engine.Engine to run the servos, audio and button callbacks on its
+        event loop rather than in threads, then run the show with show_async().
 
-        if fname_song:
+        Set isolate to drive the servos from a separate process, see the driver module,
+        so their timing does not depend on work done here.
+        """
+
+        if player:
+            self.player = player
+        elif fname_song:
             self.player = beats.Player(fname_song, lag=lag)
         else:
             self.player = None
 
+        if not gpio:
+            gpio = RPIO
+        self.gpio = gpio
+
         self.channel_lohi = channel_lohi
 
+        self.model = model
+        self.engine = engine
+        self.isolate = isolate
+        self.predictor = predictor
+        self.lead = lead
+        self.bank = None
+        self.blinker = None
+        self.servo_config = None
+
         self.channel_0 = channel_0
         self.scale_0 = scale_0
         self.D_0 = None
@@ -55,6 +101,13 @@ class Controller(object):
         self.scale_4 = scale_4
         self.D_4 = None
 
+        self.scales = [scale_0, scale_1, scale_2, scale_3, scale_4]
+        if predictor:
+            self.period_base = predictor.period
+        else:
+            self.period_base = None
+        self.period_scales = self.period_base
+
         self.pin_butt_red = 23
         self.pin_butt_yel = 24
         self.pin_butt_grn = 25
@@ -68,26 +121,56 @@ class Controller(object):
 
     def blink_led(self, pin, value):
         """
-        Blink the LEDs in an interesting fashion.
+        Blink the LEDs in an interesting fashion.  The blink runs in the background, as
+        its own task on an engine or else in its own thread, and this returns straight
+        away.  Without an engine, a blink already running is left to finish instead of
+        starting another.
+        """
+        if self.engine:
+            self.engine.spawn(self.engine.run_steps(self.blink_steps()))
+            return
+
+        if self.blinker and self.blinker.is_alive():
+            return
+
+        self.blinker = threading.Thread(target=self.blink_thread)
+        self.blinker.daemon = True
+
+        clock.attach()
+        self.blinker.start()
+
+        # Done.
+
+
+    def blink_thread(self):
+        for dt in self.blink_steps():
+            clock.sleep(dt)
+
+        clock.detach()
+
+
+    def blink_steps(self):
+        """
+        Generator for blink_led(), yielding the time to wait between steps.
         """
 
-        RPIO.output(self.pin_led_red, False)
-        RPIO.output(self.pin_led_yel, False)
-        RPIO.output(self.pin_led_grn, False)
+        self.gpio.output(self.pin_led_red, False)
+        self.gpio.output(self.pin_led_yel, False)
+        self.gpio.output(self.pin_led_grn, False)
 
-        RPIO.output(self.pin_led_red, True)
-        time.sleep(0.05)
-        RPIO.output(self.pin_led_yel, True)
-        time.sleep(0.05)
-        RPIO.output(self.pin_led_grn, True)
+        self.gpio.output(self.pin_led_red, True)
+        yield 0.05
+        self.gpio.output(self.pin_led_yel, True)
+        yield 0.05
+        self.gpio.output(self.pin_led_grn, True)
 
-        time.sleep(0.3)
+        yield 0.3
 
-        RPIO.output(self.pin_led_red, False)
-        time.sleep(0.05)
-        RPIO.output(self.pin_led_yel, False)
-        time.sleep(0.05)
-        RPIO.output(self.pin_led_grn, False)
+        self.gpio.output(self.pin_led_red, False)
+        yield 0.05
+        self.gpio.output(self.pin_led_yel, False)
+        yield 0.05
+        self.gpio.output(self.pin_led_grn, False)
 
         # Done.
 
@@ -99,42 +182,51 @@ class Controller(object):
 
     def turn_on(self):
         print('Initialize GPIO pins')
-        RPIO.setup(self.pin_led_red, RPIO.OUT)
-        RPIO.setup(self.pin_led_yel, RPIO.OUT)
-        RPIO.setup(self.pin_led_grn, RPIO.OUT)
+        self.gpio.setup(self.pin_led_red, self.gpio.OUT)
+        self.gpio.setup(self.pin_led_yel, self.gpio.OUT)
+        self.gpio.setup(self.pin_led_grn, self.gpio.OUT)
 
-        RPIO.setup(self.pin_butt_red, RPIO.IN)
-        RPIO.setup(self.pin_butt_yel, RPIO.IN)
-        RPIO.setup(self.pin_butt_grn, RPIO.IN)
+        self.gpio.setup(self.pin_butt_red, self.gpio.IN)
+        self.gpio.setup(self.pin_butt_yel, self.gpio.IN)
+        self.gpio.setup(self.pin_butt_grn, self.gpio.IN)
 
         print('Configure GPIO callback event handlers')
-        fn = self.callback_end_looping
-        RPIO.add_interrupt_callback(self.pin_butt_red, fn, edge='falling', pull_up_down=RPIO.PUD_UP,
+        fn = self.handler(self.callback_end_looping)
+        self.gpio.add_interrupt_callback(self.pin_butt_red, fn, edge='falling', pull_up_down=self.gpio.PUD_UP,
                                     threaded_callback=True, debounce_timeout_ms=100)
 
-        fn = self.blink_led
-        RPIO.add_interrupt_callback(self.pin_butt_red, fn, edge='falling', pull_up_down=RPIO.PUD_UP,
+        fn = self.handler(self.blink_led)
+        self.gpio.add_interrupt_callback(self.pin_butt_red, fn, edge='falling', pull_up_down=self.gpio.PUD_UP,
                                     threaded_callback=True, debounce_timeout_ms=100)
-        RPIO.add_interrupt_callback(self.pin_butt_yel, fn, edge='falling', pull_up_down=RPIO.PUD_UP,
+        self.gpio.add_interrupt_callback(self.pin_butt_yel, fn, edge='falling', pull_up_down=self.gpio.PUD_UP,
                                     threaded_callback=True, debounce_timeout_ms=100)
-        RPIO.add_interrupt_callback(self.pin_butt_grn, fn, edge='falling', pull_up_down=RPIO.PUD_UP,
+        self.gpio.add_interrupt_callback(self.pin_butt_grn, fn, edge='falling', pull_up_down=self.gpio.PUD_UP,
                                     threaded_callback=True, debounce_timeout_ms=100)
 
-        RPIO.wait_for_interrupts(threaded=True)
+        self.gpio.wait_for_interrupts(threaded=True)
 
 
         print('Instantiate controller objects')
-        self.D_0 = damped_servo.DampedServo(self.channel_0, damped_servo.info_sg5010,  self.scale_0)
-        self.D_1 = damped_servo.DampedServo(self.channel_1, damped_servo.info_sg92r,   self.scale_1, sign=-1)
-        self.D_2 = damped_servo.DampedServo(self.channel_2, damped_servo.info_eflrs60, self.scale_2, sign=-1)
-        self.D_3 = damped_servo.DampedServo(self.channel_3, damped_servo.info_eflrs60, self.scale_3, sign=-1)
-        self.D_4 = damped_servo.DampedServo(self.channel_4, damped_servo.info_sg92r,   self.scale_4, sign=-1, vmin=230)
-
-        self.D_0.start()
-        self.D_1.start()
-        self.D_2.start()
-        self.D_3.start()
-        self.D_4.start()
+        self.servo_config = [
+            {'channel': self.channel_0, 'info': damped_servo.info_sg5010,  'scale': self.scale_0},
+            {'channel': self.channel_1, 'info': damped_servo.info_sg92r,   'scale': self.scale_1, 'sign': -1},
+            {'channel': self.channel_2, 'info': damped_servo.info_eflrs60, 'scale': self.scale_2, 'sign': -1},
+            {'channel': self.channel_3, 'info': damped_servo.info_eflrs60, 'scale': self.scale_3, 'sign': -1},
+            {'channel': self.channel_4, 'info': damped_servo.info_sg92r,   'scale': self.scale_4, 'sign': -1, 'vmin': 230}]
+
+        if self.isolate:
+            self.bank = driver.RemoteBank(model=self.model)
+        else:
+            self.bank = damped_servo.ServoBank(model=self.model)
+        for config in self.servo_config:
+            self.bank.add(**config)
+
+        self.D_0, self.D_1, self.D_2, self.D_3, self.D_4 = self.bank.servos
+
+        if self.engine and not self.isolate:
+            self.engine.start_bank(self.bank)
+        else:
+            self.bank.start()
 
         self.D_0.pulse(0)
         self.D_1.pulse(0)
@@ -145,11 +237,32 @@ class Controller(object):
         # Done.
 
 
+    def handler(self, func):
+        """
+        GPIO callback for func, handed over to the engine's loop if there is one.
+        """
+        if self.engine:
+            return self.engine.callback(func)
+
+        # Done.
+        return func
+
+
     def intro(self):
         """
         Introduction motion.
         """
-        time.sleep(0.1)
+        for dt in self.intro_steps():
+            clock.sleep(dt)
+
+        # Done.
+
+
+    def intro_steps(self):
+        """
+        Generator for intro(), yielding the time to wait between steps.
+        """
+        yield 0.1
 
         print('Wake up...')
 
@@ -161,10 +274,10 @@ class Controller(object):
         self.D_4.pulse(0.75)
 
         self.D_0.pulse(0.9)
-        time.sleep(0.5)
+        yield 0.5
 
         self.D_1.pulse(0.95)
-        time.sleep(2.0)
+        yield 2.0
 
         self.D_0.scale = self.scale_0
         self.D_1.scale = self.scale_1
@@ -185,7 +298,7 @@ class Controller(object):
         while self.keep_running:
             try:
                 dt = np.random.uniform(0.10, 0.5)
-                time.sleep(dt)
+                clock.sleep(dt)
 
                 i = np.random.random_integers(0, len(ix)-1)
                 i = ix[i]
@@ -213,101 +326,203 @@ class Controller(object):
         """
         self.keep_running = True
 
-        #D_beats = [self.D_0, self.D_1]
-        #D_segments = [self.D_2, self.D_3, self.D_4]
-        D_beats = [self.D_0, self.D_3]
-        D_segments = [self.D_2, self.D_1, self.D_4]
-        #D_beats = [self.D_0, self.D_1]
-        #D_segments = [self.D_2, self.D_3, self.D_4]
-
-        parity = {self.D_0: False,
-                  self.D_1: False,
-                  self.D_2: False,
-                  self.D_3: False,
-                  self.D_4: False}
-
-        lohi = {self.D_0: self.channel_lohi[0],
-                self.D_1: self.channel_lohi[1],
-                self.D_2: self.channel_lohi[2],
-                self.D_3: self.channel_lohi[3],
-                self.D_4: self.channel_lohi[4]}
-
-
-        ix_beat = 0
-        ix_segment = 0
+        servos = [self.D_0, self.D_1, self.D_2, self.D_3, self.D_4]
 
         try:
             print('Start audio play')
             self.player.start()
 
+            events = self.player.beats(idle=bool(self.predictor))
+            if self.predictor:
+                events = tempo.anticipate(events, self.predictor, self.player, self.lead)
+
             print('Enter main loop...')
-            v_old = 0.
-            for d in self.player.beats():
-                t, k = d[:2]
+            for move in choreography.dance(events, self.channel_lohi):
 
                 if not self.keep_running:
                     break
 
-                if k == 'beat':
+                self.perform(servos, move)
+                if move.kind == 'beat':
+                    self.retune(servos)
 
-                    ix_beat += 1
-                    ix_beat_mod = ix_beat % len(D_beats)
+        except KeyboardInterrupt:
+            print('\nUser stop!')
+            self.keep_running = False
 
-                    if ix_beat:
-                        self.blink_led(0, 0)
+        self.player.stop()
 
-                    D = D_beats[ix_beat_mod]
-                    parity[D] = not parity[D]
-                    value = lohi[D][parity[D]]
+        # Done.
 
-                    value_work = value * v_old
-                    print('[%6.2fs] %4d  %5.2f %5.2f %5.2f' %
-                          (t, D.channel, value, v_old, value_work))
 
-                    if value_work > 1:
-                        value_work = 1
-                    if value_work < 0:
-                        value_work = 0
+    def perform(self, servos, move):
+        """
+        Carry out one dance move.
+        """
+        D = servos[move.servo]
+        if move.kind == 'beat':
+            self.blink_led(0, 0)
 
-                    D.pulse(value_work)
+            print('[%6.2fs] %4d  %5.2f %5.2f %5.2f' %
+                  (move.t, D.channel, move.value, move.level, move.width))
+        else:
+            print('          %4d  %5.2f %5.2f %5.2f' %
+                  (D.channel, move.value, move.level, move.width))
 
-                elif k == 'segment':
-                    #print('                %.2f' % v_old)
-                    ix_segment += 1
-                    ix_segment = ix_segment % len(D_segments)
+        D.pulse(move.width)
 
-                    D = D_segments[ix_segment]
-                    parity[D] = not parity[D]
-                    value = lohi[D][parity[D]]
-                    #value = lohi_segments[parity[D]]
+        # Done.
 
-                    p, v = d[2]
-                    alpha = 0.05
-                    v_old = alpha * v_old + (1. - alpha) * v
 
-                    #value *= v_old
+    def retune(self, servos):
+        """
+        Rescale servo response times once the predictor's tempo has moved by more than
+        two percent since they were last set.
+        """
+        if not self.predictor or not self.predictor.locked():
+            return
 
-                    value_work = value * v_old
-                    print('          %4d  %5.2f %5.2f %5.2f' %
-                          (D.channel, value, v_old, value_work))
+        period = self.predictor.period
+        if abs(period / self.period_scales - 1.) <= 0.02:
+            return
 
-                    if value_work > 1:
-                        value_work = 1
-                    if value_work < 0:
-                        value_work = 0
+        ratio = period / self.period_base
+        for D, scale in zip(servos, self.scales):
+            D.scale = scale * ratio
 
-                    D.pulse(value_work)
-                else:
-                    raise ValueError('Invalid kind: %s' % k)
+        self.period_scales = period
 
+        # Done.
 
 
+    async def main_dance_async(self):
+        """
+        Same as main_dance(), on the engine's event loop.
+        """
+        self.keep_running = True
+
+        servos = [self.D_0, self.D_1, self.D_2, self.D_3, self.D_4]
+
+        # choreography.dance() takes one event per move, so feed it events one at a time.
+        events = collections.deque()
+
+        def feed():
+            while True:
+                yield events.popleft()
+
+        moves = choreography.dance(feed(), self.channel_lohi)
+
+        print('Start audio play')
+        self.engine.start_player(self.player)
+
+        audio = self.engine.events(self.player, idle=bool(self.predictor))
+        if self.predictor:
+            audio = self.engine.anticipate(audio, self.predictor, self.player, self.lead)
+
+        print('Enter main loop...')
+        async for d in audio:
+            if not self.keep_running:
+                break
+
+            events.append(d)
+            move = next(moves)
+            self.perform(servos, move)
+            if move.kind == 'beat':
+                self.retune(servos)
+
+        self.player.stop()
+
+        # Done.
+
+
+    async def show_async(self):
+        """
+        Complete show with music on the engine's event loop: wake up, dance and shut
+        down.
+        """
+        self.turn_on()
+        await self.engine.run_steps(self.intro_steps())
+        await self.main_dance_async()
+        await self.engine.run_steps(self.finish_steps())
+        self.turn_off()
+
+        # Done.
+
+
+    def timeline_config(self):
+        """
+        Controller configuration for compiling a timeline, starting from the servos'
+        current targets.
+        """
+        servos = []
+        for config, D in zip(self.servo_config, self.bank.servos):
+            config = dict(config, scale=D.scale, initial=float(D.target))
+            servos.append(config)
+
+        config = {'servos': servos,
+                  'lohi': self.channel_lohi,
+                  'beat_servos': [0, 3],
+                  'segment_servos': [2, 1, 4],
+                  'freq': self.bank.freq,
+                  'eps': self.bank.eps,
+                  'model': self.bank.model}
+
+        # Done.
+        return config
+
+
+    def main_timeline(self, path_cache=None):
+        """
+        Main event loop, with music.  Same dance as main_dance(), but the whole song is
+        compiled to a servo timeline ahead of time.  During playback the PWM counts for
+        the current audio timestamp are looked up and written out once per tick, with
+        the servo bank paused so it does not write to the board as well.  LEDs are not
+        blinked.  Not available with an isolated servo driver.
+        """
+        if self.isolate:
+            raise ValueError('Timeline playback writes to the board directly')
+
+        self.keep_running = True
+
+        timeline = choreography.compile_timeline(self.player.audio_beats,
+                                                 self.player.audio_segments,
+                                                 self.timeline_config(),
+                                                 path_cache=path_cache)
+
+        time_wait = 1. / timeline.rate
+
+        self.bank.pause()
+        writer = self.bank.writer
+
+        k = 0
+        try:
+            print('Start audio play')
+            self.player.start()
+
+            print('Enter main loop...')
+            while self.keep_running and not self.player.is_finished:
+                t = self.player.timestamp
+                if t is not None:
+                    if t > timeline.duration:
+                        break
+
+                    k = timeline.index(t)
+                    for channel, counts in zip(timeline.channels, timeline.counts[k]):
+                        writer.set(channel, 0, int(counts))
+                    writer.flush()
+
+                clock.sleep(time_wait)
+
         except KeyboardInterrupt:
             print('\nUser stop!')
             self.keep_running = False
 
         self.player.stop()
 
+        # Servos are where the timeline left them.
+        self.bank.hold(timeline.widths[k])
+        self.bank.resume()
+
         # Done.
 
 
@@ -315,6 +530,16 @@ class Controller(object):
         """
         Final act.
         """
+        for dt in self.finish_steps():
+            clock.sleep(dt)
+
+        # Done.
+
+
+    def finish_steps(self):
+        """
+        Generator for finish(), yielding the time to wait between steps.
+        """
         print('Begin shutdown...')
 
         # Move up.
@@ -330,18 +555,18 @@ class Controller(object):
         self.D_4.pulse(0.65)
 
         self.D_0.pulse(0.60)
-        time.sleep(0.5)
+        yield 0.5
 
         self.D_1.pulse(1.0)
-        time.sleep(0.25)
+        yield 0.25
 
         # Move down.
         self.D_0.pulse(0)
-        time.sleep(1.0)
+        yield 1.0
 
         self.D_0.scale = 0.5
         self.D_0.pulse(0.6)
-        time.sleep(0.75)
+        yield 0.75
 
         self.D_2.pulse(0.0)
         self.D_3.pulse(0.0)
@@ -349,7 +574,7 @@ class Controller(object):
 
         # Move back up.
         self.D_1.pulse(0.1)
-        time.sleep(2)
+        yield 2
 
         print('Stowe...')
 
@@ -359,7 +584,7 @@ class Controller(object):
 
         self.D_1.scale = 0.1
         self.D_1.pulse(0.0)
-        time.sleep(0.5)
+        yield 0.5
 
         self.D_0.scale = 0.1
         self.D_0.pulse(0.0)
@@ -368,7 +593,7 @@ class Controller(object):
         self.D_3.pulse(0.0)
         self.D_4.pulse(0.0)
 
-        time.sleep(2.0)
+        yield 2.0
 
         # Done.
 
@@ -379,14 +604,13 @@ class Controller(object):
         """
 
         print('Shut down controller objects')
-        self.D_0.stop()
-        self.D_1.stop()
-        self.D_2.stop()
-        self.D_3.stop()
-        self.D_4.stop()
+        self.bank.stop()
 
+        # Let a blink in progress finish.
+        while self.blinker and self.blinker.is_alive():
+            clock.sleep(0.01)
 
-        RPIO.cleanup()
+        self.gpio.cleanup()
 
         print('Done.')
 
@@ -422,16 +646,23 @@ if __name__ == '__main__':
     channel_0 = 15  # big arm
     channel_1 = 14  # small arm
     channel_2 = 00  # small, end, thick wires
-    channel_3 = 02  # small, middle
-    channel_4 = 03  # small, end
-
-    bpm = 115.97
-    s = 60. / bpm
-    scale_0 = s*.5
-    scale_1 = s*.5
-    scale_2 = s*1.1
-    scale_3 = s*1.1
-    scale_4 = s*1.1
+    channel_3 = 2   # small, middle
+    channel_4 = 3   # small, end
+
+    # Servo response times follow the song's tempo.  The critically damped model needs
+    # no extra smoothing, so scales come straight from settle times: the arms settle
+    # within a beat, the small servos within a little over two.
+    player = beats.Player(fname_song, lag=lag)
+    bpm = tempo.estimate_bpm(player.audio_beats)
+    predictor = tempo.BeatPredictor(bpm)
+
+    model = 'critical'
+    s = 60. / bpm / damped_servo.settle_time(model, 1.)
+    scale_0 = s*1.0
+    scale_1 = s*1.0
+    scale_2 = s*2.2
+    scale_3 = s*2.2
+    scale_4 = s*2.2
 
     lohi = [[0.7, 1.0],
             [0.0, 1.0],
@@ -448,9 +679,10 @@ if __name__ == '__main__':
                             channel_2, scale_2,
                             channel_3, scale_3,
                             channel_4, scale_4,
-                            lag=lag,
                             channel_lohi=lohi,
-                            fname_song=fname_song)
+                            player=player,
+                            model=model,
+                            predictor=predictor)
     controller.turn_on()
     controller.intro()
     controller.main_dance()
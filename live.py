@@ -0,0 +1,589 @@
+"""
+Dance to live sound instead of a pre-analyzed song file.
+
+LivePlayer reads audio in small blocks from a source, runs an OnsetDetector over each
+block as it arrives and hands out events of the same form as beats.Player.beats(), so
+lego.Controller.main_dance() works unchanged:
+
+    controller = lego.Controller(..., player=live.LivePlayer(live.DeviceSource()))
+
+Sources:
+
+  - DeviceSource: OSS audio input device.
+  - StreamSource: raw signed 16-bit little endian samples from a file object, e.g. a
+    pipe from arecord.
+  - WavSource: a WAV file delivered block by block in clock time, standing in for a
+    live input when testing.
+
+The detector is a causal version of the spectral flux onset envelope from the analysis
+module.  Each block costs a fixed amount of work: its new frames, plus an occasional
+tempo estimate over a fixed length of history.  Onsets become segment events.  Onsets
+close to the beat grid of the current tempo estimate also become beat events.
+
+Detection latency, from the onset in the sound to its event being ready, is recorded in
+the player's metrics and printed when the player finishes.  It is made up of the block
+size, the detector's window and the peak confirmation delay, 15 to 20 ms in total with
+the defaults, plus whatever buffering the input device adds.
+
+"""
+
+import argparse
+import collections
+import sys
+import threading
+
+try:
+    import ossaudiodev
+except ImportError:
+    ossaudiodev = None
+
+import numpy as np
+import scipy as sp
+import scipy.fft
+
+import analysis
+import beats
+import clock
+import metrics
+
+#################################################
+
+FRAME_TIME = 0.023     # Detector window, seconds.  Rounded to a power of two samples.
+BLOCK_TIME = 0.005     # Source block duration, seconds.
+
+PEAK_FRAMES = 1        # Frames either side of an onset peak.  Each one delays events.
+MEAN_TIME = 1.0        # Time constant of the slowly varying part of the flux, seconds.
+NORM_TIME = 5.0        # Time constant of the flux deviation estimate, seconds.
+LOCAL_TIME = 0.1       # Time constant of the local mean for onset thresholds, seconds.
+ONSET_MIN = 1.0        # Envelope deviations, at least, for an onset.
+WARMUP_TIME = 0.5      # Seconds of input before the first onset, while statistics settle.
+
+TEMPO_HISTORY = 8.0    # Seconds of onset envelope used to estimate tempo.
+TEMPO_INTERVAL = 1.0   # Seconds between tempo estimates.
+BEAT_TOLERANCE = 0.2   # Fraction of a period an onset may be off the beat grid.
+LEVEL_HISTORY = 64     # Segments used to normalize levels.
+
+# Flux peaks once an attack has reached this fraction of the way into the window.
+ONSET_OFFSET = 0.25
+
+
+class OnsetDetector(object):
+    """
+    Incremental onset and loudness detector.  Feed it blocks of samples in order; it
+    returns audio events as soon as they are confirmed.
+    """
+
+    def __init__(self, sample_rate, frame_time=None):
+        if not frame_time:
+            frame_time = FRAME_TIME
+
+        n_fft = 1 << int(round(np.log2(frame_time * sample_rate)))
+        hop = n_fft // 4
+
+        self.sample_rate = sample_rate
+        self.n_fft = n_fft
+        self.hop = hop
+        self.frame_rate = float(sample_rate) / hop
+
+        self.bins = analysis.band_starts(n_fft, sample_rate)
+        self.window = np.hanning(n_fft).astype(np.float32)
+        self.scale = 4. / float(n_fft)**2
+
+        # Samples not yet consumed by a frame, and the stream position of the first one.
+        self.samples = np.zeros(n_fft - hop, dtype=np.float32)
+        self.position = -(n_fft - hop)
+        self.num_samples = 0
+
+        self.level_prev = None
+        self.flux_mean = None
+        self.flux_var = None
+        self.env_local = 0.
+
+        self.a_mean = 1. / (MEAN_TIME * self.frame_rate)
+        self.a_norm = 1. / (NORM_TIME * self.frame_rate)
+        self.a_local = 1. / (LOCAL_TIME * self.frame_rate)
+
+        # Recent frames for peak picking: (stream time, envelope, loudness, threshold).
+        self.recent = collections.deque(maxlen=2 * PEAK_FRAMES + 1)
+
+        self.history = collections.deque(maxlen=int(TEMPO_HISTORY * self.frame_rate))
+        self.levels = collections.deque(maxlen=LEVEL_HISTORY)
+        self.frames_tempo = 0
+        self.frames_warmup = int(WARMUP_TIME * self.frame_rate)
+
+        self.period = None
+        self.time_onset = None
+        self.time_beat = None
+
+        # Done.
+
+
+    def process(self, block):
+        """
+        Analyze the next block of (num_frames, num_channels) samples.  Returns a list of
+        new events with times in seconds from the start of the stream.
+        """
+        x = np.concatenate([self.samples, analysis.to_mono(block)])
+        self.num_samples += len(block)
+
+        num_frames = (len(x) - self.n_fft) // self.hop + 1
+        if num_frames <= 0:
+            self.samples = x
+            return []
+
+        frames = np.lib.stride_tricks.sliding_window_view(x, self.n_fft)[::self.hop]
+        frames = frames[:num_frames]
+
+        power = np.einsum('ij,ij->i', frames, frames) / self.n_fft
+        loudness = np.maximum(10. * np.log10(power + 1.e-10), analysis.FLOOR)
+
+        spectrum = sp.fft.rfft(frames * self.window, axis=1)
+        power = spectrum.real**2 + spectrum.imag**2
+        b0, b1 = self.bins[0], self.bins[-1]
+        bands = np.add.reduceat(power[:, b0:b1], self.bins[:-1] - b0, axis=1)
+        level = np.maximum(10. * np.log10(bands * self.scale + 1.e-12), analysis.FLOOR)
+
+        if self.level_prev is None:
+            self.level_prev = level[:1]
+        rise = np.diff(np.vstack([self.level_prev, level]), axis=0)
+        flux = np.maximum(rise, 0.).mean(axis=1)
+        self.level_prev = level[-1:]
+
+        # Stream time of each frame's onset estimate.
+        times = (self.position + np.arange(num_frames) * self.hop +
+                 (1. - ONSET_OFFSET) * self.n_fft) / self.sample_rate
+
+        consumed = num_frames * self.hop
+        self.samples = x[consumed:]
+        self.position += consumed
+
+        events = []
+        for t, f, p in zip(times.tolist(), flux.tolist(), loudness.tolist()):
+            events.extend(self.frame(t, f, p))
+
+        # Done.
+        return events
+
+
+    def frame(self, t, flux, loudness):
+        """
+        Update the onset envelope with one frame.  Returns any events it confirms.
+        """
+        if self.flux_mean is None:
+            self.flux_mean = flux
+            self.flux_var = 0.
+
+        self.flux_mean += self.a_mean * (flux - self.flux_mean)
+        env = max(flux - self.flux_mean, 0.)
+        self.flux_var += self.a_norm * (env * env - self.flux_var)
+        if self.flux_var > 0:
+            env /= np.sqrt(self.flux_var)
+
+        self.recent.append((t, env, loudness, self.env_local + analysis.ONSET_DELTA))
+        self.env_local += self.a_local * (env - self.env_local)
+
+        self.history.append(env)
+        self.frames_tempo += 1
+        if self.frames_tempo >= TEMPO_INTERVAL * self.frame_rate:
+            self.frames_tempo = 0
+            self.update_tempo()
+
+        if self.frames_warmup > 0:
+            self.frames_warmup -= 1
+            return []
+
+        # Middle frame is an onset once it is confirmed as a peak.
+        if len(self.recent) < self.recent.maxlen:
+            return []
+
+        t_peak, env_peak, p, threshold = self.recent[PEAK_FRAMES]
+        if env_peak < max(threshold, ONSET_MIN):
+            return []
+        if env_peak < max(d[1] for d in self.recent):
+            return []
+        if self.time_onset is not None and t_peak - self.time_onset < analysis.ONSET_GAP:
+            return []
+
+        self.time_onset = t_peak
+
+        p = max(d[2] for d in self.recent)
+        v = 10.**(p / 20.)
+        self.levels.append(v)
+
+        events = []
+        if self.is_beat(t_peak):
+            self.time_beat = t_peak
+            events.append((t_peak, 'beat'))
+        events.append((t_peak, 'segment', (p, self.level(v))))
+
+        # Done.
+        return events
+
+
+    def update_tempo(self):
+        """
+        Re-estimate the beat period from recent onset envelope history.
+        """
+        if len(self.history) < self.history.maxlen // 2:
+            return
+
+        bpm, confidence = analysis.estimate_tempo(np.array(self.history), self.frame_rate)
+        if confidence > 0:
+            self.period = 60. / bpm
+
+
+    def is_beat(self, t):
+        """
+        Decide whether an onset at time t lands on the beat.  Before the tempo is known
+        onsets at least half a second apart count as beats.  After a long gap the beat
+        grid restarts at the next onset.
+        """
+        if self.time_beat is None:
+            return True
+
+        dt = t - self.time_beat
+        if self.period is None:
+            return dt >= 0.5
+
+        n = round(dt / self.period)
+        if n < 1:
+            return False
+        if n > 4:
+            return True
+
+        # Done.
+        return abs(dt - n * self.period) <= BEAT_TOLERANCE * self.period
+
+
+    def level(self, v):
+        """
+        Normalize a segment level against recent segments, as beats.analyze_song() does
+        for a whole song.
+        """
+        if len(self.levels) < 10:
+            return 1.
+
+        levels = np.array(self.levels)
+        v0, v1 = np.percentile(levels, [10., 90.])
+        if v1 <= v0:
+            return 1.
+
+        # Done.
+        return float(beats.normalize_levels(levels)[-1])
+
+#################################################
+
+
+class DeviceSource(object):
+    """
+    Blocks of samples from an OSS audio input device.
+    """
+
+    def __init__(self, sample_rate=None, num_channels=None, block_size=None):
+        if not sample_rate:
+            sample_rate = 44100
+        if not num_channels:
+            num_channels = 2
+        if not block_size:
+            block_size = int(BLOCK_TIME * sample_rate)
+
+        self.name = 'audio input'
+        self.sample_rate = sample_rate
+        self.num_channels = num_channels
+        self.block_size = block_size
+        self.device = None
+
+
+    def open(self):
+        self.device = ossaudiodev.open('r')
+        self.device.setparameters(ossaudiodev.AFMT_S16_LE, self.num_channels,
+                                  self.sample_rate)
+
+
+    def read(self):
+        """
+        Next block of samples and the clock time of its last sample, or None and the
+        time at the end of the input.
+        """
+        data = self.device.read(self.block_size * 2 * self.num_channels)
+        t = clock.time()
+        if not data:
+            return None, t
+
+        # Done.
+        return np.frombuffer(data, dtype='<i2').reshape(-1, self.num_channels), t
+
+
+    def close(self):
+        self.device.close()
+
+
+class StreamSource(object):
+    """
+    Blocks of raw signed 16-bit little endian samples read from a file object, e.g.
+    sys.stdin.buffer fed by 'arecord -t raw -f S16_LE -r 44100 -c 2'.
+    """
+
+    def __init__(self, stream, sample_rate=None, num_channels=None, block_size=None):
+        if not sample_rate:
+            sample_rate = 44100
+        if not num_channels:
+            num_channels = 2
+        if not block_size:
+            block_size = int(BLOCK_TIME * sample_rate)
+
+        self.name = getattr(stream, 'name', 'stream')
+        self.stream = stream
+        self.sample_rate = sample_rate
+        self.num_channels = num_channels
+        self.block_size = block_size
+        self.buffer = bytearray(block_size * 2 * num_channels)
+
+
+    def open(self):
+        pass
+
+
+    def read(self):
+        num = self.stream.readinto(self.buffer)
+        t = clock.time()
+
+        frame_bytes = 2 * self.num_channels
+        num -= num % frame_bytes
+        if not num:
+            return None, t
+
+        data = np.frombuffer(self.buffer, dtype='<i2', count=num // 2)
+
+        # Done.
+        return data.reshape(-1, self.num_channels), t
+
+
+    def close(self):
+        pass
+
+
+class WavSource(object):
+    """
+    Blocks of samples from a WAV file, each delivered once it would have finished
+    arriving from a live input started when the source was opened.
+    """
+
+    def __init__(self, fname, block_size=None):
+        data, sample_rate = beats.read_wav(fname, mmap=True)
+
+        if not block_size:
+            block_size = int(BLOCK_TIME * sample_rate)
+
+        self.name = fname
+        self.data = data
+        self.sample_rate = sample_rate
+        self.num_channels = data.shape[1]
+        self.block_size = block_size
+
+        self.k0 = 0
+        self.t0 = None
+
+
+    def open(self):
+        self.k0 = 0
+        self.t0 = clock.time()
+
+
+    def read(self):
+        if self.k0 >= len(self.data):
+            return None, clock.time()
+
+        k1 = min(self.k0 + self.block_size, len(self.data))
+        t = self.t0 + float(k1) / self.sample_rate
+        clock.sleep_until(t)
+
+        data = self.data[self.k0:k1]
+        self.k0 = k1
+
+        # Done.
+        return data, t
+
+
+    def close(self):
+        pass
+
+#################################################
+
+
+class LivePlayer(threading.Thread):
+    """
+    Stand-in for beats.Player driven by live sound.  Reads and analyzes the source in a
+    background thread; beats() yields events as they are detected.
+    """
+
+    def __init__(self, source, time_interval=None):
+        """
+        Events are checked for at least every time_interval seconds.
+        """
+        threading.Thread.__init__(self)
+
+        if not time_interval:
+            time_interval = 0.05
+
+        self.source = source
+        self.fname = source.name
+        self.time_interval = time_interval
+        self.sample_rate = source.sample_rate
+
+        self.detector = OnsetDetector(source.sample_rate)
+
+        self.lock = threading.Lock()
+        self.events = collections.deque()
+        self.tick = clock.Event()
+
+        self.is_running = False
+        self.is_finished = False
+        self._timestamp = None
+
+        # Processing starting later than tolerance after a block arrives counts as a
+        # deadline miss.
+        self.metrics = metrics.LoopMetrics('live', counters=['blocks', 'onsets', 'beats'])
+
+        # Done.
+
+
+    @property
+    def timestamp(self):
+        """
+        Stream time of the most recently analyzed sample.
+        """
+        with self.lock:
+            return self._timestamp
+
+
+    def run(self):
+        """
+        Read, analyze and queue events until stopped or the source runs out.
+        """
+        self.is_running = True
+        try:
+            self.source.open()
+            while self.is_running:
+                block, t_block = self.source.read()
+                if block is None:
+                    break
+
+                self.metrics.tick(clock.time(), t_block)
+                self.metrics.count('blocks')
+
+                time_A = clock.time()
+                events = self.detector.process(block)
+                self.metrics.observe('process_time', clock.time() - time_A)
+
+                t_stream = float(self.detector.num_samples) / self.sample_rate
+                for d in events:
+                    # Clock time of the onset, from the time its block finished arriving.
+                    t_onset = t_block - (t_stream - d[0])
+                    self.metrics.observe('latency', clock.time() - t_onset)
+                    if d[1] == 'beat':
+                        self.metrics.count('beats')
+                    else:
+                        self.metrics.count('onsets')
+
+                with self.lock:
+                    self.events.extend(events)
+                    self._timestamp = t_stream
+                self.tick.set()
+
+        except KeyboardInterrupt:
+            print('\nUser stop!')
+            self.stop()
+
+        self.source.close()
+        self.report()
+
+        self.is_finished = True
+        self.tick.set()
+        clock.detach()
+
+        # Done.
+
+
+    def report(self):
+        histogram = self.metrics.histograms.get('latency')
+        if histogram:
+            info = histogram.snapshot()
+            print('Detection latency: mean %.1f ms, max %.1f ms, %d events' %
+                  (info['mean'] * 1000., info['max'] * 1000., info['count']))
+
+
+    def start(self):
+        clock.attach()
+        threading.Thread.start(self)
+
+
+    def stop(self):
+        if self.is_alive():
+            print('Player stopping: %s' % self.fname)
+
+        self.is_running = False
+
+
+    def beats(self, idle=False):
+        """
+        Generator yielding audio events as they are detected, in the same form as
+        beats.Player.beats().  With idle set, also yield None on waking up with no
+        new events.
+        """
+        while True:
+            self.tick.clear()
+
+            with self.lock:
+                events = list(self.events)
+                self.events.clear()
+
+            for d in events:
+                yield d
+
+            if self.is_finished and not self.events:
+                return
+
+            self.tick.wait(self.time_interval)
+
+            if idle:
+                yield None
+
+        # Done.
+
+#################################################
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Print audio events detected live.')
+    parser.add_argument('fname', type=str, nargs='?', default=None,
+                        help='WAV file to play in as if live, or - for raw S16_LE on stdin.  '
+                             'Default is the audio input device.')
+    parser.add_argument('--rate', type=int, default=44100, help='Sample rate for raw input.')
+    parser.add_argument('--channels', type=int, default=2, help='Channels for raw input.')
+
+    args = parser.parse_args()
+
+    if args.fname == '-':
+        source = StreamSource(sys.stdin.buffer, args.rate, args.channels)
+    elif args.fname:
+        source = WavSource(args.fname)
+    else:
+        source = DeviceSource(args.rate, args.channels)
+
+    player = LivePlayer(source)
+    player.start()
+
+    try:
+        for d in player.beats():
+            if d[1] == 'beat':
+                print('[%7.3fs] beat' % d[0])
+            else:
+                print('[%7.3fs] segment  %6.1f dB  %5.2f' % (d[0], d[2][0], d[2][1]))
+    except KeyboardInterrupt:
+        player.stop()
+
+    player.join()
+
+    # Done.
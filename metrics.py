@@ -0,0 +1,334 @@
+"""
+Live runtime metrics for the servo loops, PWM boards and audio player.
+
+Each servo, servo bank, board writer and player owns a Metrics object holding simple
+counters, histograms and lock wait statistics.  The owning thread updates them as it
+runs.  Any other thread may call snapshot() at any time to get a plain dictionary copy
+of every registered object's current values, for example to tell whether a stutter
+came from a servo loop, the I2C bus or the audio thread.
+
+Counters used by the servo code:
+
+  - ticks: run loop iterations.
+  - writes: channel updates handed to the board writer.
+  - suppressed_dedupe: updates dropped because the PWM counts did not change.
+  - suppressed_deadband: updates dropped because the response moved less than eps.
+  - invalid: updates rejected for a width outside the range 0 to 1.
+  - deadline_misses: ticks starting later than tolerance after their deadline.
+
+Histogram values and lock wait times are in seconds.  Tick times come from the clock
+module, so they follow a VirtualClock when one is installed.  Lock wait times and board
+write times are always measured on the wall clock.
+
+"""
+
+import bisect
+import threading
+import time
+import weakref
+
+import numpy as np
+
+#################################################
+
+# Histogram bucket edges, seconds.
+EDGES = [0., 0.001, 0.002, 0.005, 0.010, 0.015, 0.020, 0.030, 0.050, 0.100, 0.200, 0.500,
+         1.0]
+
+
+class Histogram(object):
+    """
+    Counts of values falling between fixed bucket edges.  The last bucket holds
+    everything from the last edge upwards.
+    """
+
+    def __init__(self, edges=None):
+        if edges is None:
+            edges = EDGES
+
+        self.edges = list(edges)
+        self.counts = [0] * len(self.edges)
+        self.total = 0.
+        self.max = None
+
+
+    def add(self, value):
+        k = bisect.bisect_right(self.edges, value) - 1
+        if k < 0:
+            k = 0
+
+        self.counts[k] += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+
+    def snapshot(self):
+        counts = list(self.counts)
+        num = sum(counts)
+
+        info = {'edges': self.edges,
+                'counts': counts,
+                'count': num,
+                'max': self.max}
+        if num:
+            info['mean'] = self.total / num
+        else:
+            info['mean'] = None
+
+        # Done.
+        return info
+
+
+class Metrics(object):
+    """
+    Named collection of counters, histograms and lock wait statistics.
+    """
+
+    def __init__(self, name, counters=None):
+        """
+        Create metrics and add them to the registry.  The name is made unique by
+        appending a number if needed.
+        """
+        self.counters = dict((key, 0) for key in (counters or []))
+        self.histograms = {}
+
+        self.lock_waits = 0
+        self.lock_wait_total = 0.
+        self.lock_wait_max = 0.
+
+        self.name = register(name, self)
+
+
+    def count(self, key, n=1):
+        self.counters[key] = self.counters.get(key, 0) + n
+
+
+    def observe(self, key, value):
+        """
+        Add value to the named histogram.
+        """
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = Histogram()
+            self.histograms[key] = histogram
+
+        histogram.add(value)
+
+
+    def acquire(self, lock):
+        """
+        Acquire lock, recording how long the wait took.
+        """
+        time_A = time.time()
+        lock.acquire()
+        dt = time.time() - time_A
+
+        self.lock_waits += 1
+        self.lock_wait_total += dt
+        if dt > self.lock_wait_max:
+            self.lock_wait_max = dt
+
+
+    def snapshot(self):
+        """
+        Plain dictionary copy of current values.
+        """
+        histograms = list(self.histograms.items())
+        info = {'counters': dict(self.counters),
+                'histograms': dict((key, h.snapshot()) for key, h in histograms),
+                'lock_wait': {'count': self.lock_waits,
+                              'total': self.lock_wait_total,
+                              'max': self.lock_wait_max}}
+
+        # Done.
+        return info
+
+
+class LoopMetrics(Metrics):
+    """
+    Metrics for a periodic loop: tick count, tick interval histogram and deadline misses.
+    These are updated on every tick, so are kept in plain attributes rather than looked
+    up by name, and only merged into the counters by snapshot().
+    """
+
+    def __init__(self, name, tolerance=None, counters=None):
+        """
+        A tick starting more than tolerance seconds after its deadline counts as a miss.
+        """
+        if tolerance is None:
+            tolerance = 0.005
+
+        Metrics.__init__(self, name, counters)
+
+        self.tolerance = tolerance
+        self.ticks = 0
+        self.deadline_misses = 0
+        self.time_tick = None
+        self.late_max = 0.
+
+        self.intervals = Histogram()
+        self.histograms['tick_interval'] = self.intervals
+
+
+    def tick(self, t, deadline=None):
+        """
+        Record the start of a tick at time t, due at the given deadline if any.
+        """
+        self.ticks += 1
+
+        if self.time_tick is not None:
+            self.intervals.add(t - self.time_tick)
+        self.time_tick = t
+
+        if deadline is not None:
+            late = t - deadline
+            if late > self.late_max:
+                self.late_max = late
+            if late > self.tolerance:
+                self.deadline_misses += 1
+
+
+    def snapshot(self):
+        info = Metrics.snapshot(self)
+        info['counters']['ticks'] = self.ticks
+        info['counters']['deadline_misses'] = self.deadline_misses
+        info['late_max'] = self.late_max
+
+        # Done.
+        return info
+
+
+class BankMetrics(LoopMetrics):
+    """
+    Loop metrics for a ServoBank, plus per-channel write counters.  Each step counts the
+    channels written, the channels that moved and any with invalid widths, in one
+    array with a row per count and a column per channel.  The rest follow from those:
+    a channel that moved without being written had its update dropped as a duplicate,
+    and one that did none of these was inside the deadband.
+    """
+
+    CHANNEL_COUNTERS = ['writes', 'suppressed_dedupe', 'suppressed_deadband', 'invalid']
+
+    def __init__(self, name, tolerance=None):
+        LoopMetrics.__init__(self, name, tolerance)
+
+        self.steps = 0
+        self.channels = []
+        self.channel_steps = np.zeros(0, dtype=np.int64)
+        self.channel_counts = np.zeros((3, 0), dtype=np.int64)
+
+
+    def add_channel(self, channel):
+        self.channels.append(channel)
+        self.channel_steps = np.append(self.channel_steps, self.steps)
+        self.channel_counts = np.append(self.channel_counts, np.zeros((3, 1), dtype=np.int64),
+                                        axis=1)
+
+
+    def count_channels(self, writes, moves, invalid=None):
+        """
+        Count one step, given boolean masks of the channels written, those that moved,
+        including the ones written, and those with invalid widths, if any.
+        """
+        self.steps += 1
+
+        counts = self.channel_counts
+        counts[0] += writes
+        counts[1] += moves
+        if invalid is not None:
+            counts[2] += invalid
+
+
+    def snapshot(self):
+        info = LoopMetrics.snapshot(self)
+
+        writes, moves, invalid = self.channel_counts.copy()
+        steps = self.steps - self.channel_steps[:len(writes)]
+        values = [writes, moves - writes, steps - moves - invalid, invalid]
+
+        for key, row in zip(self.CHANNEL_COUNTERS, values):
+            info['counters'][key] = int(row.sum())
+
+        info['channels'] = dict((channel, dict((key, int(row[k]))
+                                               for key, row in zip(self.CHANNEL_COUNTERS, values)))
+                                for k, channel in enumerate(list(self.channels)[:len(writes)]))
+
+        # Done.
+        return info
+
+
+class WriterMetrics(Metrics):
+    """
+    Metrics for a board writer, updated on every flush, so kept in plain attributes and
+    merged into the counters by snapshot().
+    """
+
+    COUNTERS = ['flushes', 'transactions', 'bytes', 'channels_written', 'suppressed_shadow']
+
+    def __init__(self, name):
+        Metrics.__init__(self, name)
+
+        self.flushes = 0
+        self.transactions = 0
+        self.bytes = 0
+        self.channels_written = 0
+        self.suppressed_shadow = 0
+
+        self.write_times = Histogram()
+        self.histograms['write_time'] = self.write_times
+
+
+    def flush(self, transactions, num_bytes, channels_written, suppressed_shadow):
+        """
+        Record one flush.
+        """
+        self.flushes += 1
+        self.transactions += transactions
+        self.bytes += num_bytes
+        self.channels_written += channels_written
+        self.suppressed_shadow += suppressed_shadow
+
+
+    def snapshot(self):
+        info = Metrics.snapshot(self)
+        for key in self.COUNTERS:
+            info['counters'][key] = getattr(self, key)
+
+        # Done.
+        return info
+
+#################################################
+
+# Live metrics objects by name.  Entries vanish when their owner is garbage collected.
+registry = weakref.WeakValueDictionary()
+registry_lock = threading.Lock()
+
+
+def register(name, metrics):
+    """
+    Add metrics to the registry under a unique name based on the one given.  Returns the
+    name used.
+    """
+    with registry_lock:
+        key = name
+        k = 1
+        while key in registry:
+            k += 1
+            key = '%s#%d' % (name, k)
+
+        registry[key] = metrics
+
+    # Done.
+    return key
+
+
+def snapshot():
+    """
+    Current values of every registered metrics object, keyed by name.
+    """
+    with registry_lock:
+        items = list(registry.items())
+
+    # Done.
+    return dict((name, m.snapshot()) for name, m in sorted(items))
@@ -0,0 +1,384 @@
+"""
+Low level helpers for talking to the PCA9685 PWM board.
+
+The Adafruit library writes each servo update as four separate single-register I2C
+transactions.  The BurstWriter class below instead collects all channel updates made
+during one tick and flushes them as auto-increment block writes spanning contiguous
+LEDn registers.  Channels that have no updated neighbours still get a single 4-byte
+block write.
+
+FakeI2C is an in-memory stand-in for Adafruit_I2C.  It keeps a copy of the register
+contents and counts transactions and bytes so bus usage can be checked without the
+real board attached.
+
+Boards are opened through get_board(), which keeps a process-wide registry keyed by
+I2C bus and address.  Each board is reset and has its PWM frequency set exactly once,
+no matter how many servos share it.
+
+"""
+
+import os
+import sys
+import threading
+import time
+
+import clock
+import metrics
+
+path_adafruit = '../Adafruit-Raspberry-Pi-Python-Code/Adafruit_PWM_Servo_Driver'
+sys.path.append(os.path.abspath(path_adafruit))
+
+try:
+    import Adafruit_I2C
+except ImportError:
+    Adafruit_I2C = None
+
+###############################################
+
+MODE1 = 0x00
+MODE1_RESTART = 0x80
+MODE1_AI = 0x20
+MODE1_SLEEP = 0x10
+PRESCALE = 0xFE
+LED0_ON_L = 0x06
+
+ADDRESS = 0x40
+FREQ = 50.  # Hz
+OSCILLATOR = 25000000.  # Hz
+
+NUM_CHANNELS = 16
+BYTES_PER_CHANNEL = 4
+
+# SMBus limits block writes to 32 data bytes.
+BLOCK_SIZE = 32
+
+###############################################
+
+
+class FakeI2C(object):
+    """
+    In-memory replacement for Adafruit_I2C.  Counts transactions and bytes sent over
+    the bus.  Byte counts include the register byte but not the address byte.
+    """
+
+    def __init__(self, address=ADDRESS, busnum=None):
+        self.address = address
+        self.busnum = busnum
+        self.registers = bytearray(256)
+
+        self.transactions = 0
+        self.bytes = 0
+
+
+    def reset_counts(self):
+        self.transactions = 0
+        self.bytes = 0
+
+
+    def write8(self, reg, value):
+        """
+        Write a single byte to a register.
+        """
+        self.registers[reg] = value & 0xFF
+
+        self.transactions += 1
+        self.bytes += 2
+
+
+    def writeList(self, reg, data):
+        """
+        Block write.  Register address only advances when auto-increment is enabled,
+        same as the real chip.
+        """
+        auto_increment = self.registers[MODE1] & MODE1_AI
+        for k, value in enumerate(data):
+            if auto_increment:
+                self.registers[reg + k] = value & 0xFF
+            else:
+                self.registers[reg] = value & 0xFF
+
+        self.transactions += 1
+        self.bytes += 1 + len(data)
+
+
+    def readU8(self, reg):
+        """
+        Read a single byte from a register.
+        """
+        self.transactions += 1
+        self.bytes += 1
+
+        return self.registers[reg]
+
+
+    def channel(self, channel):
+        """
+        Return (on, off) counts currently stored for a channel.
+        """
+        k = LED0_ON_L + BYTES_PER_CHANNEL*channel
+        r = self.registers
+
+        on = r[k] | (r[k+1] << 8)
+        off = r[k+2] | (r[k+3] << 8)
+
+        # Done.
+        return on, off
+
+###############################################
+
+
+def channel_bytes(on, off):
+    """
+    Register contents for one channel, in LEDn_ON_L .. LEDn_OFF_H order.
+    """
+    return [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+
+
+def channel_runs(channels):
+    """
+    Split channel numbers into runs of contiguous channels, each run small enough to
+    fit inside a single block write.
+    """
+    per_block = BLOCK_SIZE // BYTES_PER_CHANNEL
+
+    runs = []
+    for c in sorted(channels):
+        if runs and c == runs[-1][-1] + 1 and len(runs[-1]) < per_block:
+            runs[-1].append(c)
+        else:
+            runs.append([c])
+
+    # Done.
+    return runs
+
+
+class BurstWriter(object):
+    """
+    Collect channel updates and write them to the board in as few I2C transactions as
+    possible.  Call set() for each changed channel during a tick, then flush() once.
+    """
+
+    def __init__(self, i2c):
+        """
+        Wrap an Adafruit_I2C compatible device and enable register auto-increment.
+        """
+        self.i2c = i2c
+        self.lock = threading.Lock()
+        self.bus_lock = threading.Lock()
+        self.pending = {}
+
+        address = getattr(i2c, 'address', None)
+        if address is None:
+            name = 'board'
+        else:
+            name = 'board.0x%02x' % address
+        self.metrics = metrics.WriterMetrics(name)
+
+        # Shadow copy of (on, off) counts last written to each channel.
+        self.shadow = [None] * NUM_CHANNELS
+
+        mode = self.i2c.readU8(MODE1)
+        if not mode & MODE1_AI:
+            self.i2c.write8(MODE1, (mode & ~MODE1_RESTART) | MODE1_AI)
+
+
+    def set(self, channel, on, off):
+        """
+        Queue new on/off counts for a channel.  Later updates to the same channel
+        within a tick replace earlier ones.
+        """
+        with self.lock:
+            self.pending[channel] = (on, off)
+
+
+    def flush(self):
+        """
+        Write all queued updates.  Returns the number of I2C transactions used.
+        """
+        self.metrics.acquire(self.bus_lock)
+        try:
+            with self.lock:
+                pending = self.pending
+                self.pending = {}
+
+            num = len(pending)
+            for c in list(pending):
+                if pending[c] == self.shadow[c]:
+                    del pending[c]
+                else:
+                    self.shadow[c] = pending[c]
+
+            time_A = time.time()
+            num_bytes = 0
+            runs = channel_runs(pending)
+            for run in runs:
+                data = []
+                for c in run:
+                    data.extend(channel_bytes(*pending[c]))
+
+                self.i2c.writeList(LED0_ON_L + BYTES_PER_CHANNEL*run[0], data)
+                num_bytes += len(data) + 1
+
+            if runs:
+                self.metrics.write_times.add(time.time() - time_A)
+
+            self.metrics.flush(len(runs), num_bytes, len(pending), num - len(pending))
+
+        finally:
+            self.bus_lock.release()
+
+        # Done.
+        return len(runs)
+
+###############################################
+
+
+def open_i2c(address, busnum=None):
+    """
+    Open the I2C device for a real board through the Adafruit library.
+    """
+    if Adafruit_I2C is None:
+        raise IOError('Adafruit I2C library not found: %s' % path_adafruit)
+
+    if busnum is None:
+        busnum = -1
+
+    # Done.
+    return Adafruit_I2C.Adafruit_I2C(address, busnum)
+
+
+class Board(object):
+    """
+    A single PCA9685 board.  Holds the I2C device, a burst writer shared by every servo
+    on the board, and timing details from board initialization.
+    Use get_board() rather than creating instances directly.
+    """
+
+    def __init__(self, address=None, busnum=None, freq=None, factory=None):
+        """
+        Open and initialize the board: reset, set PWM frequency and enable register
+        auto-increment.
+        """
+        if address is None:
+            address = ADDRESS
+        if not freq:
+            freq = FREQ
+        if not factory:
+            factory = open_i2c
+
+        self.address = address
+        self.busnum = busnum
+        self.freq = freq
+
+        time_A = clock.time()
+        self.i2c = factory(address, busnum)
+
+        time_B = clock.time()
+        self.i2c.write8(MODE1, 0x00)
+        self.set_freq(freq)
+
+        time_C = clock.time()
+        self.writer = BurstWriter(self.i2c)
+
+        time_D = clock.time()
+        self.timing = {'open': time_B - time_A,
+                       'freq': time_C - time_B,
+                       'writer': time_D - time_C,
+                       'total': time_D - time_A}
+
+
+    def set_freq(self, freq):
+        """
+        Set PWM frequency.  Same sequence as the Adafruit library's setPWMFreq.
+        """
+        prescale = int(OSCILLATOR / 4096. / freq - 1. + 0.5)
+
+        mode = self.i2c.readU8(MODE1)
+        self.i2c.write8(MODE1, (mode & 0x7F) | MODE1_SLEEP)
+        self.i2c.write8(PRESCALE, prescale)
+        self.i2c.write8(MODE1, mode)
+        clock.sleep(0.005)
+        self.i2c.write8(MODE1, mode | MODE1_RESTART)
+
+        self.freq = freq
+
+
+    @property
+    def shadow(self):
+        return self.writer.shadow
+
+
+boards = {}
+boards_lock = threading.Lock()
+board_locks = {}
+
+
+def get_board(address=None, busnum=None, freq=None, factory=None):
+    """
+    Return the shared Board for the given bus and address, initializing it on first use.
+    Boards on different addresses may be initialized concurrently from several threads.
+    """
+    if address is None:
+        address = ADDRESS
+
+    key = (busnum, address)
+    with boards_lock:
+        if key in boards:
+            return boards[key]
+        lock = board_locks.setdefault(key, threading.Lock())
+
+    with lock:
+        with boards_lock:
+            if key in boards:
+                return boards[key]
+
+        board = Board(address, busnum, freq=freq, factory=factory)
+
+        with boards_lock:
+            boards[key] = board
+
+    # Done.
+    return board
+
+
+def open_boards(addresses, busnum=None, freq=None, factory=None):
+    """
+    Initialize several boards in parallel, one thread per board.  Returns list of Boards
+    in the same order as the supplied addresses.
+    """
+    errors = []
+
+    def work(address):
+        try:
+            get_board(address, busnum, freq=freq, factory=factory)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(a,)) for a in addresses]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+    # Done.
+    return [get_board(a, busnum) for a in addresses]
+
+
+def startup_times():
+    """
+    Board initialization timing details, keyed by (busnum, address).
+    """
+    with boards_lock:
+        return dict((key, board.timing) for key, board in boards.items())
+
+
+def close_boards():
+    """
+    Forget all registered boards.  Next call to get_board() initializes them afresh.
+    """
+    with boards_lock:
+        boards.clear()
+        board_locks.clear()
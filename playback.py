@@ -0,0 +1,283 @@
+"""
+Playback position of audio sent to an output device.
+
+Audio written to a device is heard once everything written before it has played out of
+the device buffer, and then the converter, amplifier and speaker have passed it on.
+PlaybackClock anchors the position in the song to the device's own report of how much
+written audio is still to be played, its output delay, after every write, and runs on
+the clock in between, so the position is good to well under a chunk at any moment.
+Small differences between successive reports are smoothed, and a large one, after an
+underrun or a pause, restarts the clock.
+
+The delay past the device buffer is not reported by the device.  calibrate() measures
+it by playing clicks and listening for them with an audio input, such as a microphone
+in front of the speaker or a cable looped back from the output, and save_latency()
+keeps the result for beats.Player to use from then on.
+
+    python playback.py --calibrate
+
+"""
+
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+
+import cache
+import clock
+import sinks
+
+#################################################
+
+FNAME_CALIBRATION = os.path.join(cache.PATH_DEFAULT, 'playback.json')
+
+GAIN = 0.1             # Weight of each new delay report against the running clock.
+RESYNC = 0.01          # Seconds off the running clock to restart it instead.
+MIN_WAIT = 1.e-6       # Shortest wait for a position, so virtual time moves on.
+
+CLICKS = 8             # Calibration clicks.
+CLICK_PERIOD = 0.5     # Seconds between clicks.
+CLICK_TIME = 0.002     # Click duration, seconds.
+THRESHOLD = 0.25       # Fraction of the loudest input heard that counts as a click.
+
+
+class PlaybackClock(object):
+    """
+    Position in the audio being heard, in seconds from the start, interpolated on the
+    clock between updates from the device.  Latency is the delay past the device buffer.
+    """
+
+    def __init__(self, sample_rate, latency=None):
+        if latency is None:
+            latency = 0.
+
+        self.sample_rate = sample_rate
+        self.latency = latency
+
+        self.lock = threading.Lock()
+        self.t_ref = None
+        self.position_ref = None
+        self.position_end = None
+        self.position_last = None
+
+        # Done.
+
+
+    def update(self, frames_written, frames_delay):
+        """
+        Anchor the clock just after a write, given the total frames written so far and
+        the device's output delay.
+        """
+        t = clock.time()
+        end = float(frames_written) / self.sample_rate - self.latency
+        position = end - float(frames_delay) / self.sample_rate
+
+        with self.lock:
+            if self.t_ref is not None:
+                predicted = min(self.position_ref + t - self.t_ref, self.position_end)
+                error = position - predicted
+                if abs(error) < RESYNC:
+                    position = predicted + GAIN * error
+
+            self.t_ref = t
+            self.position_ref = position
+            self.position_end = end
+
+        # Done.
+
+
+    def position(self, t=None):
+        """
+        Position at clock time t, default now, or None before the first update.  Never
+        runs backwards, nor past the end of the audio written.
+        """
+        with self.lock:
+            if self.t_ref is None:
+                return None
+            if t is None:
+                t = clock.time()
+
+            position = min(self.position_ref + t - self.t_ref, self.position_end)
+            if self.position_last is not None:
+                position = max(position, self.position_last)
+            self.position_last = position
+
+        # Done.
+        return position
+
+
+    def wait_time(self, position):
+        """
+        Clock time until a position is reached, assuming playback carries on.
+        """
+        current = self.position()
+        if current is None:
+            return None
+
+        # Done.
+        return max(position - current, MIN_WAIT)
+
+#################################################
+
+
+def click_track(sample_rate, num_channels, clicks=None, period=None):
+    """
+    Silence with a short full scale click every period seconds, starting one period
+    in.  Returns samples shaped (num_frames, num_channels) and the click times.
+    """
+    if not clicks:
+        clicks = CLICKS
+    if not period:
+        period = CLICK_PERIOD
+
+    data = np.zeros((int((clicks + 1) * period * sample_rate), num_channels), dtype=np.int16)
+    times = period * np.arange(1, clicks + 1)
+
+    width = max(int(CLICK_TIME * sample_rate), 1)
+    for t in times:
+        k = int(round(t * sample_rate))
+        data[k:k + width] = 30000
+
+    # Done.
+    return data, times
+
+
+def calibrate(device, source, chunk_time=None):
+    """
+    Measure the output latency not reported by the device, in seconds.  Plays a click
+    track on the device, a sink from the sinks module set up for source's sample rate
+    and channels, while listening with source, in the form of the live module's sources.  Each click's
+    latency is the time it is heard less the time PlaybackClock, with no latency, says
+    it was played.  The input's own delay is included, so use one with short blocks.
+    """
+    if not chunk_time:
+        chunk_time = 0.02
+
+    sample_rate = source.sample_rate
+    data, click_times = click_track(sample_rate, source.num_channels)
+    chunk_size = int(chunk_time * sample_rate)
+
+    playback = PlaybackClock(sample_rate)
+    anchors = []
+
+    def play():
+        for k0 in range(0, len(data), chunk_size):
+            k1 = min(k0 + chunk_size, len(data))
+            sinks.write_all(device, data[k0:k1], chunk_time)
+            playback.update(k1, device.odelay())
+            anchors.append((playback.t_ref, playback.position_ref))
+
+        clock.detach()
+
+    source.open()
+    clock.attach()
+    thread = threading.Thread(target=play)
+    thread.start()
+
+    # Listen until the last click has had time to come through.
+    blocks = []
+    t_end = None
+    while True:
+        block, t = source.read()
+        if block is None:
+            break
+        blocks.append((block, t))
+
+        if not thread.is_alive() and t_end is None:
+            t_end = t + CLICK_PERIOD
+        if t_end is not None and t > t_end:
+            break
+
+    source.close()
+
+    # Time each input sample was heard.
+    times = []
+    for block, t in blocks:
+        times.append(t - np.arange(len(block))[::-1] / float(sample_rate))
+    times = np.concatenate(times)
+    level = np.abs(np.concatenate([block for block, t in blocks]).astype(float)).max(axis=1)
+
+    # Click onsets: first loud sample after a quiet spell.
+    loud = np.nonzero(level > THRESHOLD * level.max())[0]
+    if not len(loud) or not level.max():
+        raise IOError('No clicks heard by %s' % source.name)
+
+    gap = np.diff(times[loud]) > CLICK_PERIOD / 2.
+    heard = times[loud[np.concatenate([[True], gap])]]
+
+    # Clock time each click was played, from the playback anchors.
+    t_anchor, position_anchor = np.array(anchors).T
+    latency = []
+    for t_click in click_times:
+        k = max(np.searchsorted(position_anchor, t_click) - 1, 0)
+        t_played = t_anchor[k] + t_click - position_anchor[k]
+        near = heard[np.abs(heard - t_played) < CLICK_PERIOD / 2.]
+        if len(near):
+            latency.append(near[0] - t_played)
+
+    if len(latency) < len(click_times) // 2:
+        raise IOError('Only %d of %d clicks heard' % (len(latency), len(click_times)))
+
+    # Done.
+    return float(np.median(latency))
+
+
+def save_latency(latency, fname=None):
+    if not fname:
+        fname = FNAME_CALIBRATION
+
+    path = os.path.dirname(fname)
+    if path:
+        os.makedirs(path, exist_ok=True)
+
+    text = json.dumps({'latency': latency})
+    cache.replace_atomic(fname, lambda f: f.write(text.encode('utf-8')))
+
+    # Done.
+
+
+def load_latency(fname=None):
+    """
+    Latency stored by calibration, or zero if not calibrated.
+    """
+    if not fname:
+        fname = FNAME_CALIBRATION
+
+    try:
+        with open(fname) as f:
+            return float(json.load(f)['latency'])
+    except (IOError, OSError, ValueError, KeyError):
+        return 0.
+
+#################################################
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measure audio output latency.')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='Play clicks and listen with the audio input.')
+    parser.add_argument('--sample-rate', type=int, default=44100, help='Sample rate.')
+    parser.add_argument('--fname', type=str, default=None,
+                        help='Calibration file, default %s.' % FNAME_CALIBRATION)
+
+    args = parser.parse_args()
+
+    if args.calibrate:
+        import live
+
+        source = live.DeviceSource(args.sample_rate, 2, block_size=64)
+        device = sinks.OssSink()
+        device.setparameters(sinks.AFMT_S16_LE, 2, args.sample_rate)
+
+        latency = calibrate(device, source)
+        device.close()
+
+        save_latency(latency, args.fname)
+        print('Latency: %.1f ms' % (latency * 1000.))
+    else:
+        print('Latency: %.1f ms' % (load_latency(args.fname) * 1000.))
+
+    # Done.
@@ -0,0 +1,138 @@
+"""
+Closed form motion profiles.
+
+Each function here evaluates a servo's position directly from the time and the state
+captured when the target last changed, so positions may be computed at any time
+without iterating.  All functions accept NumPy arrays and broadcast, so a single call
+evaluates many servos over many times.  For example times shaped (num_times, 1) with
+per-servo parameters shaped (num_servos,) return positions shaped
+(num_times, num_servos).
+
+  - first_order: exponential approach used by the original Response class.
+  - critical: critically damped second order system.  Starts with continuous velocity
+    and never overshoots when starting from rest.
+  - trapezoid: velocity and acceleration limited move.  Planned once per target
+    change by plan_trapezoid() as a list of constant-acceleration segments.
+
+"""
+
+import numpy as np
+
+#################################################
+
+
+def first_order(t, t_set, y_ref, y_set, scale):
+    """
+    First order exponential response.
+    """
+    dt = np.maximum(t - t_set, 0.)
+    frac = 1. - np.exp(-dt/scale)
+
+    # Done.
+    return y_ref + (y_set - y_ref)*frac
+
+
+def critical(t, t_set, y_ref, v_ref, y_set, scale):
+    """
+    Critically damped second order response with time constant scale.  Starts from
+    position y_ref with velocity v_ref at time t_set.  Returns position and velocity.
+    """
+    dt = np.maximum(t - t_set, 0.)
+    decay = np.exp(-dt/scale)
+
+    e0 = y_ref - y_set
+    c = v_ref + e0/scale
+
+    y = y_set + (e0 + c*dt)*decay
+    v = (v_ref - c*dt/scale)*decay
+
+    # Done.
+    return y, v
+
+#################################################
+
+# Segments per trapezoid plan: brake, accelerate, cruise, decelerate, hold.
+NUM_SEGMENTS = 5
+
+
+def plan_trapezoid(t0, y0, v0, y1, vmax, amax):
+    """
+    Plan a velocity and acceleration limited move from position y0 with velocity v0 to
+    rest at y1.  Returns four arrays (start time, position, velocity, acceleration)
+    describing NUM_SEGMENTS constant-acceleration segments.  Unused segments have zero
+    duration.
+    """
+    starts = [t0]
+    ys = [y0]
+    vs = [v0]
+    accs = []
+
+    def add(acc, duration):
+        y = ys[-1] + vs[-1]*duration + 0.5*acc*duration**2
+        v = vs[-1] + acc*duration
+
+        accs.append(acc)
+        starts.append(starts[-1] + duration)
+        ys.append(y)
+        vs.append(v)
+
+    # Brake to rest first if moving away from the target, or too fast to stop in time.
+    d = y1 - y0
+    stop = v0*abs(v0) / (2.*amax)
+    if v0*d < 0 or abs(stop) > abs(d):
+        add(-np.sign(v0)*amax, abs(v0)/amax)
+    else:
+        add(0., 0.)
+
+    # Accelerate towards the target, cruise, then decelerate to rest.
+    d = y1 - ys[-1]
+    s = np.sign(d)
+    u0 = abs(vs[-1])
+    vp = min(vmax, np.sqrt(amax*abs(d) + 0.5*u0**2))
+
+    t_acc = abs(vp - u0) / amax
+    t_dec = vp / amax
+    d_acc = 0.5*(vp + u0)*t_acc
+    d_dec = 0.5*vp*t_dec
+
+    if vp > 0:
+        t_cruise = max(abs(d) - d_acc - d_dec, 0.) / vp
+    else:
+        t_cruise = 0.
+
+    add(s*np.sign(vp - u0)*amax, t_acc)
+    add(0., t_cruise)
+    add(-s*amax, t_dec)
+
+    # Hold at rest on the target.
+    accs.append(0.)
+    ys[-1] = y1
+    vs[-1] = 0.
+
+    # Done.
+    return np.array(starts), np.array(ys), np.array(vs), np.array(accs)
+
+
+def trapezoid(t, starts, ys, vs, accs):
+    """
+    Evaluate planned trapezoid moves.  Plan arrays have shape (..., NUM_SEGMENTS) and
+    t broadcasts against the leading dimensions.  Returns position and velocity.
+    """
+    t = np.asarray(t, dtype=float)[..., np.newaxis]
+
+    durations = np.diff(starts, axis=-1)
+    durations = np.concatenate([durations, np.inf + 0.*durations[..., :1]], axis=-1)
+
+    # Time spent so far within each segment.
+    tau = np.clip(t - starts, 0., durations)
+
+    y = ys[..., 0] + np.sum(vs*tau + 0.5*accs*tau**2, axis=-1)
+    v = vs[..., 0] + np.sum(accs*tau, axis=-1)
+
+    # Once the move is over, rest exactly on the target rather than on the rounded sum.
+    done = t[..., 0] >= starts[..., -1]
+    y = np.where(done, ys[..., -1], y)
+    v = np.where(done, 0., v)
+
+    # Done.
+    return y, v
@@ -0,0 +1,324 @@
+"""
+Simulated hardware for running a complete show without the Raspberry Pi rig.
+
+SimGPIO stands in for the RPIO module, SimAudioDevice for the audio output device,
+and the PCA9685 board is replaced by pca9685.FakeI2C.  run_show() ties these together
+with a synthetic song and runs the whole lego.Controller show (intro, main dance and
+finish) on a clock.VirtualClock, much faster than real time.
+
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import beats
+import clock
+import damped_servo
+import engine
+import lego
+import metrics
+import pca9685
+import sinks
+import tempo
+
+#################################################
+
+
+class SimGPIO(object):
+    """
+    Stand-in for the RPIO module.  Records LED output changes and lets buttons be
+    pressed from code.
+    """
+
+    OUT = 0
+    IN = 1
+    PUD_UP = 22
+
+    def __init__(self):
+        self.pins = {}
+        self.callbacks = {}
+        self.log = []
+
+
+    def setup(self, pin, direction):
+        self.pins[pin] = False
+
+
+    def output(self, pin, value):
+        self.pins[pin] = value
+        self.log.append((clock.time(), pin, value))
+
+
+    def add_interrupt_callback(self, pin, callback, edge='both', pull_up_down=None,
+                               threaded_callback=False, debounce_timeout_ms=None):
+        self.callbacks.setdefault(pin, []).append(callback)
+
+
+    def wait_for_interrupts(self, threaded=False):
+        pass
+
+
+    def press(self, pin):
+        """
+        Simulate a button press.  Callbacks run in the calling thread.
+        """
+        for callback in self.callbacks.get(pin, []):
+            callback(pin, 0)
+
+
+    def cleanup(self):
+        self.callbacks = {}
+
+
+class SimAudioDevice(sinks.NullSink):
+    """
+    Stand-in for the audio output device: a sinks.NullSink that keeps count of what is
+    written.  With record set, written samples are kept so that SimMicrophone can hear
+    them.
+    """
+
+    def __init__(self, buffer_size=None, latency=None, record=False):
+        sinks.NullSink.__init__(self, buffer_size, latency)
+
+        self.record = record
+        self.chunks = []
+
+
+    def consume(self, data):
+        if self.record:
+            self.chunks.append(bytes(data))
+
+
+class SimMicrophone(object):
+    """
+    Audio input hearing a recording SimAudioDevice, in the form of the live module's
+    sources.  Each read returns the block of sound heard since the last.
+    """
+
+    def __init__(self, device, block_size=None):
+        if not block_size:
+            block_size = 256
+
+        self.name = 'simulated microphone'
+        self.device = device
+        self.block_size = block_size
+        self.sample_rate = device.sample_rate
+        self.num_channels = device.num_channels
+
+        self.k0 = 0
+
+        # Samples written but not yet heard, from frame k_pending on.
+        self.pending = np.zeros((0, self.num_channels), dtype=np.int16)
+        self.k_pending = 0
+        self.num_chunks = 0
+
+
+    def open(self):
+        self.k0 = int(round(self.device.position() * self.sample_rate))
+
+
+    def read(self):
+        clock.sleep(float(self.block_size) / self.sample_rate)
+        t = clock.time()
+        if self.device.closed:
+            return None, t
+
+        k1 = int(round(self.device.position() * self.sample_rate))
+
+        chunks = self.device.chunks[self.num_chunks:]
+        self.num_chunks += len(chunks)
+        if chunks:
+            chunks = [np.frombuffer(c, dtype='<i2').reshape(-1, self.num_channels)
+                      for c in chunks]
+            self.pending = np.concatenate([self.pending] + chunks)
+
+        # Silence before playback started.
+        data = np.zeros((max(k1 - self.k0, 0), self.num_channels), dtype=np.int16)
+        k = np.arange(self.k0, k1) - self.k_pending
+        ok = (k >= 0) & (k < len(self.pending))
+        data[ok] = self.pending[k[ok]]
+
+        drop = min(max(k1 - self.k_pending, 0), len(self.pending))
+        self.pending = self.pending[drop:]
+        self.k_pending += drop
+        self.k0 = max(k1, self.k0)
+
+        # Done.
+        return data, t
+
+
+    def close(self):
+        pass
+
+#################################################
+
+
+def make_song(path, duration=None, bpm=None, sample_rate=None, seed=None):
+    """
+    Write a silent WAV file and make up matching analysis results.  Returns the file
+    name and a (beats, segments) tuple as from beats.analyze_song().
+    """
+    if not duration:
+        duration = 30.
+    if not bpm:
+        bpm = 115.97
+    if not sample_rate:
+        sample_rate = 22050
+    if seed is None:
+        seed = 0
+
+    rng = np.random.RandomState(seed)
+
+    fname = os.path.join(path, 'sim_song.wav')
+    data = np.zeros((int(duration * sample_rate), 2), dtype=np.int16)
+    beats.write_wav(fname, data, sample_rate)
+
+    beat_times = np.arange(0.5, duration - 1., 60. / bpm)
+
+    t = np.sort(rng.uniform(0.5, duration - 1., int(duration * 4)))
+    p = rng.uniform(-30., -5., len(t))
+    v = rng.uniform(0.2, 1.2, len(t))
+    segments = np.column_stack([t, p, v])
+
+    # Done.
+    return fname, (beat_times, segments)
+
+
+def make_controller(path_work, duration=None, bpm=None, model=None, lead=None):
+    """
+    Set up a lego.Controller on simulated hardware, configured like lego.py's own
+    example.  The fake PCA9685 board must already be registered.  Returns controller,
+    GPIO and audio device.  With lead set, the controller dances on predicted beats
+    that many seconds early.
+    """
+    fname, analysis = make_song(path_work, duration, bpm)
+
+    gpio = SimGPIO()
+    audio_device = SimAudioDevice()
+    player = beats.Player(fname, latency=audio_device.latency, audio_device=audio_device,
+                          analysis=analysis)
+
+    if not model:
+        model = 'critical'
+
+    bpm = tempo.estimate_bpm(analysis[0])
+    s = 60. / bpm / damped_servo.settle_time(model, 1.)
+
+    predictor = None
+    if lead is not None:
+        predictor = tempo.BeatPredictor(bpm)
+    lohi = [[0.7, 1.0],
+            [0.0, 1.0],
+            [0.0, 0.8],
+            [0.0, 0.8],
+            [0.0, 0.8]]
+
+    controller = lego.Controller(15, s*1.0,
+                                 14, s*1.0,
+                                 0, s*2.2,
+                                 2, s*2.2,
+                                 3, s*2.2,
+                                 channel_lohi=lohi,
+                                 model=model,
+                                 gpio=gpio,
+                                 player=player,
+                                 predictor=predictor,
+                                 lead=lead)
+
+    # Done.
+    return controller, gpio, audio_device
+
+
+def run_show(duration=None, bpm=None, model=None, timeline=False, use_engine=False,
+             lead=None):
+    """
+    Run a complete show in virtual time.  Returns dictionary of statistics.
+    With use_engine the show runs on a single engine.Engine event loop instead of
+    threads.  Timelines are only available in threaded mode.
+    """
+    if timeline and use_engine:
+        raise ValueError('Timeline playback does not run on the engine')
+
+    path_work = tempfile.mkdtemp()
+
+    clock_virtual = clock.VirtualClock()
+    clock_previous = clock.install(clock_virtual)
+
+    pca9685.close_boards()
+    board = pca9685.get_board(factory=pca9685.FakeI2C)
+
+    try:
+        controller, gpio, audio_device = make_controller(path_work, duration, bpm, model,
+                                                         lead)
+        player = controller.player
+
+        time_A = time.time()
+
+        if use_engine:
+            controller.engine = engine.Engine(clock_virtual)
+            controller.engine.run(controller.show_async())
+            controller.engine.close()
+        else:
+            controller.turn_on()
+            controller.intro()
+            if timeline:
+                controller.main_timeline(path_cache=os.path.join(path_work, 'Timelines'))
+            else:
+                controller.main_dance()
+            controller.finish()
+            controller.turn_off()
+
+            # Let background threads wind down in virtual time.
+            while controller.bank.is_alive() or player.is_alive():
+                clock.sleep(0.01)
+
+        time_B = time.time()
+        snapshot = metrics.snapshot()
+
+    finally:
+        clock.install(clock_previous)
+        pca9685.close_boards()
+        shutil.rmtree(path_work)
+
+    time_wall = time_B - time_A
+    time_virtual = clock_virtual.now
+
+    results = {'time_virtual': time_virtual,
+               'time_wall': time_wall,
+               'speedup': time_virtual / max(time_wall, 1.e-6),
+               'i2c_transactions': board.i2c.transactions,
+               'i2c_bytes': board.i2c.bytes,
+               'led_changes': len(gpio.log),
+               'audio_bytes': audio_device.bytes_written,
+               'metrics': snapshot}
+
+    # Done.
+    return results
+
+#################################################
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run a simulated show in virtual time.')
+    parser.add_argument('--duration', type=float, default=30., help='Song duration, seconds.')
+    parser.add_argument('--model', type=str, default=None, choices=damped_servo.MODELS,
+                        help='Servo response model, default critical.')
+    parser.add_argument('--timeline', action='store_true', help='Play a compiled timeline.')
+    parser.add_argument('--engine', action='store_true', help='Run on one event loop.')
+    parser.add_argument('--lead', type=float, default=None,
+                        help='Dance on predicted beats, this many seconds early.')
+
+    args = parser.parse_args()
+
+    results = run_show(args.duration, model=args.model, timeline=args.timeline,
+                       use_engine=args.engine, lead=args.lead)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    # Done.
@@ -0,0 +1,384 @@
+"""
+Audio output sinks for beats.Player.
+
+A sink is used like an ossaudiodev output device, with sizes and counts in frames, and
+setparameters() returning the format, channels and sample rate actually set, but
+writes never block: write() takes as much as the buffer has room for and returns the
+number of bytes taken.  wait() blocks until there is room, a timeout passes, or another
+thread calls interrupt(), so the player can feed audio as space frees up and still
+respond to stop() at once.
+
+  - OssSink: OSS audio device in non-blocking mode, waiting on select().
+  - NullSink: no device.  Audio drains from a buffer at the sample rate in clock time,
+    like a sound card's, and is thrown away.  For benchmarks and machines without
+    sound.  Given a sample rate it plays only that rate, as many sound cards do.
+  - WavSink: writes the audio to a WAV file, paced like NullSink or as fast as
+    possible.
+
+make_sink() picks one from a short description, e.g. 'oss', 'null', 'null:48000' or
+'wav:out.wav'.
+
+"""
+
+import errno
+import os
+import select
+import struct
+import wave
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import ossaudiodev
+except ImportError:
+    ossaudiodev = None
+
+import numpy as np
+
+import clock
+
+#################################################
+
+# Signed 16-bit little endian sample format.
+if ossaudiodev:
+    AFMT_S16_LE = ossaudiodev.AFMT_S16_LE
+else:
+    AFMT_S16_LE = 0x10
+
+BUFFER_SIZE = 4096       # Frames.
+FRAGMENTS = 4            # Buffer parts; wait() returns once one part is free.
+
+
+def write_all(sink, data, timeout=None):
+    """
+    Write all of data to a sink, waiting for room as needed.
+    """
+    view = memoryview(data).cast('B')
+    while len(view):
+        n = sink.write(view)
+        view = view[n:]
+        if len(view):
+            sink.wait(timeout)
+
+    # Done.
+
+
+def make_sink(spec=None):
+    """
+    Sink from a description: 'oss' or 'oss:DEVICE', 'null' or 'null:RATE', 'wav:FILE'
+    to write a file in real time, or 'wav-fast:FILE' to write it as fast as possible.
+    Default 'oss'.
+    """
+    if not spec:
+        spec = 'oss'
+
+    kind, sep, arg = spec.partition(':')
+    if kind == 'oss':
+        return OssSink(arg or None)
+    if kind == 'null':
+        return NullSink(sample_rate=int(arg) if arg else None)
+    if kind == 'wav':
+        return WavSink(arg)
+    if kind == 'wav-fast':
+        return WavSink(arg, realtime=False)
+
+    # Done.
+    raise ValueError('Unknown audio sink: %s' % spec)
+
+#################################################
+
+
+class OssSink(object):
+    """
+    OSS audio output device with non-blocking writes.
+    """
+
+    def __init__(self, name=None):
+        if ossaudiodev is None:
+            raise IOError('No OSS audio support, use another sink')
+
+        self.name = name
+        self.device = None
+        self.frame_bytes = None
+
+        # Pipe for interrupt() to wake select() with.
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+
+
+    def setparameters(self, fmt, num_channels, sample_rate):
+        if self.device is None:
+            if self.name:
+                self.device = ossaudiodev.open(self.name, 'w')
+            else:
+                self.device = ossaudiodev.open('w')
+
+        fmt, num_channels, sample_rate = self.device.setparameters(fmt, num_channels,
+                                                                   sample_rate)
+        self.device.nonblock()
+        self.frame_bytes = 2 * num_channels
+
+        # Done.
+        return fmt, num_channels, sample_rate
+
+
+    def bufsize(self):
+        return self.device.bufsize()
+
+
+    def obuffree(self):
+        return self.device.obuffree()
+
+
+    def odelay(self):
+        """
+        Frames written and not yet played, from SNDCTL_DSP_GETODELAY if available.
+        """
+        request = getattr(ossaudiodev, 'SNDCTL_DSP_GETODELAY', None)
+        if fcntl and request is not None:
+            try:
+                reply = fcntl.ioctl(self.device.fileno(), request, struct.pack('i', 0))
+                return struct.unpack('i', reply)[0] // self.frame_bytes
+            except (IOError, OSError):
+                pass
+
+        # Done.
+        return self.device.obufcount()
+
+
+    def write(self, data):
+        try:
+            return self.device.write(data)
+        except BlockingIOError:
+            return 0
+
+
+    def wait(self, timeout=None):
+        """
+        Wait for room in the buffer.  Returns the frames free.
+        """
+        readable, writable, failed = select.select([self.wake_r], [self.device.fileno()],
+                                                   [], timeout)
+        if readable:
+            try:
+                os.read(self.wake_r, 64)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+        # Done.
+        return self.obuffree()
+
+
+    def interrupt(self):
+        try:
+            os.write(self.wake_w, b'x')
+        except BlockingIOError:
+            pass
+
+
+    def reset(self):
+        """
+        Stop playing and discard buffered audio.
+        """
+        self.device.reset()
+
+
+    def close(self):
+        if self.device is not None:
+            self.device.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+#################################################
+
+
+class NullSink(object):
+    """
+    Sink without a device.  Buffered audio drains at the sample rate in clock time and
+    is passed to consume(), which discards it.  Sound is taken to be heard latency
+    seconds after it leaves the buffer, a delay odelay() does not report, as with a real
+    converter and speaker.  Given a sample rate, setparameters() sets that whatever
+    rate is asked for.
+    """
+
+    def __init__(self, buffer_size=None, latency=None, sample_rate=None):
+        if not buffer_size:
+            buffer_size = BUFFER_SIZE
+        if latency is None:
+            latency = 0.
+
+        self.buffer_size = buffer_size
+        self.fragment = max(buffer_size // FRAGMENTS, 1)
+        self.latency = latency
+        self.fixed_rate = sample_rate
+
+        self.frame_bytes = None
+        self.sample_rate = None
+        self.num_channels = None
+
+        self.level = 0.
+        self.t_level = None
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.closed = False
+
+        self.wakeup = clock.Event()
+
+
+    def setparameters(self, fmt, num_channels, sample_rate):
+        """
+        Assume 16-bit samples.
+        """
+        if self.fixed_rate:
+            sample_rate = self.fixed_rate
+
+        self.num_channels = num_channels
+        self.sample_rate = sample_rate
+        self.frame_bytes = 2 * num_channels
+
+        # Done.
+        return fmt, num_channels, sample_rate
+
+
+    def bufsize(self):
+        return self.buffer_size
+
+
+    def drain(self):
+        """
+        Remove data played out since the last call.
+        """
+        t = clock.time()
+        if self.t_level is not None:
+            self.level = max(self.level - (t - self.t_level) * self.sample_rate, 0.)
+        self.t_level = t
+
+
+    def obufcount(self):
+        """
+        Frames in the buffer yet to be played.
+        """
+        self.drain()
+
+        # Done.
+        return int(np.ceil(self.level))
+
+
+    def obuffree(self):
+        return self.buffer_size - self.obufcount()
+
+
+    def odelay(self):
+        return self.obufcount()
+
+
+    def position(self):
+        """
+        True position in the audio being heard, seconds.
+        """
+        self.drain()
+
+        # Done.
+        return (self.frames_written - self.level) / self.sample_rate - self.latency
+
+
+    def write(self, data):
+        frames = min(len(data) // self.frame_bytes, self.obuffree())
+        if frames <= 0:
+            return 0
+
+        num = frames * self.frame_bytes
+        self.consume(data[:num])
+
+        self.level += frames
+        self.frames_written += frames
+        self.bytes_written += num
+
+        # Done.
+        return num
+
+
+    def consume(self, data):
+        pass
+
+
+    def wait(self, timeout=None):
+        """
+        Wait for a fragment of room in the buffer.  Returns the frames free.
+        """
+        free = self.obuffree()
+        if free < self.fragment:
+            dt = float(self.fragment - free) / self.sample_rate
+            if timeout is not None:
+                dt = min(dt, timeout)
+
+            self.wakeup.wait(dt)
+            self.wakeup.clear()
+            free = self.obuffree()
+
+        # Done.
+        return free
+
+
+    def interrupt(self):
+        self.wakeup.set()
+
+
+    def reset(self):
+        self.drain()
+        self.level = 0.
+
+
+    def close(self):
+        self.closed = True
+
+
+class WavSink(NullSink):
+    """
+    Sink writing to a WAV file.  With realtime set, audio is taken at the sample rate as
+    by NullSink, else as fast as it comes with no output delay.
+    """
+
+    def __init__(self, fname, realtime=True, buffer_size=None):
+        NullSink.__init__(self, buffer_size)
+
+        self.fname = fname
+        self.realtime = realtime
+        self.wav = None
+
+
+    def setparameters(self, fmt, num_channels, sample_rate):
+        info = NullSink.setparameters(self, fmt, num_channels, sample_rate)
+
+        if self.wav is None:
+            self.wav = wave.open(self.fname, 'wb')
+            self.wav.setsampwidth(2)
+            self.wav.setnchannels(num_channels)
+            self.wav.setframerate(sample_rate)
+
+        # Done.
+        return info
+
+
+    def drain(self):
+        if self.realtime:
+            NullSink.drain(self)
+        else:
+            self.level = 0.
+
+
+    def consume(self, data):
+        self.wav.writeframesraw(data)
+
+
+    def close(self):
+        if self.wav is not None:
+            self.wav.close()
+            self.wav = None
+
+        NullSink.close(self)
@@ -0,0 +1,291 @@
+"""
+Tempo tracking and beat prediction.
+
+BeatPredictor locks onto the tempo and phase of beat events as they arrive, from a
+song's analysis or from live.LivePlayer, and predicts the times of the beats to come.
+It is a phase-locked loop: each observed beat is matched to the nearest beat of the
+predicted grid, and the timing error nudges both the grid's phase and its period.  A
+gap of several periods between beats counts as dropped beats, not as a tempo change.
+A run of beats off the grid restarts the lock.
+
+anticipate() uses a predictor to hand beat events to the dance ahead of time, so servos
+can be moving before the beat instead of starting on it.  lego.Controller does this
+when given a predictor.
+
+"""
+
+import numpy as np
+
+import clock
+
+#################################################
+
+BPM_DEFAULT = 120.
+BPM_MIN = 40.
+BPM_MAX = 240.
+
+ALPHA = 0.4            # Phase correction gain.
+BETA = 0.1             # Period correction gain.
+TOLERANCE = 0.2        # Fraction of a period a beat may be off the grid.
+LOCK_BEATS = 3         # Beats on the grid in a row before predictions are trusted.
+RELOCK_BEATS = 3       # Beats off the grid in a row before restarting the lock.
+SMOOTHING = 0.2        # Weight of the latest beat in running error statistics.
+
+
+def estimate_bpm(beat_times):
+    """
+    Tempo from a list of beat times, using the median interval.
+    """
+    intervals = np.diff(np.asarray(beat_times, dtype=float))
+    intervals = intervals[(intervals >= 60. / BPM_MAX) & (intervals <= 60. / BPM_MIN)]
+    if not len(intervals):
+        return BPM_DEFAULT
+
+    # Done.
+    return 60. / np.median(intervals)
+
+
+class BeatPredictor(object):
+    """
+    Phase-locked estimate of the beat grid.  Feed it beat times in order with update(),
+    then ask for the beats to come with predict().
+    """
+
+    def __init__(self, bpm=None, min_confidence=None):
+        """
+        Start from a tempo guess, default 120 bpm.  Predictions are considered reliable
+        while confidence is at least min_confidence, default 0.5.
+        """
+        if not bpm:
+            bpm = BPM_DEFAULT
+        if min_confidence is None:
+            min_confidence = 0.5
+
+        self.period = 60. / bpm
+        self.min_confidence = min_confidence
+
+        self.t_ref = None
+        self.t_seen = None
+        self.t_miss = None
+
+        self.hits = 0
+        self.misses = 0
+        self.error_var = 0.
+        self.quality = 0.
+
+        # Done.
+
+
+    @property
+    def bpm(self):
+        return 60. / self.period
+
+
+    def update(self, t):
+        """
+        Observe a beat at time t.  Returns True if it landed on the predicted grid.
+        """
+        if self.t_ref is None:
+            self.t_ref = self.t_seen = t
+            return False
+
+        dt = t - self.t_ref
+        n = max(int(round(dt / self.period)), 1)
+        error = dt - n * self.period
+
+        if abs(error) > TOLERANCE * self.period:
+            self.miss(t)
+            return False
+
+        self.t_seen = t
+        self.t_miss = None
+        self.misses = 0
+        self.hits += 1
+
+        if self.hits < LOCK_BEATS:
+            # Still acquiring: take the interval at face value.
+            self.period = self.clip(dt / n)
+            self.t_ref = t
+        else:
+            self.t_ref += n * self.period + ALPHA * error
+            self.period = self.clip(self.period + BETA * error / n)
+
+        e = error / self.period
+        self.error_var += SMOOTHING * (e * e - self.error_var)
+        self.quality += SMOOTHING * (1. - self.quality)
+
+        # Done.
+        return True
+
+
+    def miss(self, t):
+        """
+        Beat off the grid.  Restart the lock after too many in a row.
+        """
+        self.misses += 1
+        self.quality -= SMOOTHING * self.quality
+
+        if self.misses >= RELOCK_BEATS:
+            if self.t_miss is not None:
+                dt = t - self.t_miss
+                if 60. / BPM_MAX <= dt <= 60. / BPM_MIN:
+                    self.period = dt
+
+            self.t_ref = self.t_seen = t
+            self.hits = 0
+            self.misses = 0
+            self.error_var = 0.
+            self.quality = 0.
+
+        self.t_miss = t
+
+
+    def clip(self, period):
+        return min(max(period, 60. / BPM_MAX), 60. / BPM_MIN)
+
+
+    def confidence(self, t=None):
+        """
+        Confidence in the beat grid at time t, between 0 and 1.  Falls away while no
+        beats are seen, and with timing error.
+        """
+        if self.t_ref is None or self.hits == 0:
+            return 0.
+
+        if t is None:
+            t = self.t_seen
+
+        silent = (t - self.t_seen) / self.period
+        fade = np.exp(-max(silent - 1., 0.) / 4.)
+        sharp = np.exp(-0.5 * self.error_var / (TOLERANCE / 2.)**2)
+
+        # Done.
+        return float(self.quality * sharp * fade)
+
+
+    def locked(self, t=None):
+        return self.hits >= LOCK_BEATS and self.confidence(t) >= self.min_confidence
+
+
+    def next_beat(self, after):
+        """
+        Time of the first predicted beat later than after.
+        """
+        if self.t_ref is None:
+            return None
+
+        n = np.floor((after - self.t_ref) / self.period) + 1
+
+        # Done.
+        return self.t_ref + n * self.period
+
+
+    def predict(self, num=None, after=None):
+        """
+        Times of the next num beats later than after, default the last beat seen, and
+        the confidence in each.  Confidence falls with distance ahead as period error
+        accumulates.
+        """
+        if not num:
+            num = 4
+        if after is None:
+            after = self.t_seen
+
+        if self.t_ref is None:
+            return np.zeros(0), np.zeros(0)
+
+        times = self.next_beat(after) + np.arange(num) * self.period
+
+        ahead = (times - self.t_seen) / self.period
+        spread = np.sqrt(self.error_var) * np.sqrt(1. + (BETA * ahead)**2)
+        confidence = self.confidence(after) * np.exp(-0.5 * (spread / TOLERANCE)**2)
+
+        # Done.
+        return times, confidence
+
+#################################################
+
+
+class Anticipation(object):
+    """
+    State for anticipate(): decides when to issue predicted beats and which observed
+    beats to pass on.  Shared with engine.Engine.anticipate(), which does its waiting on
+    the event loop instead.
+    """
+
+    def __init__(self, predictor, player, lead=None):
+        if lead is None:
+            lead = 0.1
+
+        self.predictor = predictor
+        self.player = player
+        self.lead = lead
+        self.t_issued = None
+
+
+    def idle(self):
+        """
+        Idle wake up.  Returns the time to wait and the beat event to issue after it, if
+        the next beat is due within one interval, else None.
+        """
+        t_now = self.player.timestamp
+        if t_now is None or not self.predictor.locked(t_now):
+            return None
+
+        after = t_now
+        if self.t_issued is not None:
+            after = max(after, self.t_issued + self.predictor.period / 2.)
+        t_next = self.predictor.next_beat(after)
+
+        wait = t_next - self.lead - t_now
+        if wait > self.player.time_interval:
+            return None
+
+        self.t_issued = t_next
+
+        # Done.
+        return wait, (t_next, 'beat')
+
+
+    def observe(self, d):
+        """
+        Observed audio event.  Returns it to pass on, or None if a predicted beat already
+        stood in for it.
+        """
+        if d[1] != 'beat':
+            return d
+
+        self.predictor.update(d[0])
+
+        tolerance = TOLERANCE * self.predictor.period
+        if self.t_issued is not None and abs(d[0] - self.t_issued) <= tolerance:
+            return None
+
+        self.t_issued = d[0]
+
+        # Done.
+        return d
+
+
+def anticipate(events, predictor, player, lead=None):
+    """
+    Generator passing on audio events from player.beats(idle=True), with beat events
+    issued lead seconds, default 0.1, ahead of the predicted beat while the predictor is
+    locked.  Observed beats update the predictor, and are dropped when a predicted beat
+    already stood in for them.  Falls back to the observed beats when the lock is lost.
+    """
+    state = Anticipation(predictor, player, lead)
+
+    for d in events:
+        if d is None:
+            due = state.idle()
+            if due:
+                wait, d = due
+                clock.sleep(wait)
+                yield d
+        else:
+            d = state.observe(d)
+            if d:
+                yield d
+
+    # Done.